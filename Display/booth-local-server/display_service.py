@@ -0,0 +1,212 @@
+"""Long-running e-ink display service for the booth.
+
+Start it once with the privileges the panel needs:
+
+    sudo python3 display_service.py
+
+The Flask app sends display jobs to it over a Unix socket and returns right
+away. Jobs wait in a bounded queue and the panel worker only shows the
+newest one: updates that arrive within DISPLAY_COALESCE_WINDOW of each
+other, or while the panel is refreshing, are coalesced and the older frames
+are dropped. A slow refresh never holds up an upload request and the panel
+does not work through a backlog of QR codes nobody will scan.
+
+With DISPLAY_MODE=partial and a panel backend that supports it (see
+display_panels.py), only the window that differs from the last frame is
+refreshed, with a full refresh every FULL_REFRESH_INTERVAL updates to clear
+ghosting. Otherwise every frame is a full refresh.
+
+Requests and replies are single JSON lines:
+    {"op": "show", "job": "<job id>", "frame": "<image id>_qr"}
+    {"op": "status"} or {"op": "status", "job": "<job id>"}
+"""
+import os
+import re
+import json
+import time
+import datetime
+import threading
+import collections
+import socketserver
+from display_panels import create_panel, load_frame, changed_window
+
+DISPLAY_SOCKET = os.environ.get('DISPLAY_SOCKET', '/tmp/booth-display.sock')
+DISPLAY_SOCKET_MODE = 0o666  # The app does not run as root
+DISPLAY_QUEUE_SIZE = 8  # The oldest pending frame is dropped beyond this
+DISPLAY_COALESCE_WINDOW = float(os.environ.get('DISPLAY_COALESCE_WINDOW', 0.25))  # seconds
+DISPLAY_JOB_HISTORY = 100  # Finished jobs kept for status lookups
+FRAME_NAME_PATTERN = re.compile(r'[A-Za-z0-9_-]+')  # The driver builds file paths from it
+DISPLAY_MODE = os.environ.get('DISPLAY_MODE', 'full')  # 'full' or 'partial'
+FULL_REFRESH_INTERVAL = int(os.environ.get('FULL_REFRESH_INTERVAL', 10))  # Partial updates between full refreshes
+DISPLAY_ERROR_DELAY = 1  # seconds the worker pauses after a failed refresh
+
+class DisplayService:
+    """Last-writer-wins display scheduler drained by a single panel worker"""
+
+    def __init__(self, panel, queue_size=DISPLAY_QUEUE_SIZE, coalesce_window=DISPLAY_COALESCE_WINDOW):
+        self.panel = panel
+        self.queue_size = queue_size
+        self.coalesce_window = coalesce_window
+        self.pending = []  # (job ID, frame), oldest first
+        self.first_pending_at = None
+        self.condition = threading.Condition()
+        self.jobs = collections.OrderedDict()  # job ID -> state
+        self.stats = {'queued': 0, 'shown': 0, 'failed': 0, 'dropped': 0,
+                      'fullRefreshes': 0, 'partialRefreshes': 0, 'unchanged': 0}
+        self.current_job = None
+        self.last_refresh_seconds = None
+        # Only touched by the worker
+        self.shown_buffer = None
+        self.partial_updates = 0
+
+        self.worker_thread = threading.Thread(target=self.run, daemon=True)
+        self.worker_thread.start()
+
+    def submit(self, job_id, frame):
+        """Queue a frame without blocking and return the job's state"""
+        with self.condition:
+            if not self.pending:
+                self.first_pending_at = time.monotonic()
+            self.pending.append((job_id, frame))
+            self.set_state(job_id, 'queued')
+            if len(self.pending) > self.queue_size:
+                self.set_state(self.pending.pop(0)[0], 'dropped')
+            self.condition.notify()
+        return 'queued'
+
+    def set_state(self, job_id, state):
+        """Record a job's state; callers must hold the condition"""
+        self.jobs[job_id] = state
+        self.jobs.move_to_end(job_id)
+        while len(self.jobs) > DISPLAY_JOB_HISTORY:
+            self.jobs.popitem(last=False)
+        if state in self.stats:
+            self.stats[state] += 1
+
+    def next_job(self):
+        """Wait for pending frames, let a burst collect, and return the newest"""
+        with self.condition:
+            while True:
+                if self.pending:
+                    remaining = self.first_pending_at + self.coalesce_window - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                else:
+                    self.condition.wait()
+            
+            job_id, frame = self.pending.pop()
+            for superseded_id, _ in self.pending:
+                self.set_state(superseded_id, 'dropped')
+            self.pending.clear()
+            self.current_job = job_id
+            self.set_state(job_id, 'showing')
+            return job_id, frame
+
+    def run(self):
+        while True:
+            job_id, frame = self.next_job()
+            try:
+                started = time.monotonic()
+                refresh = self.show(frame)
+                state = 'shown'
+                with self.condition:
+                    self.stats[refresh] += 1
+                    self.last_refresh_seconds = round(time.monotonic() - started, 3)
+                print(f"[{datetime.datetime.now()}] Displayed {frame or 'current frame'} (job {job_id})")
+            except Exception as e:
+                # Driver errors must not end the only worker
+                state = 'failed'
+                print(f"[{datetime.datetime.now()}] Error displaying {frame} (job {job_id}): {e!r}")
+                self.recover()
+            with self.condition:
+                self.set_state(job_id, state)
+                self.current_job = None
+
+    def recover(self):
+        """Reset the panel after a failed refresh; its contents are unknown, so the next frame is a full refresh"""
+        self.shown_buffer = None
+        self.partial_updates = 0
+        try:
+            self.panel.recover()
+        except Exception as e:
+            print(f"[{datetime.datetime.now()}] Error resetting the {self.panel.name} panel: {e!r}")
+        time.sleep(DISPLAY_ERROR_DELAY)
+
+    def show(self, frame):
+        """Put a frame on the panel, or redraw the current one if frame is None.
+
+        Returns the kind of refresh used, as a stats key.
+        """
+        buffer = load_frame(frame) if frame else self.shown_buffer
+        if (DISPLAY_MODE == 'partial' and self.panel.supports_partial and frame
+                and buffer is not None and self.shown_buffer is not None
+                and self.partial_updates < FULL_REFRESH_INTERVAL):
+            window = changed_window(self.shown_buffer, buffer)
+            if window is None:
+                return 'unchanged'
+            self.panel.show_partial(buffer, window)
+            self.shown_buffer = buffer
+            self.partial_updates += 1
+            return 'partialRefreshes'
+        
+        self.panel.show_full(frame, buffer)
+        self.shown_buffer = buffer
+        self.partial_updates = 0
+        return 'fullRefreshes'
+
+    def status(self, job_id=None):
+        with self.condition:
+            if job_id is not None:
+                return {'job': job_id, 'status': self.jobs.get(job_id, 'unknown')}
+            return dict(self.stats,
+                        queueDepth=len(self.pending),
+                        queueSize=self.queue_size,
+                        coalesceWindow=self.coalesce_window,
+                        mode=DISPLAY_MODE if self.panel.supports_partial else 'full',
+                        panel=self.panel.status(),
+                        lastRefreshSeconds=self.last_refresh_seconds,
+                        currentJob=self.current_job)
+
+class DisplayRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            message = json.loads(self.rfile.readline())
+            if message.get('op') == 'show':
+                job_id = str(message['job'])
+                frame = message.get('frame')
+                if frame is not None and not FRAME_NAME_PATTERN.fullmatch(frame):
+                    raise ValueError(f'invalid frame name {frame!r}')
+                reply = {'job': job_id, 'status': self.server.service.submit(job_id, frame)}
+            elif message.get('op') == 'status':
+                reply = self.server.service.status(message.get('job'))
+            else:
+                reply = {'error': 'Unknown op'}
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            reply = {'error': f'Bad request: {e}'}
+        self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+
+class DisplayServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, service):
+        self.service = service
+        # A socket left behind by a previous run would make bind fail
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, DisplayRequestHandler)
+        os.chmod(path, DISPLAY_SOCKET_MODE)
+
+if __name__ == '__main__':
+    # The driver and its frame files are relative to this folder
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    panel = create_panel()
+    if DISPLAY_MODE == 'partial' and not panel.supports_partial:
+        print(f"[{datetime.datetime.now()}] The {panel.name} backend cannot do partial refreshes, using full refreshes")
+    server = DisplayServer(DISPLAY_SOCKET, DisplayService(panel))
+    print(f"[{datetime.datetime.now()}] Display service listening on {DISPLAY_SOCKET}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(DISPLAY_SOCKET)
@@ -0,0 +1,368 @@
+"""Image work run by the app's image worker processes.
+
+Workers are started by a fork server (or spawned), not forked from the
+app, so they only import this module. It must not import app.py or start
+anything when imported. Tasks take and return plain data, and the app
+runs them itself when the workers cannot.
+
+- encode_qr_matrix: a URL's QR module matrix, with FastQRCode's vectorized
+  mask selection.
+- render_qr_*: QR code images from a module matrix.
+- render_eink_files: the display's frame around a QR code, as the native
+  buffer and the BMP the epd binary reads.
+- build_renditions: the resized copies of an upload shown by the pages.
+"""
+import os
+import time
+import struct
+import datetime
+import threading
+from io import BytesIO
+import numpy as np
+import qrcode
+from PIL import Image, ImageDraw, ImageFont, ImageOps
+
+EINK_WIDTH, EINK_HEIGHT = 800, 480  # Waveshare 7.5" V2 panel resolution
+EINK_BUFFER_MAGIC = b'EPD1'  # Header of the native .epd frame files
+EINK_QR_AREA = 480  # The QR is centered in the left 480x480 square of the frame
+EINK_CAPTION = os.environ.get('EINK_CAPTION', 'Scan to view and download your photo')
+EINK_BRANDING = os.environ.get('EINK_BRANDING', '')  # Optional text under the logo
+EINK_LOGO_FILE = os.environ.get('EINK_LOGO_FILE', 'logo.png')  # Optional, drawn at the top right
+EINK_FONT_FILE = os.environ.get('EINK_FONT_FILE', 'DejaVuSans.ttf')
+RENDITION_SAVE_OPTIONS = {
+    'webp': {'quality': 75, 'method': 4},
+    'jpeg': {'quality': 80, 'optimize': True, 'progressive': True}
+}
+
+def render_qr_pixels(matrix, box_size):
+    """Scale a QR module matrix (True = dark module) to a 1-bit pixel array (True = white)"""
+    modules = np.asarray(matrix, dtype=bool)
+    return ~np.kron(modules, np.ones((box_size, box_size), dtype=bool))
+
+def encode_image(image, image_format):
+    """Encode a PIL image to bytes"""
+    buffer = BytesIO()
+    image.save(buffer, format=image_format)
+    return buffer.getvalue()
+
+def render_qr_png(modules, box_size):
+    return encode_image(Image.fromarray(render_qr_pixels(modules, box_size)), 'PNG')
+
+def render_qr_bmp(modules, box_size):
+    return encode_image(Image.fromarray(render_qr_pixels(modules, box_size)), 'BMP')
+
+def render_qr_bits(modules, box_size):
+    """Pixel rows packed 8 to a byte, most significant bit first, 1 = dark"""
+    return np.packbits(~render_qr_pixels(modules, box_size), axis=1).tobytes()
+
+def render_qr_svg(modules, box_size):
+    """One unit square per dark module, scaled to box_size pixels per module"""
+    count = len(modules)
+    size = count * box_size
+    rows, cols = np.nonzero(modules)
+    path = ''.join(f"M{col} {row}h1v1h-1z" for row, col in zip(rows.tolist(), cols.tolist()))
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{size}" height="{size}" '
+            f'viewBox="0 0 {count} {count}" shape-rendering="crispEdges">'
+            f'<rect width="{count}" height="{count}" fill="#fff"/><path d="{path}"/></svg>').encode('utf-8')
+
+# Reused 800x480 1-bit frame for the e-ink display files (True = white)
+eink_frame = np.ones((EINK_HEIGHT, EINK_WIDTH), dtype=bool)
+eink_frame_lock = threading.Lock()
+
+# Fonts by size and the pre-rasterized static layers of the e-ink frame
+eink_fonts = {}
+eink_layers = {}
+
+def get_eink_font(size):
+    font = eink_fonts.get(size)
+    if font is None:
+        try:
+            font = ImageFont.truetype(EINK_FONT_FILE, size)
+        except OSError:
+            font = ImageFont.load_default()
+        eink_fonts[size] = font
+    return font
+
+def wrap_text(draw, text, font, width):
+    """Split text into lines no wider than width pixels"""
+    lines = []
+    for word in text.split():
+        if lines and draw.textlength(f"{lines[-1]} {word}", font=font) <= width:
+            lines[-1] = f"{lines[-1]} {word}"
+        else:
+            lines.append(word)
+    return lines
+
+def get_eink_background():
+    """Return the static layers (logo, branding and caption) as a 1-bit array, rendered once"""
+    background = eink_layers.get('background')
+    if background is None:
+        image = Image.new('1', (EINK_WIDTH, EINK_HEIGHT), 1)
+        draw = ImageDraw.Draw(image)
+        x = EINK_QR_AREA
+        width = EINK_WIDTH - EINK_QR_AREA - 40
+        y = 40
+        
+        if os.path.exists(EINK_LOGO_FILE):
+            try:
+                with Image.open(EINK_LOGO_FILE) as logo:
+                    logo.thumbnail((width, 120))
+                    image.paste(logo.convert('1'), (x, y))
+                    y += logo.height + 20
+            except OSError as e:
+                print(f"[{datetime.datetime.now()}] Error loading e-ink logo: {e}")
+        if EINK_BRANDING:
+            font = get_eink_font(32)
+            for line in wrap_text(draw, EINK_BRANDING, font, width):
+                draw.text((x, y), line, font=font, fill=0)
+                y += 40
+            y += 10
+        
+        font = get_eink_font(28)
+        for line in wrap_text(draw, EINK_CAPTION, font, width):
+            draw.text((x, y), line, font=font, fill=0)
+            y += 36
+        
+        background = eink_layers['background'] = np.array(image, dtype=bool)
+    return background
+
+def render_text(text, size):
+    """Rasterize one line of text to a 1-bit array (True = white)"""
+    font = get_eink_font(size)
+    left, top, right, bottom = ImageDraw.Draw(Image.new('1', (1, 1))).textbbox((0, 0), text, font=font)
+    image = Image.new('1', (right, bottom), 1)
+    ImageDraw.Draw(image).text((0, 0), text, font=font, fill=0)
+    return np.array(image, dtype=bool)
+
+def blit(pixels, x, y):
+    """Draw the dark pixels of a 1-bit array onto the e-ink frame, clipped to it"""
+    height = min(pixels.shape[0], EINK_HEIGHT - y)
+    width = min(pixels.shape[1], EINK_WIDTH - x)
+    eink_frame[y:y + height, x:x + width] &= pixels[:height, :width]
+
+def compose_eink_frame(pixels, expires_at=None):
+    """Compose the QR pixels and the expiry time over the static layers and return the frame.
+
+    Callers must hold eink_frame_lock. The frame is reused between calls.
+    """
+    eink_frame[:] = get_eink_background()
+    height, width = pixels.shape
+    eink_frame[(EINK_QR_AREA - height) // 2:(EINK_QR_AREA + height) // 2,
+               (EINK_QR_AREA - width) // 2:(EINK_QR_AREA + width) // 2] = pixels
+    if expires_at:
+        expiry = time.strftime('%H:%M', time.localtime(expires_at))
+        blit(render_text(f"Available until {expiry}", 24), EINK_QR_AREA, EINK_HEIGHT - 80)
+    return eink_frame
+
+# Version chosen per (start version, error correction, data chunk modes and lengths)
+qr_version_cache = {}
+# Function pattern layout, the 8 mask patterns and data bit placement per QR version
+qr_layouts = {}
+# The fast mask selection is checked against the reference once per version
+fast_qr_state = {'enabled': True, 'verified': set()}
+
+FINDER_PATTERNS = np.array([
+    [1, 0, 1, 1, 1, 0, 1, 0, 0, 0, 0],
+    [0, 0, 0, 0, 1, 0, 1, 1, 1, 0, 1],
+], dtype=bool)
+
+def get_qr_layout(qr):
+    """Return (data module positions, mask patterns, data bit placement) for qr's version, computed once"""
+    layout = qr_layouts.get(qr.version)
+    if layout is None:
+        # Draw the function patterns on a scratch copy: the caller's modules may
+        # already hold its own, with the type info of a different mask
+        scratch = qrcode.QRCode(version=qr.version, error_correction=qr.error_correction)
+        n = scratch.modules_count = qr.version * 4 + 17
+        scratch.modules = [[None] * n for _ in range(n)]
+        scratch.setup_position_probe_pattern(0, 0)
+        scratch.setup_position_probe_pattern(n - 7, 0)
+        scratch.setup_position_probe_pattern(0, n - 7)
+        scratch.setup_position_adjust_pattern()
+        scratch.setup_timing_pattern()
+        scratch.setup_type_info(True, 0)
+        if qr.version >= 7:
+            scratch.setup_type_number(True)
+        data_modules = np.array([[module is None for module in row] for row in scratch.modules])
+        
+        # Data bits fill the free modules in the same zigzag as QRCode.map_data
+        order = []
+        row, inc = n - 1, -1
+        for col in range(n - 1, 0, -2):
+            if col <= 6:
+                col -= 1
+            while True:
+                for c in (col, col - 1):
+                    if scratch.modules[row][c] is None:
+                        order.append((row, c))
+                row += inc
+                if row < 0 or row >= n:
+                    row -= inc
+                    inc = -inc
+                    break
+        placement = tuple(np.array(order).T)
+        
+        i, j = np.indices((n, n))
+        masks = np.array([
+            (i + j) % 2 == 0,
+            i % 2 == 0,
+            j % 3 == 0,
+            (i + j) % 3 == 0,
+            (i // 2 + j // 3) % 2 == 0,
+            (i * j) % 2 + (i * j) % 3 == 0,
+            ((i * j) % 2 + (i * j) % 3) % 2 == 0,
+            ((i * j) % 3 + (i + j) % 2) % 2 == 0,
+        ])
+        layout = qr_layouts[qr.version] = (data_modules, masks, placement)
+    return layout
+
+def qr_run_penalty(candidates):
+    """Rule 1 along rows: every run of 5+ equal modules scores (length - 2)"""
+    n = candidates.shape[-1]
+    same = candidates[:, :, 1:] == candidates[:, :, :-1]
+    # One point per window of 5 equal modules, plus 2 for each run it starts
+    windows = same[:, :, 0:n - 4] & same[:, :, 1:n - 3] & same[:, :, 2:n - 2] & same[:, :, 3:n - 1]
+    run_starts = np.ones_like(windows)
+    run_starts[:, :, 1:] = ~same[:, :, 0:n - 5]
+    return windows.sum(axis=(1, 2)) + 2 * (windows & run_starts).sum(axis=(1, 2))
+
+def qr_finder_penalty(candidates):
+    """Rule 3 along rows: 40 points per 1:1:3:1:1 finder-like pattern with 4 light modules"""
+    windows = np.lib.stride_tricks.sliding_window_view(candidates, 11, axis=2)
+    matches = (windows[..., None, :] == FINDER_PATTERNS).all(axis=-1).any(axis=-1)
+    return 40 * matches.sum(axis=(1, 2))
+
+def qr_penalty_scores(candidates):
+    """Score candidate matrices, shape (masks, n, n), like qrcode.util.lost_point"""
+    n = candidates.shape[-1]
+    columns = candidates.transpose(0, 2, 1)
+    
+    top_left = candidates[:, :-1, :-1]
+    blocks = ((top_left == candidates[:, 1:, :-1]) & (top_left == candidates[:, :-1, 1:])
+              & (top_left == candidates[:, 1:, 1:]))
+    
+    percent = candidates.sum(axis=(1, 2)) / float(n ** 2)
+    balance = np.floor(np.abs(percent * 100 - 50) / 5).astype(np.int64) * 10
+    
+    return (qr_run_penalty(candidates) + qr_run_penalty(columns)
+            + 3 * blocks.sum(axis=(1, 2))
+            + qr_finder_penalty(candidates) + qr_finder_penalty(columns)
+            + balance)
+
+class FastQRCode(qrcode.QRCode):
+    """qrcode.QRCode with vectorized mask selection.
+
+    The reference encoder builds and scores all 8 masked matrices in pure
+    Python. This places the data bits and applies the 8 masks as NumPy
+    arrays and evaluates the same penalty rules for all of them at once. Fitted
+    versions are remembered for payloads with the same shape, such as view
+    URLs, which all have the same length.
+    """
+
+    def best_fit(self, start=None):
+        key = (start, self.error_correction, tuple((data.mode, len(data)) for data in self.data_list))
+        version = qr_version_cache.get(key)
+        if version is None:
+            version = super().best_fit(start)
+            if len(qr_version_cache) < 1024:
+                qr_version_cache[key] = version
+        self.version = version
+        return version
+
+    def map_data(self, data, mask_pattern):
+        if not fast_qr_state['enabled']:
+            return super().map_data(data, mask_pattern)
+        
+        data_modules, masks, placement = get_qr_layout(self)
+        matrix = np.array([[module is True for module in row] for row in self.modules])
+        bits = np.unpackbits(np.asarray(data, dtype=np.uint8))
+        values = np.zeros(len(placement[0]), dtype=bool)
+        values[:len(bits)] = bits[:len(values)]
+        matrix[placement] = values
+        matrix ^= data_modules & masks[mask_pattern]
+        self.modules = matrix.tolist()
+
+    def best_mask_pattern(self):
+        if not fast_qr_state['enabled']:
+            return super().best_mask_pattern()
+        
+        data_modules, masks, _ = get_qr_layout(self)
+        self.makeImpl(True, 0)
+        base = np.array(self.modules, dtype=bool)
+        # Swap mask 0 for each mask in turn on the data modules
+        candidates = base ^ (data_modules & (masks[0] ^ masks))
+        pattern = int(np.argmin(qr_penalty_scores(candidates)))
+        
+        verify_key = (self.version, self.error_correction)
+        if verify_key not in fast_qr_state['verified']:
+            expected = super().best_mask_pattern()
+            if expected != pattern:
+                print(f"[{datetime.datetime.now()}] Fast QR mask selection disagrees with qrcode "
+                      f"(version {self.version}: {pattern} != {expected}), using the reference encoder")
+                fast_qr_state['enabled'] = False
+                return expected
+            fast_qr_state['verified'].add(verify_key)
+        return pattern
+
+def encode_qr_matrix(url, error_correction):
+    """Return url's QR module matrix (True = dark, no border) as the bytes of a square bool array"""
+    qr = FastQRCode(version=1, error_correction=error_correction, border=0)
+    qr.add_data(url)
+    qr.make(fit=True)
+    return np.array(qr.modules, dtype=bool).tobytes()
+
+def encode_eink_buffer(frame):
+    """Encode a frame in the EPD_7in5_V2's native layout.
+
+    An 8-byte header (EINK_BUFFER_MAGIC, then width and height as little
+    endian uint16) is followed by the 48,000-byte frame: rows of 1-bit pixels
+    packed most significant bit first, 1 = white, ready to send to the panel.
+    """
+    header = struct.pack('<4sHH', EINK_BUFFER_MAGIC, EINK_WIDTH, EINK_HEIGHT)
+    return header + np.packbits(frame, axis=1).tobytes()
+
+def render_eink_files(modules, max_box_size, expires_at=None, bmp_fallback=False):
+    """Compose the frame for a QR module matrix (with its border); returns (native buffer, BMP or None)"""
+    # Shrink QR codes for long URLs to fit their square
+    box_size = max(1, min(max_box_size, EINK_QR_AREA // len(modules)))
+    pixels = render_qr_pixels(modules, box_size)
+    with eink_frame_lock:
+        frame = compose_eink_frame(pixels, expires_at)
+        epd_data = encode_eink_buffer(frame)
+        bmp_data = encode_image(Image.fromarray(frame), 'BMP') if bmp_fallback else None
+    return epd_data, bmp_data
+
+def build_renditions(image_id, upload_path, folder, widths, formats):
+    """Decode an upload once and write all its renditions; returns their total size.
+
+    Renditions are written to folder as <image id>_<width>.<format>, for
+    each of widths (ascending) and formats. EXIF orientation is applied and
+    no metadata is copied. Images are never enlarged: widths above the
+    original's are written at its size.
+    """
+    with Image.open(upload_path) as image:
+        # JPEGs can be decoded straight at a fraction of their size
+        image.draft('RGB', (widths[-1], widths[-1]))
+        image = ImageOps.exif_transpose(image)
+    has_alpha = image.mode in ('RGBA', 'LA') or 'transparency' in image.info
+    image = image.convert('RGBA' if has_alpha else 'RGB')
+    
+    written = 0
+    # Each width is resized from the previous, larger one
+    for width in sorted(widths, reverse=True):
+        if image.width > width:
+            height = max(1, round(image.height * width / image.width))
+            image = image.resize((width, height), Image.Resampling.LANCZOS, reducing_gap=3.0)
+        for image_format in formats:
+            output = image
+            if image_format == 'jpeg' and has_alpha:
+                output = Image.new('RGB', image.size, 'white')
+                output.paste(image, mask=image.getchannel('A'))
+            buffer = BytesIO()
+            output.save(buffer, image_format.upper(), **RENDITION_SAVE_OPTIONS[image_format])
+            path = os.path.join(folder, f"{image_id}_{width}.{image_format}")
+            with open(f"{path}.tmp", 'wb') as f:
+                f.write(buffer.getvalue())
+            os.replace(f"{path}.tmp", path)
+            written += buffer.tell()
+    return written
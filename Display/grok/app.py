@@ -3,17 +3,29 @@ from flask_cors import CORS
 import os
 import time
 import uuid
+import secrets
 import datetime
 import socket
 import threading
 import json
+import atexit
+import heapq
+import hashlib
+import collections
+import concurrent.futures
+import multiprocessing
+import importlib.machinery
+import math
+import sqlite3
 import qrcode
-from io import BytesIO
 from werkzeug.utils import secure_filename
-from PIL import Image
+from PIL import features
+import numpy as np
 import requests
-
-import subprocess
+from display_panels import create_panel, CommandPanel
+from display_service import DisplayService
+from image_tasks import (build_renditions, encode_qr_matrix, render_eink_files,
+                         render_qr_png, render_qr_bmp, render_qr_bits, render_qr_svg)
 
 app = Flask(__name__, static_folder='.')
 CORS(app)  # Enable CORS for all routes
@@ -24,23 +36,215 @@ QR_FOLDER = 'qrcodes'
 BMP_FOLDER = 'qrcodes_bmp'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp', 'bmp', 'svg'}
 EXPIRATION_TIME = 30 * 60  # 30 minutes in seconds
-CLEANUP_INTERVAL = 5 * 60  # 5 minutes in seconds
+MAX_EXPIRATION_TIME = 24 * 60 * 60  # Upper bound for a per-upload ttl
+IMAGE_ID_ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'  # Crockford base32
+IMAGE_ID_LENGTH = 8
+QR_UPPERCASE_URLS = os.environ.get('QR_UPPERCASE_URLS', '').lower() in ('1', 'true', 'yes')  # Smaller QR codes
+CLEANUP_INTERVAL = 5 * 60  # 5 minutes in seconds, backstop for the expiry scheduler
+SWEEP_INTERVAL = 60 * 60  # 1 hour in seconds
+SWEEP_GRACE_PERIOD = 60  # Leave files this recent alone during a sweep
 PORT = 3000
+VIEW_CSS_FILE = 'view.css'  # Stylesheet of the /view page
+VIEW_CSS_MAX_AGE = 365 * 24 * 60 * 60  # Its URL changes with its content
+# Cache-Control per route as (max-age in seconds, immutable). Files that never
+# change under their name are cached outright; a max-age of 0 makes browsers
+# revalidate every time with the route's ETag (and Last-Modified for files).
+CACHE_POLICIES = {
+    'uploads': (365 * 24 * 60 * 60, True),  # Named by content hash
+    'renditions': (MAX_EXPIRATION_TIME, True),
+    'qrcodes': (MAX_EXPIRATION_TIME, True),  # An image ID's QR code never changes
+    'view_css': (VIEW_CSS_MAX_AGE, True),
+    'static': (0, False),
+}
+# How /view pages are served: 'dynamic' renders them on request, 'static' writes
+# them at upload time and sends the file, and 'x-accel' / 'x-sendfile' leave
+# sending the file to a fronting nginx / Apache
+VIEW_PAGE_MODE = os.environ.get('VIEW_PAGE_MODE', 'dynamic')
+VIEW_PAGE_FOLDER = 'view_pages'
+VIEW_PAGE_ACCEL_PREFIX = os.environ.get('VIEW_PAGE_ACCEL_PREFIX', '/internal/view_pages')  # nginx internal location for VIEW_PAGE_FOLDER
+RENDITION_FOLDER = 'renditions'  # Resized copies of uploads shown by the pages
+RENDITION_WIDTHS = (320, 640, 1280)  # pixels
+GALLERY_RENDITION_WIDTHS = (320, 640)  # The gallery's thumbnails
+RENDITION_FORMATS = ('webp', 'jpeg') if features.check('webp') else ('jpeg',)  # Preferred first
+RENDITION_MIMETYPES = {'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+RENDITION_SOURCE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'webp', 'bmp'}  # GIFs and SVGs are shown as uploaded
+RENDITION_WAIT = 30  # seconds a request waits for a rendition that is being built
+# Processes for CPU-heavy image work, leaving a core for the request threads
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', max(1, (os.cpu_count() or 2) - 1)))
+IMAGE_WORKER_QUEUE_SIZE = 32  # Tasks queued or running at once
+IMAGE_TASK_TIMEOUT = 30  # seconds a caller waits for a task by default
+IMAGE_WORKER_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
 IMAGE_METADATA_FILE = 'image_metadata.json'
-DISPLAY_COMMAND = ["sudo","./epd"]
+METADATA_FLUSH_DELAY = 0.5  # seconds to batch metadata writes before saving
+METADATA_BACKEND = os.environ.get('METADATA_BACKEND', 'json')  # 'json' or 'sqlite'
+METADATA_DB_FILE = 'image_metadata.db'
+DISPLAY_COMMAND = ["sudo","./epd"]  # Used directly only when the display service is not running
+DISPLAY_SOCKET = os.environ.get('DISPLAY_SOCKET', '/tmp/booth-display.sock')  # See display_service.py
+DISPLAY_SOCKET_TIMEOUT = 2  # seconds
+# The prebuilt epd driver only reads BMPs, so keep writing them until it loads .epd files
+EINK_BMP_FALLBACK = os.environ.get('EINK_BMP_FALLBACK', 'true').lower() in ('1', 'true', 'yes')
+QR_ERROR_CORRECTION = qrcode.constants.ERROR_CORRECT_L
+QR_BOX_SIZE = 10
+QR_BORDER = 4
+QR_EC_LEVELS = {
+    'L': qrcode.constants.ERROR_CORRECT_L,
+    'M': qrcode.constants.ERROR_CORRECT_M,
+    'Q': qrcode.constants.ERROR_CORRECT_Q,
+    'H': qrcode.constants.ERROR_CORRECT_H,
+}
+QR_MAX_RENDER_SIZE = 2048  # Largest ?size= in pixels served by /qrcodes
+QR_CACHE_MAX_BYTES = 8 * 1024 * 1024  # In-memory QR render cache budget
+QR_CACHE_FOLDER = os.environ.get('QR_CACHE_FOLDER')  # Optional on-disk cache tier
+QR_CACHE_DISK_MAX_BYTES = 64 * 1024 * 1024
+QR_POOL_SIZE = 5  # Image IDs kept with their QR codes pre-rendered
+QR_POOL_REFILL_DELAY = 2  # seconds
+UPLOAD_CHUNK_SIZE = 64 * 1024
+REPLICATION_ENDPOINT = "https://qrcodegeneration2.onrender.com/api/upload"
+REPLICATION_OUTBOX_FOLDER = 'outbox'  # Pending uploads to copy to Render
+REPLICATION_CHUNK_SIZE = 64 * 1024
+REPLICATION_RETRY_DELAY = 5  # seconds, doubled after every failed attempt
+REPLICATION_MAX_RETRY_DELAY = 5 * 60
+REPLICATION_TIMEOUT = 120  # seconds per upload request
+IS_RENDER = 'RENDER' in os.environ  # Render sets RENDER=true for its services
 # Create necessary directories if they don't exist
-for folder in [UPLOAD_FOLDER, QR_FOLDER]:
+for folder in [UPLOAD_FOLDER, BMP_FOLDER, VIEW_PAGE_FOLDER, RENDITION_FOLDER]:
     if not os.path.exists(folder):
         os.makedirs(folder)
 
+# Folders holding per-image files, reconciled against the metadata by the sweeper.
+# QR PNGs are rendered on demand now; QR_FOLDER only holds files from older versions.
+ARTIFACT_FOLDERS = [UPLOAD_FOLDER, QR_FOLDER, BMP_FOLDER, VIEW_PAGE_FOLDER, RENDITION_FOLDER]
+# Artifacts that are reused rather than tied to an uploaded image
+PERSISTENT_ARTIFACT_IDS = {'remote'}
+
 app.config['BMP_FOLDER'] = BMP_FOLDER
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['QR_FOLDER'] = QR_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB max upload size
 
+def generate_image_id():
+    """Create a short image ID that is not in use yet.
+
+    IDs use Crockford's base32 alphabet (digits and uppercase letters without
+    I, L, O and U), which keeps view URLs short and lets an uppercase URL be
+    encoded in the QR code's compact alphanumeric mode.
+    """
+    while True:
+        image_id = ''.join(secrets.choice(IMAGE_ID_ALPHABET) for _ in range(IMAGE_ID_LENGTH))
+        if metadata_store.get(image_id) is None and image_id not in qr_pool:
+            return image_id
+
+def get_view_url(image_id):
+    """Return the public page an image's QR code points to"""
+    view_url = f"https://qrcodegeneration2.onrender.com/view/{image_id}"
+    return view_url.upper() if QR_UPPERCASE_URLS else view_url
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def is_valid_image_id(image_id):
+    """Accept short IDs as well as the UUIDs used by older uploads"""
+    if len(image_id) == IMAGE_ID_LENGTH and all(c in IMAGE_ID_ALPHABET for c in image_id):
+        return True
+    try:
+        return str(uuid.UUID(image_id)) == image_id
+    except ValueError:
+        return False
+
+def get_requested_image_id():
+    """Return the image ID sent by a replicating booth if it can be used, else None"""
+    requested_id = request.form.get('image_id')
+    if requested_id and not is_valid_image_id(requested_id):
+        requested_id = None
+    if requested_id and metadata_store.get(requested_id) is None:
+        return requested_id
+    return None
+
+def is_valid_content_hash(content_hash):
+    """Accept only full sha256 hex digests, as stored upload names use"""
+    return len(content_hash) == 64 and all(c in '0123456789abcdef' for c in content_hash)
+
+def get_replicated_image():
+    """Answer a booth resending an image ID this server already stores, else return None.
+
+    A replication retried after a timeout may have gone through the first
+    time. The same ID with the same content is acknowledged without changes;
+    the same ID with other content is refused.
+    """
+    image_id = request.form.get('image_id')
+    image_data = metadata_store.get(image_id) if image_id else None
+    if image_data is None:
+        return None
+    
+    content_hash = request.form.get('sha256')
+    if not content_hash and 'image' in request.files:
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: request.files['image'].stream.read(UPLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+        content_hash = digest.hexdigest()
+    if content_hash != image_data.get('sha256'):
+        print(f"[{datetime.datetime.now()}] Refusing image {image_id}: the ID is in use with other content")
+        return jsonify({'error': 'Image ID already in use'}), 409
+    
+    print(f"[{datetime.datetime.now()}] Image {image_id} is already stored, nothing to do")
+    return jsonify({
+        'success': True,
+        'id': image_id,
+        'url': f"/uploads/{image_data['filename']}",
+        'viewUrl': f"/view/{image_id}"
+    }), 200
+
+def get_requested_ttl():
+    """Read the optional per-upload lifetime in seconds from the request"""
+    ttl = request.form.get('ttl', type=int)
+    if not ttl or ttl <= 0:
+        return EXPIRATION_TIME
+    return min(ttl, MAX_EXPIRATION_TIME)
+
+def save_upload(image_id, file, original_filename, ttl):
+    """Store an uploaded file under its content hash and record its metadata.
+
+    Identical uploads share one file in UPLOAD_FOLDER. Each image ID is a
+    reference to it, and the file is only deleted with its last reference.
+    """
+    # allowed_file checked the extension of the name as sent; secure_filename can
+    # drop it (e.g. non-Latin names), so it is taken from there
+    extension = file.filename.rsplit('.', 1)[1].lower() if '.' in file.filename else ''
+    
+    # Hash the upload while it is written to a temporary file
+    temp_path = os.path.join(UPLOAD_FOLDER, f"{image_id}.part")
+    digest = hashlib.sha256()
+    with open(temp_path, 'wb') as f:
+        while True:
+            chunk = file.stream.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            f.write(chunk)
+    content_hash = digest.hexdigest()
+    unique_filename = f"{content_hash}.{extension}" if extension else content_hash
+    file_path = os.path.join(UPLOAD_FOLDER, unique_filename)
+    
+    upload_time = time.time()
+    image_data = {
+        'filename': unique_filename,
+        'original_filename': original_filename,
+        'upload_time': upload_time,
+        'expires_at': upload_time + ttl,
+        'size': os.path.getsize(temp_path),
+        'sha256': content_hash
+    }
+    with content_lock:
+        if os.path.exists(file_path):
+            os.remove(temp_path)
+            print(f"[{datetime.datetime.now()}] Upload matches stored content {unique_filename}, keeping one copy")
+        else:
+            os.replace(temp_path, file_path)
+        metadata_store.set(image_id, image_data)
+    expiry_scheduler.schedule(image_id, image_data['expires_at'])
+    write_view_page(image_id)
+    rendition_workers.submit(image_id)
+    return image_data
+
 def get_server_url():
     """Get the server's URL for network access"""
     # Always use Render URL for QR codes
@@ -48,115 +252,1312 @@ def get_server_url():
     print(f"[{datetime.datetime.now()}] Using Render URL for QR codes: {render_url}")
     return render_url
 
-def load_metadata():
-    """Load the image metadata from the JSON file"""
-    if os.path.exists(IMAGE_METADATA_FILE):
+class MultipartFileStream:
+    """multipart/form-data body that reads the file in chunks as it is sent"""
+
+    def __init__(self, file_path, filename, fields, chunk_size=REPLICATION_CHUNK_SIZE):
+        self.file_path = file_path
+        self.chunk_size = chunk_size
+        boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        head = ''.join(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+            for name, value in fields.items()
+        )
+        head += (f'--{boundary}\r\nContent-Disposition: form-data; name="image"; filename="{filename}"\r\n'
+                 f'Content-Type: application/octet-stream\r\n\r\n')
+        self.head = head.encode('utf-8')
+        self.tail = f"\r\n--{boundary}--\r\n".encode('utf-8')
+
+    def __len__(self):
+        # Lets requests send a Content-Length instead of chunked encoding
+        return len(self.head) + os.path.getsize(self.file_path) + len(self.tail)
+
+    def __iter__(self):
+        yield self.head
+        with open(self.file_path, 'rb') as f:
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        yield self.tail
+
+class ReplicationOutbox:
+    """Persistent queue of uploads waiting to be copied to the Render instance.
+
+    Each pending upload is a small JSON job file in the outbox folder, so
+    nothing is lost on restart. A worker thread streams the files over a
+    reused session and backs off while Render is unreachable or failing.
+    Jobs Render rejects (4xx) are parked in the rejected subfolder so they do
+    not hold up the ones behind them.
+    """
+
+    def __init__(self, folder, endpoint):
+        self.folder = folder
+        self.endpoint = endpoint
+        self.session = requests.Session()
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.stats = {'replicated': 0, 'linked': 0, 'failedAttempts': 0, 'abandoned': 0, 'rejected': 0}
+        # Content hashes Render is known to store; those are linked, not re-sent
+        self.remote_hashes = set()
+        self.last_error = None
+        self.rejected_folder = os.path.join(folder, 'rejected')
+        if not os.path.exists(self.rejected_folder):
+            os.makedirs(self.rejected_folder)
+        
+        self.worker_thread = threading.Thread(target=self.run, daemon=True)
+        self.worker_thread.start()
+
+    def enqueue(self, image_id, file_path, original_filename, fields=None, content_hash=None):
+        """Record an upload to replicate; returns as soon as the job is on disk"""
+        job = {
+            'image_id': image_id,
+            'file_path': file_path,
+            'original_filename': original_filename,
+            'fields': fields or {},
+            'sha256': content_hash,
+            'queued_at': time.time()
+        }
+        job_path = os.path.join(self.folder, f"{image_id}.json")
+        temp_path = f"{job_path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(job, f)
+        os.replace(temp_path, job_path)
+        self.wakeup.set()
+
+    def is_pending(self, image_id):
+        """Whether an image is still waiting to be replicated"""
+        return os.path.exists(os.path.join(self.folder, f"{image_id}.json"))
+
+    def pending_jobs(self):
+        """Return (job_path, job) pairs, oldest first"""
+        jobs = []
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.json'):
+                    continue
+                try:
+                    with open(entry.path, 'r') as f:
+                        jobs.append((entry.path, json.load(f)))
+                except (OSError, ValueError) as e:
+                    print(f"[{datetime.datetime.now()}] Skipping unreadable outbox job {entry.name}: {e}")
+        jobs.sort(key=lambda item: item[1]['queued_at'])
+        return jobs
+
+    def run(self):
+        delay = REPLICATION_RETRY_DELAY
+        while True:
+            self.wakeup.clear()
+            failed = False
+            for job_path, job in self.pending_jobs():
+                if not os.path.exists(job['file_path']):
+                    # The upload expired or was removed before it could be sent
+                    print(f"[{datetime.datetime.now()}] Dropping replication of missing file: {job['file_path']}")
+                    self.count('abandoned')
+                    os.remove(job_path)
+                    continue
+                replicated = self.replicate(job)
+                if replicated is None:
+                    failed = True
+                    break
+                if replicated:
+                    os.remove(job_path)
+                else:
+                    self.reject(job_path, job)
+            
+            if failed:
+                self.wakeup.wait(delay)
+                delay = min(delay * 2, REPLICATION_MAX_RETRY_DELAY)
+            else:
+                delay = REPLICATION_RETRY_DELAY
+                self.wakeup.wait()
+
+    def reject(self, job_path, job):
+        """Park a job Render refused, keeping it for inspection"""
+        print(f"[{datetime.datetime.now()}] Render rejected {job['image_id']}, parking its replication job")
+        self.count('rejected')
+        os.replace(job_path, os.path.join(self.rejected_folder, os.path.basename(job_path)))
+
+    def replicate(self, job):
+        """Send one upload to Render.
+
+        Returns True once it has been accepted, False if Render rejected it
+        and None if it should be retried later.
+        """
+        content_hash = job.get('sha256')
+        if content_hash in self.remote_hashes:
+            linked = self.link(job)
+            if linked:
+                return True
+            if linked is None:
+                return None
+            # Render no longer has the content; send the file again
+            self.remote_hashes.discard(content_hash)
+        
+        uploaded = self.upload(job)
+        if uploaded and content_hash:
+            self.remote_hashes.add(content_hash)
+        return uploaded
+
+    def link(self, job):
+        """Ask Render to reference content it already stores under a new image ID.
+
+        Returns True on success, False if Render does not have the content and
+        None if Render could not be reached or failed.
+        """
+        fields = dict(job['fields'],
+                      image_id=job['image_id'],
+                      sha256=job['sha256'],
+                      filename=os.path.basename(job['file_path']),
+                      original_filename=job['original_filename'])
         try:
-            with open(IMAGE_METADATA_FILE, 'r') as f:
-                return json.load(f)
+            response = self.session.post(self.endpoint, data=fields, timeout=REPLICATION_TIMEOUT)
+        except requests.RequestException as e:
+            print(f"[{datetime.datetime.now()}] Linking {job['image_id']} on Render failed: {e}")
+            with self.lock:
+                self.stats['failedAttempts'] += 1
+                self.last_error = str(e)
+            return None
+        if response.status_code == 200:
+            print(f"[{datetime.datetime.now()}] Render already has {job['sha256']}, linked {job['image_id']}")
+            self.count('linked')
+            return True
+        if response.status_code >= 500:
+            with self.lock:
+                self.stats['failedAttempts'] += 1
+                self.last_error = f"HTTP {response.status_code}: {response.text[:200]}"
+            return None
+        return False
+
+    def upload(self, job):
+        """Stream one upload file to Render.
+
+        Returns True once accepted, False if Render rejected it (4xx) and None
+        on network errors and server errors, which are worth retrying.
+        """
+        fields = dict(job['fields'], image_id=job['image_id'], original_filename=job['original_filename'])
+        if job.get('sha256'):
+            fields['sha256'] = job['sha256']  # Lets Render recognize a retry of an upload it already has
+        # The stored file's extension was validated on upload; guest file names may not survive secure_filename
+        extension = os.path.splitext(job['file_path'])[1]
+        filename = f"{job['image_id']}{extension}" if extension else job['original_filename']
+        body = MultipartFileStream(job['file_path'], filename, fields)
+        print(f"[{datetime.datetime.now()}] Replicating {job['file_path']} to {self.endpoint}")
+        try:
+            response = self.session.post(
+                self.endpoint,
+                data=body,
+                headers={'Content-Type': body.content_type},
+                timeout=REPLICATION_TIMEOUT
+            )
+            if response.status_code == 200:
+                self.count('replicated')
+                return True
+            error = f"HTTP {response.status_code}: {response.text[:200]}"
+            permanent = 400 <= response.status_code < 500
+        except (requests.RequestException, OSError) as e:
+            error = str(e)
+            permanent = False
+        
+        print(f"[{datetime.datetime.now()}] Replication of {job['image_id']} failed: {error}")
+        with self.lock:
+            self.stats['failedAttempts'] += 1
+            self.last_error = error
+        return False if permanent else None
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def status(self):
+        pending = len(self.pending_jobs())
+        with self.lock:
+            return dict(self.stats,
+                        pending=pending,
+                        endpoint=self.endpoint,
+                        lastError=self.last_error)
+
+# The Render instance itself is the replication target
+replication_outbox = None if IS_RENDER else ReplicationOutbox(REPLICATION_OUTBOX_FOLDER, REPLICATION_ENDPOINT)
+
+def get_expiry_time(image_data):
+    """Return the timestamp at which an image expires"""
+    return image_data.get('expires_at', image_data['upload_time'] + EXPIRATION_TIME)
+
+def format_lifetime(seconds):
+    """Describe how long an image is kept, e.g. "30 minutes" or "45 seconds" """
+    seconds = max(0, round(seconds))
+    if seconds < 60:
+        count, unit = seconds, 'second'
+    elif seconds < 60 * 60 or seconds % (60 * 60):
+        count, unit = math.ceil(seconds / 60), 'minute'
+    else:
+        count, unit = seconds // (60 * 60), 'hour'
+    return f"{count} {unit}" if count == 1 else f"{count} {unit}s"
+
+class MetadataStore:
+    """In-memory index of the image metadata, persisted to a JSON file.
+
+    The file is read once at startup and lookups are served from a dict.
+    Changes are written back by a background thread that coalesces bursts
+    of updates into a single atomic rewrite (temp file + rename).
+    """
+
+    def __init__(self, path, flush_delay=METADATA_FLUSH_DELAY):
+        self.path = path
+        self.flush_delay = flush_delay
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.images = {}
+        self.filename_refs = collections.Counter()
+        self.mtime = None
+        self.dirty = False
+        self.flush_requested = threading.Event()
+        self.load()
+        
+        self.writer_thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer_thread.start()
+        atexit.register(self.flush)
+
+    def load(self):
+        """(Re)load the metadata from disk, replacing the in-memory index"""
+        try:
+            mtime = os.stat(self.path).st_mtime
+            with open(self.path, 'r') as f:
+                images = json.load(f)
+        except FileNotFoundError:
+            return
         except Exception as e:
-            print(f"Error loading metadata: {e}")
-    return {}
+            print(f"[{datetime.datetime.now()}] Error loading metadata: {e}")
+            return
+        self.images = images
+        self.filename_refs = collections.Counter(image_data['filename'] for image_data in images.values())
+        self.mtime = mtime
 
-def save_metadata(metadata):
-    """Save the image metadata to the JSON file"""
-    try:
-        with open(IMAGE_METADATA_FILE, 'w') as f:
-            json.dump(metadata, f, indent=2)
-    except Exception as e:
-        print(f"Error saving metadata: {e}")
+    def refresh_if_changed(self):
+        """Pick up changes written by another process (e.g. a second gunicorn worker)"""
+        if self.dirty:
+            return
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return
+        if mtime != self.mtime:
+            self.load()
+
+    def get(self, image_id):
+        with self.lock:
+            self.refresh_if_changed()
+            return self.images.get(image_id)
+
+    def items(self):
+        """Return a snapshot of (image_id, image_data) pairs"""
+        with self.lock:
+            self.refresh_if_changed()
+            return list(self.images.items())
+
+    def expired_items(self, now):
+        """Return (image_id, image_data) pairs whose expiry time has passed"""
+        return [(image_id, image_data) for image_id, image_data in self.items()
+                if get_expiry_time(image_data) <= now]
+
+    def set(self, image_id, image_data):
+        with self.lock:
+            self.refresh_if_changed()
+            previous = self.images.get(image_id)
+            if previous:
+                self.filename_refs[previous['filename']] -= 1
+            self.images[image_id] = image_data
+            self.filename_refs[image_data['filename']] += 1
+            self.mark_dirty()
+
+    def delete(self, image_ids):
+        with self.lock:
+            self.refresh_if_changed()
+            for image_id in image_ids:
+                image_data = self.images.pop(image_id, None)
+                if image_data:
+                    self.filename_refs[image_data['filename']] -= 1
+            self.mark_dirty()
+
+    def count_references(self, filename):
+        """Return how many images share a stored upload file"""
+        with self.lock:
+            self.refresh_if_changed()
+            return self.filename_refs[filename]
 
-def generate_qr_code(url, image_id):
-    """Generate a QR code for a given URL and save it"""
+    def find_by_filename(self, filename):
+        """Return the newest (image_id, image_data) stored as filename, or None"""
+        matches = [(image_id, image_data) for image_id, image_data in self.items()
+                   if image_data['filename'] == filename]
+        return max(matches, key=lambda item: item[1]['upload_time'], default=None)
+
+    def mark_dirty(self):
+        self.dirty = True
+        self.flush_requested.set()
+
+    def write_loop(self):
+        """Write pending changes to disk, batching updates that arrive close together"""
+        while True:
+            self.flush_requested.wait()
+            time.sleep(self.flush_delay)
+            self.flush()
+
+    def flush(self):
+        """Atomically write the index to disk if it has unsaved changes"""
+        with self.write_lock:
+            with self.lock:
+                self.flush_requested.clear()
+                if not self.dirty:
+                    return
+                payload = json.dumps(self.images, separators=(',', ':'))
+                self.dirty = False
+            
+            temp_path = f"{self.path}.tmp"
+            try:
+                with open(temp_path, 'w') as f:
+                    f.write(payload)
+                os.replace(temp_path, self.path)
+                with self.lock:
+                    if not self.dirty:
+                        self.mtime = os.stat(self.path).st_mtime
+            except Exception as e:
+                print(f"[{datetime.datetime.now()}] Error saving metadata: {e}")
+                with self.lock:
+                    self.dirty = True
+
+class SQLiteMetadataStore:
+    """Image metadata kept in a SQLite database in WAL mode.
+
+    Unlike the JSON file, several processes (e.g. gunicorn workers) can read
+    concurrently and each upload is a single-row insert instead of a
+    read-modify-write of the whole index.
+    """
+
+    def __init__(self, path, json_path=IMAGE_METADATA_FILE):
+        self.path = path
+        self.local = threading.local()
+        conn = self.connection()
+        with conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS images (
+                    image_id TEXT PRIMARY KEY,
+                    filename TEXT NOT NULL,
+                    upload_time REAL NOT NULL,
+                    expires_at REAL NOT NULL,
+                    data TEXT NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS images_upload_time ON images (upload_time)")
+            conn.execute("CREATE INDEX IF NOT EXISTS images_filename ON images (filename)")
+            conn.execute("CREATE INDEX IF NOT EXISTS images_expires_at ON images (expires_at)")
+        self.import_json(json_path)
+
+    def connection(self):
+        """Return this thread's connection, opening it on first use"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def import_json(self, json_path):
+        """Carry over entries from an existing JSON metadata file into an empty database"""
+        conn = self.connection()
+        if not os.path.exists(json_path) or conn.execute("SELECT 1 FROM images LIMIT 1").fetchone():
+            return
+        try:
+            with open(json_path, 'r') as f:
+                images = json.load(f)
+        except Exception as e:
+            print(f"[{datetime.datetime.now()}] Error importing metadata from {json_path}: {e}")
+            return
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO images VALUES (?, ?, ?, ?, ?)",
+                [self.row(image_id, image_data) for image_id, image_data in images.items()]
+            )
+        print(f"[{datetime.datetime.now()}] Imported {len(images)} metadata entries from {json_path}")
+
+    def row(self, image_id, image_data):
+        return (image_id, image_data['filename'], image_data['upload_time'],
+                get_expiry_time(image_data), json.dumps(image_data))
+
+    def get(self, image_id):
+        row = self.connection().execute(
+            "SELECT data FROM images WHERE image_id = ?", (image_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def items(self):
+        """Return (image_id, image_data) pairs, oldest upload first"""
+        rows = self.connection().execute(
+            "SELECT image_id, data FROM images ORDER BY upload_time"
+        ).fetchall()
+        return [(image_id, json.loads(data)) for image_id, data in rows]
+
+    def expired_items(self, now):
+        """Return (image_id, image_data) pairs whose expiry time has passed"""
+        rows = self.connection().execute(
+            "SELECT image_id, data FROM images WHERE expires_at <= ? ORDER BY expires_at", (now,)
+        ).fetchall()
+        return [(image_id, json.loads(data)) for image_id, data in rows]
+
+    def count_references(self, filename):
+        """Return how many images share a stored upload file"""
+        return self.connection().execute(
+            "SELECT COUNT(*) FROM images WHERE filename = ?", (filename,)
+        ).fetchone()[0]
+
+    def find_by_filename(self, filename):
+        """Return the newest (image_id, image_data) stored as filename, or None"""
+        row = self.connection().execute(
+            "SELECT image_id, data FROM images WHERE filename = ? ORDER BY upload_time DESC LIMIT 1", (filename,)
+        ).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+
+    def set(self, image_id, image_data):
+        conn = self.connection()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?)", self.row(image_id, image_data))
+
+    def delete(self, image_ids):
+        conn = self.connection()
+        with conn:
+            conn.executemany("DELETE FROM images WHERE image_id = ?", [(image_id,) for image_id in image_ids])
+
+    def flush(self):
+        """Writes are committed immediately; nothing to flush"""
+
+def create_metadata_store():
+    """Create the metadata store selected by METADATA_BACKEND"""
+    if METADATA_BACKEND == 'sqlite':
+        print(f"[{datetime.datetime.now()}] Using SQLite metadata store: {METADATA_DB_FILE}")
+        return SQLiteMetadataStore(METADATA_DB_FILE)
+    return MetadataStore(IMAGE_METADATA_FILE)
+
+metadata_store = create_metadata_store()
+# Guards stored upload files against being deleted while a new upload reuses them
+content_lock = threading.Lock()
+
+class QRRenderCache:
+    """LRU cache of rendered QR codes, keyed by payload and render parameters.
+
+    Entries are evicted once their total size exceeds max_bytes. When a disk
+    folder is configured, renders are also kept there (bounded the same way)
+    so they survive restarts.
+    """
+
+    def __init__(self, max_bytes, disk_folder=None, disk_max_bytes=0):
+        self.max_bytes = max_bytes
+        self.disk_folder = disk_folder
+        self.disk_max_bytes = disk_max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'diskHits': 0, 'misses': 0, 'evictions': 0}
+        if disk_folder and not os.path.exists(disk_folder):
+            os.makedirs(disk_folder)
+
+    def disk_path(self, key):
+        digest = hashlib.sha256(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.disk_folder, f"{digest}.{key[-1]}")
+
+    def get(self, key):
+        """Return the cached bytes for key, or None"""
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return data
+        
+        if self.disk_folder:
+            path = self.disk_path(key)
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                os.utime(path)  # Keeps recently used renders from being evicted
+            except OSError:
+                data = None
+            if data is not None:
+                self.count('diskHits')
+                self.put_memory(key, data)
+                return data
+        
+        self.count('misses')
+        return None
+
+    def put(self, key, data):
+        self.put_memory(key, data)
+        if self.disk_folder:
+            path = self.disk_path(key)
+            temp_path = f"{path}.tmp"
+            try:
+                with open(temp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(temp_path, path)
+                self.evict_disk()
+            except OSError as e:
+                print(f"[{datetime.datetime.now()}] Error writing QR cache file: {e}")
+
+    def put_memory(self, key, data):
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            self.entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.stats['evictions'] += 1
+
+    def evict_disk(self):
+        """Remove the least recently used files once the disk tier is over budget"""
+        with os.scandir(self.disk_folder) as entries:
+            files = [(entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                     for entry in entries if entry.is_file() and not entry.name.endswith('.tmp')]
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.disk_max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def status(self):
+        with self.lock:
+            lookups = self.stats['hits'] + self.stats['diskHits'] + self.stats['misses']
+            return dict(self.stats,
+                        entries=len(self.entries),
+                        bytes=self.size,
+                        maxBytes=self.max_bytes,
+                        hitRate=round((lookups - self.stats['misses']) / lookups, 3) if lookups else None,
+                        diskFolder=self.disk_folder)
+
+qr_cache = QRRenderCache(QR_CACHE_MAX_BYTES, QR_CACHE_FOLDER, QR_CACHE_DISK_MAX_BYTES)
+
+def get_qr_matrix(url, error_correction=QR_ERROR_CORRECTION):
+    """Return url's QR module matrix (True = dark, no border), encoding it only on a cache miss"""
+    key = (url, error_correction, 'matrix')
+    data = qr_cache.get(key)
+    if data is None:
+        data = image_workers.run_with_fallback(encode_qr_matrix, url, error_correction)
+        qr_cache.put(key, data)
+    size = math.isqrt(len(data))
+    return np.frombuffer(data, dtype=bool).reshape(size, size)
+
+QR_RENDERERS = {
+    'png': render_qr_png,
+    'svg': render_qr_svg,
+    'bmp': render_qr_bmp,
+    'bits': render_qr_bits,
+}
+# Formats served by /qrcodes/<id>.<format>
+QR_MIMETYPES = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+    'bmp': 'image/bmp',
+    'bits': 'application/octet-stream',
+}
+
+def render_qr_code(url, image_format, box_size=QR_BOX_SIZE, error_correction=QR_ERROR_CORRECTION, border=QR_BORDER):
+    """Return url's QR code in image_format, rendering it only on a cache miss"""
+    key = (url, error_correction, box_size, border, image_format)
+    data = qr_cache.get(key)
+    if data is None:
+        modules = np.pad(get_qr_matrix(url, error_correction), border)
+        data = image_workers.run_with_fallback(QR_RENDERERS[image_format], modules, box_size)
+        qr_cache.put(key, data)
+    return data
+
+def render_eink_frame(image_id, url, expires_at=None):
+    """Return image_id's e-ink frame as (native buffer, BMP), composing it only on a cache miss.
+
+    The BMP is None unless EINK_BMP_FALLBACK is on. The frame is composed
+    on the image workers, which keep the static layers rasterized.
+    """
+    key = ('frame', image_id, url, expires_at)
+    epd_data = qr_cache.get(key + ('epd',))
+    bmp_data = qr_cache.get(key + ('bmp',)) if EINK_BMP_FALLBACK else None
+    if epd_data is not None and (bmp_data is not None or not EINK_BMP_FALLBACK):
+        return epd_data, bmp_data
+    
+    modules = np.pad(get_qr_matrix(url), QR_BORDER)
+    epd_data, bmp_data = image_workers.run_with_fallback(render_eink_files, modules, QR_BOX_SIZE,
+                                                         expires_at, EINK_BMP_FALLBACK)
+    
+    qr_cache.put(key + ('epd',), epd_data)
+    if bmp_data is not None:
+        qr_cache.put(key + ('bmp',), bmp_data)
+    return epd_data, bmp_data
+
+def write_file(path, data):
+    """Write a file in one step, so the display never reads half a frame"""
+    temp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+def get_eink_paths(image_id):
+    """Return an image's display files: the native frame and the BMP fallback"""
+    return [
+        os.path.join(BMP_FOLDER, f"{image_id}_qr.epd"),
+        os.path.join(BMP_FOLDER, f"{image_id}_qr.bmp")
+    ]
+
+# URLs encoded for IDs whose QR code does not point at their view page
+qr_payloads = {}
+
+def get_qr_payload(image_id):
+    """Return the URL an image's QR code encodes, or None for unknown IDs"""
+    if image_id in qr_payloads:
+        return qr_payloads[image_id]
+    if metadata_store.get(image_id) is not None or image_id in qr_pool:
+        return get_view_url(image_id)
+    return None
+
+def generate_qr_code(url, image_id, expires_at=None):
+    """Generate a QR code for a given URL and write the e-ink files for the display.
+
+    The PNG is only rendered into the QR cache; /qrcodes serves it from there.
+    expires_at is shown on the display when given.
+    """
     try:
         print(f"[{datetime.datetime.now()}] Generating QR code for URL: {url}")
         
         # Make sure the URL is properly formatted
-        if not url.startswith('http://') and not url.startswith('https://'):
+        if not url.lower().startswith(('http://', 'https://')):
             url = 'http://' + url
         
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,  # Higher error correction
-            box_size=10,
-            border=4,
-        )
-        qr.add_data(url)
-        qr.make(fit=True)
+        if url != get_view_url(image_id):
+            qr_payloads[image_id] = url
+        epd_file_path, bmp_file_path = get_eink_paths(image_id)
+        epd_data, bmp_data = render_eink_frame(image_id, url, expires_at)
+        write_file(epd_file_path, epd_data)
+        if bmp_data is not None:
+            write_file(bmp_file_path, bmp_data)
+        render_qr_code(url, 'png')  # Ready for the browser's first request
 
-        img = qr.make_image(fill_color="black", back_color="white")
-        qr_file_path = os.path.join(app.config['QR_FOLDER'], f"{image_id}_qr.png")
-        img.save(qr_file_path)
+        print(f"[{datetime.datetime.now()}] QR code saved to: {epd_file_path}")
+        return f"/qrcodes/{image_id}.png"
+    except Exception as e:
+        print(f"[{datetime.datetime.now()}] Error generating QR code: {e}")
+        return None
+
+class QRCodePool:
+    """Image IDs whose QR code and e-ink files are rendered ahead of time.
+
+    A view URL only depends on the image ID, so a background worker keeps a
+    few IDs with their QR files ready and an upload just claims one. The pool
+    is refilled shortly after a claim, between guests. A claimed frame is
+    shown as it is; the worker then redraws it with the upload's expiry time
+    and swaps it in.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.ready = collections.deque()
+        self.annotations = collections.deque()
+        self.lock = threading.Lock()
+        self.refill_needed = threading.Event()
+        self.annotation_needed = threading.Event()
+        self.stats = {'claimed': 0, 'empty': 0}
         
-        bmp = qr.make_image(fill="black", back_color="white").convert("1")
-        bmp_width, bmp_height = bmp.size
-        target_width, target_height = 800, 480
+        self.refill_needed.set()
+        self.worker_thread = threading.Thread(target=self.run, daemon=True)
+        self.worker_thread.start()
 
-        padded_bmp = Image.new("1", (target_width, target_height), 1)
-        x_offset = (target_width - bmp_width) // 2
-        y_offset = (target_height - bmp_height) // 2
-        padded_bmp.paste(bmp, (x_offset, y_offset))
-        bmp_file_path = os.path.join(app.config['BMP_FOLDER'], f"{image_id}_qr.bmp")
-        padded_bmp.save(bmp_file_path, format="BMP")
+    def __contains__(self, image_id):
+        with self.lock:
+            return image_id in self.ready
 
+    def claim(self):
+        """Take a pre-rendered image ID, or None if the pool is empty"""
+        with self.lock:
+            image_id = self.ready.popleft() if self.ready else None
+            self.stats['claimed' if image_id else 'empty'] += 1
+        self.refill_needed.set()
+        if image_id:
+            # Restart the orphan sweeper's grace period until the upload is recorded
+            for path in get_eink_paths(image_id):
+                try:
+                    os.utime(path)
+                except OSError:
+                    pass
+        return image_id
 
-        print(f"[{datetime.datetime.now()}] QR code saved to: {qr_file_path}")
-        return f"/qrcodes/{image_id}_qr.png"
-    except Exception as e:
-        print(f"[{datetime.datetime.now()}] Error generating QR code: {e}")
-        return None
+    def annotate(self, image_id, expires_at):
+        """Queue a claimed ID's frame to be redrawn with its expiry time"""
+        with self.lock:
+            self.annotations.append((image_id, expires_at))
+        self.annotation_needed.set()
 
-def cleanup_old_files():
-    """Remove files older than EXPIRATION_TIME"""
-    while True:
-        print(f"[{datetime.datetime.now()}] Running cleanup check...")
-        now = time.time()
-        metadata = load_metadata()
-        deleted_ids = []
+    def annotate_claimed(self):
+        """Redraw the queued frames and show them if they are still the newest"""
+        self.annotation_needed.clear()
+        while True:
+            with self.lock:
+                if not self.annotations:
+                    return
+                image_id, expires_at = self.annotations.popleft()
+            if metadata_store.get(image_id) is None:
+                continue  # Deleted before its frame was redrawn
+            if generate_qr_code(get_view_url(image_id), image_id, expires_at) and display_state['frame'] == f"{image_id}_qr":
+                show_on_display(f"{image_id}_qr")
+
+    def run(self):
+        while True:
+            self.refill_needed.wait()
+            self.refill_needed.clear()
+            # Let the upload that claimed an ID finish before rendering more,
+            # redrawing claimed frames with their expiry time meanwhile
+            deadline = time.monotonic() + QR_POOL_REFILL_DELAY
+            while time.monotonic() < deadline:
+                self.annotation_needed.wait(max(0, deadline - time.monotonic()))
+                self.annotate_claimed()
+            while len(self.ready) < self.size:
+                self.annotate_claimed()
+                image_id = generate_image_id()
+                if not generate_qr_code(get_view_url(image_id), image_id):
+                    break
+                with self.lock:
+                    self.ready.append(image_id)
+
+    def status(self):
+        with self.lock:
+            return dict(self.stats, ready=len(self.ready), size=self.size)
+
+class ImageWorkers:
+    """Runs CPU-heavy image work in a bounded pool of worker processes.
+
+    Pillow and numpy hold the GIL for much of their work, so in a request
+    thread a burst of uploads stalls every other guest's request. Worker
+    processes run it on the Pi's other cores instead.
+
+    Forking this multi-threaded process could copy locks held by other
+    threads, so workers come from a fork server (or are spawned) and only
+    import image_tasks.py. Tasks must be functions from that module, which
+    can also run in this process when the workers cannot take them.
+    """
+
+    def __init__(self, workers=IMAGE_WORKERS, queue_size=IMAGE_WORKER_QUEUE_SIZE):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.lock = threading.Lock()
+        self.executor = self.create_executor()
+        self.pending = 0
+        self.peak_pending = 0
+        self.stats = {'submitted': 0, 'completed': 0, 'failed': 0, 'timedOut': 0, 'rejected': 0, 'restarts': 0,
+                      'fallbacks': 0}
+        atexit.register(self.shutdown)
+
+    def create_executor(self):
+        return concurrent.futures.ProcessPoolExecutor(max_workers=self.workers,
+                                                      mp_context=multiprocessing.get_context(IMAGE_WORKER_START_METHOD))
+
+    def submit(self, function, *args, wait=0):
+        """Queue function(*args) and return its Future.
+
+        Waits up to wait seconds for a free slot when queue_size tasks are
+        already queued or running, and returns None if none frees up.
+        """
+        acquired = self.slots.acquire(timeout=wait) if wait > 0 else self.slots.acquire(blocking=False)
+        if not acquired:
+            with self.lock:
+                self.stats['rejected'] += 1
+            return None
+        try:
+            try:
+                future = self.executor.submit(function, *args)
+            except concurrent.futures.process.BrokenProcessPool:
+                # A worker died (e.g. killed for memory), which breaks the whole pool
+                print(f"[{datetime.datetime.now()}] Image worker pool broken, starting a new one")
+                with self.lock:
+                    self.stats['restarts'] += 1
+                self.executor = self.create_executor()
+                future = self.executor.submit(function, *args)
+        except Exception:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.stats['submitted'] += 1
+            self.pending += 1
+            self.peak_pending = max(self.peak_pending, self.pending)
+        future.add_done_callback(self.finish)
+        return future
+
+    def finish(self, future):
+        with self.lock:
+            self.pending -= 1
+            self.stats['failed' if future.cancelled() or future.exception() else 'completed'] += 1
+        self.slots.release()
+
+    def run(self, function, *args, timeout=IMAGE_TASK_TIMEOUT):
+        """Run function(*args) in a worker and return its result.
+
+        Raises concurrent.futures.TimeoutError if the task cannot be queued
+        or does not finish within timeout. A running task cannot be stopped;
+        it finishes in the background and its slot is freed then.
+        """
+        deadline = time.monotonic() + timeout
+        future = self.submit(function, *args, wait=timeout)
+        if future is None:
+            raise concurrent.futures.TimeoutError('Image workers are busy')
+        try:
+            return future.result(timeout=max(0, deadline - time.monotonic()))
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            with self.lock:
+                self.stats['timedOut'] += 1
+            raise
+
+    def run_with_fallback(self, function, *args, timeout=IMAGE_TASK_TIMEOUT):
+        """Run function(*args) in a worker, or in this thread if the workers cannot run it"""
+        try:
+            return self.run(function, *args, timeout=timeout)
+        except Exception as e:
+            # Busy, timed out or broken workers; the task itself raises again here if it is at fault
+            print(f"[{datetime.datetime.now()}] Running {function.__name__} in the app instead of a worker: {e!r}")
+            with self.lock:
+                self.stats['fallbacks'] += 1
+            return function(*args)
+
+    def shutdown(self):
+        """Cancel queued tasks and wait for the running ones to finish"""
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def status(self):
+        with self.lock:
+            return dict(self.stats,
+                        workers=self.workers,
+                        queueDepth=self.pending,
+                        peakQueueDepth=self.peak_pending,
+                        queueSize=self.queue_size)
+
+image_workers = ImageWorkers()
+qr_pool = QRCodePool(QR_POOL_SIZE)
+
+def has_renditions(image_data):
+    """Whether renditions are built for an upload"""
+    return image_data['filename'].rsplit('.', 1)[-1].lower() in RENDITION_SOURCE_EXTENSIONS
+
+def get_rendition_paths(image_id):
+    """Return the files of every rendition of an image"""
+    return [os.path.join(RENDITION_FOLDER, f"{image_id}_{width}.{image_format}")
+            for width in RENDITION_WIDTHS for image_format in RENDITION_FORMATS]
+
+class RenditionWorkers:
+    """Builds the renditions of uploads on the image workers.
+
+    Uploads are queued as soon as they are stored, so pages usually find
+    their renditions ready. A request for one that is still being built
+    waits for that build instead of starting another.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.building = {}  # image ID -> Future
+        self.stats = {'built': 0, 'failed': 0, 'sourceBytes': 0, 'renditionBytes': 0}
+
+    def submit(self, image_id, wait=0):
+        """Queue an image's renditions unless they are being built; returns the Future or None.
+
+        Waits up to wait seconds for the image workers to accept the build.
+        """
+        image_data = metadata_store.get(image_id)
+        if image_data is None or not has_renditions(image_data):
+            return None
+        with self.lock:
+            future = self.building.get(image_id)
+        if future is not None:
+            return future
         
+        started = time.monotonic()
+        upload_path = os.path.join(UPLOAD_FOLDER, image_data['filename'])
+        future = image_workers.submit(build_renditions, image_id, upload_path, RENDITION_FOLDER,
+                                      RENDITION_WIDTHS, RENDITION_FORMATS, wait=wait)
+        if future is None:
+            return None
+        with self.lock:
+            self.building.setdefault(image_id, future)
+        future.add_done_callback(lambda future: self.finish(image_id, image_data, started, future))
+        return future
+
+    def finish(self, image_id, image_data, started, future):
         try:
-            for image_id, image_data in list(metadata.items()):
-                file_path = os.path.join(UPLOAD_FOLDER, image_data['filename'])
-                qr_path = os.path.join(QR_FOLDER, f"{image_id}_qr.png")
-                
-                if os.path.isfile(file_path):
-                    # Check if file has expired
-                    if now - image_data['upload_time'] > EXPIRATION_TIME:
-                        # Delete both the image and its QR code
-                        os.remove(file_path)
-                        if os.path.exists(qr_path):
-                            os.remove(qr_path)
-                        deleted_ids.append(image_id)
-                        print(f"[{datetime.datetime.now()}] Deleted old file: {image_data['filename']}")
-                else:
-                    # File doesn't exist, remove from metadata
-                    if os.path.exists(qr_path):
-                        os.remove(qr_path)
-                    deleted_ids.append(image_id)
-            
-            # Remove deleted files from metadata
-            for image_id in deleted_ids:
-                metadata.pop(image_id, None)
-            
-            save_metadata(metadata)
+            written = future.result()
+            error = None
         except Exception as e:
-            print(f"[{datetime.datetime.now()}] Error during cleanup: {e}")
+            error = e
+        with self.lock:
+            if self.building.get(image_id) is future:
+                del self.building[image_id]
+            if error is None:
+                self.stats['built'] += 1
+                self.stats['sourceBytes'] += image_data['size']
+                self.stats['renditionBytes'] += written
+            else:
+                self.stats['failed'] += 1
+        if error is None:
+            print(f"[{datetime.datetime.now()}] Built renditions of {image_id} in {time.monotonic() - started:.2f}s")
+        else:
+            print(f"[{datetime.datetime.now()}] Error building renditions of {image_id}: {error}")
+
+    def get(self, image_id, width, image_format):
+        """Return the path of a rendition, building it first if needed, or None if it cannot be built"""
+        path = os.path.join(RENDITION_FOLDER, f"{image_id}_{width}.{image_format}")
+        if os.path.exists(path):
+            return path
+        future = self.submit(image_id, wait=RENDITION_WAIT)
+        if future is None:
+            return None
+        concurrent.futures.wait([future], timeout=RENDITION_WAIT)
+        return path if os.path.exists(path) else None
+
+    def status(self):
+        with self.lock:
+            return dict(self.stats, building=len(self.building))
+
+rendition_workers = RenditionWorkers()
+
+def get_image_sources(image_id, image_data, widths=RENDITION_WIDTHS, base_url=''):
+    """Return how a page shows an image, as (src, [(mimetype, srcset)]).
+
+    Images with renditions get a srcset per format and a mid-sized JPEG as
+    src; others are shown from the original upload.
+    """
+    if not has_renditions(image_data):
+        return f"{base_url}/uploads/{image_data['filename']}", []
+    sources = [(RENDITION_MIMETYPES[image_format],
+                ', '.join(f"{base_url}/renditions/{image_id}_{width}.{image_format} {width}w" for width in widths))
+               for image_format in RENDITION_FORMATS]
+    return f"{base_url}/renditions/{image_id}_{widths[len(widths) // 2]}.jpeg", sources
+
+class ExpiryScheduler:
+    """Deletes images when they expire.
+
+    Expiry deadlines are kept in a min-heap fed by uploads, and the worker
+    sleeps until the earliest one instead of rescanning every image on a
+    fixed interval.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.condition = threading.Condition()
+
+    def schedule(self, image_id, expires_at):
+        """Queue an image for deletion at expires_at"""
+        with self.condition:
+            heapq.heappush(self.heap, (expires_at, image_id))
+            # Wake the worker if this is now the earliest deadline
+            if self.heap[0][1] == image_id:
+                self.condition.notify()
+
+    def run(self):
+        """Worker loop: sleep until the next deadline, then delete what is due"""
+        for image_id, image_data in metadata_store.items():
+            self.schedule(image_id, get_expiry_time(image_data))
+        
+        while True:
+            due = []
+            reconcile = False
+            with self.condition:
+                now = time.time()
+                if self.heap and self.heap[0][0] <= now:
+                    while self.heap and self.heap[0][0] <= now:
+                        due.append(heapq.heappop(self.heap)[1])
+                else:
+                    timeout = CLEANUP_INTERVAL
+                    if self.heap:
+                        timeout = min(timeout, self.heap[0][0] - now)
+                    if self.condition.wait(timeout):
+                        continue  # An earlier deadline was scheduled
+                    # Nothing due after a full interval: check the store for images
+                    # scheduled by another process (e.g. a second gunicorn worker)
+                    reconcile = not self.heap or self.heap[0][0] > time.time()
             
-        # Wait for the next cleanup interval
-        time.sleep(CLEANUP_INTERVAL)
+            try:
+                if reconcile:
+                    due = [image_id for image_id, _ in metadata_store.expired_items(time.time())]
+                if due:
+                    expire_images(due)
+            except Exception as e:
+                print(f"[{datetime.datetime.now()}] Error during cleanup: {e}")
+
+def get_artifact_paths(image_id, image_data):
+    """Return every file written for an image"""
+    return [
+        os.path.join(UPLOAD_FOLDER, image_data['filename']),
+        os.path.join(QR_FOLDER, f"{image_id}_qr.png"),
+        os.path.join(VIEW_PAGE_FOLDER, f"{image_id}.html")
+    ] + get_eink_paths(image_id) + get_rendition_paths(image_id)
 
-# Start the cleanup thread
-cleanup_thread = threading.Thread(target=cleanup_old_files, daemon=True)
+def expire_images(image_ids):
+    """Delete the files of expired images and drop them from the metadata"""
+    now = time.time()
+    expired = []
+    for image_id in image_ids:
+        image_data = metadata_store.get(image_id)
+        # Skip images that are already gone or were given a later expiry
+        if image_data is None or get_expiry_time(image_data) > now:
+            continue
+        expired.append((image_id, image_data))
+    if not expired:
+        return
+    
+    with content_lock:
+        metadata_store.delete([image_id for image_id, _ in expired])
+        forget_view_pages([image_id for image_id, _ in expired])
+        for image_id, image_data in expired:
+            upload_path = os.path.join(UPLOAD_FOLDER, image_data['filename'])
+            for path in get_artifact_paths(image_id, image_data):
+                # Uploads are shared by every image with the same content
+                if path == upload_path and metadata_store.count_references(image_data['filename']):
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            print(f"[{datetime.datetime.now()}] Deleted expired image: {image_id} ({image_data['filename']})")
+
+# Start the expiry scheduler
+expiry_scheduler = ExpiryScheduler()
+cleanup_thread = threading.Thread(target=expiry_scheduler.run, daemon=True)
 cleanup_thread.start()
 
+def get_artifact_image_id(filename):
+    """Map an artifact file name back to the image ID it belongs to"""
+    # Uploads are "<id>.<ext>", QR codes "<id>.<format>" or "<id>_qr.<ext>",
+    # renditions "<id>_<width>.<format>"
+    return filename.split('.', 1)[0].split('_', 1)[0]
+
+def sweep_orphans():
+    """Reconcile the artifact folders against the metadata in one pass.
+
+    Deletes files that belong to no known image and drops metadata entries
+    whose upload has disappeared. Files younger than SWEEP_GRACE_PERIOD are
+    left alone so uploads that are still being written are not removed.
+    """
+    started = time.time()
+    images = dict(metadata_store.items())
+    upload_filenames = {image_data['filename'] for image_data in images.values()}
+    seen_uploads = set()
+    removed_files = 0
+    reclaimed_bytes = 0
+    
+    for folder in ARTIFACT_FOLDERS:
+        try:
+            entries = os.scandir(folder)
+        except FileNotFoundError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.name.startswith('.') or not entry.is_file(follow_symlinks=False):
+                    continue
+                if folder == UPLOAD_FOLDER:
+                    if entry.name in upload_filenames:
+                        seen_uploads.add(entry.name)
+                        continue
+                else:
+                    image_id = get_artifact_image_id(entry.name)
+                    if image_id in images or image_id in PERSISTENT_ARTIFACT_IDS or image_id in qr_pool:
+                        continue
+                
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                    if started - stat.st_mtime < SWEEP_GRACE_PERIOD:
+                        continue
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    continue
+                removed_files += 1
+                reclaimed_bytes += stat.st_size
+    
+    # Metadata entries whose upload file is gone can no longer be served
+    missing_ids = [image_id for image_id, image_data in images.items()
+                   if image_data['filename'] not in seen_uploads
+                   and started - image_data['upload_time'] > SWEEP_GRACE_PERIOD]
+    if missing_ids:
+        metadata_store.delete(missing_ids)
+        forget_view_pages(missing_ids)
+    
+    report = {
+        'removedFiles': removed_files,
+        'reclaimedBytes': reclaimed_bytes,
+        'removedEntries': len(missing_ids),
+        'duration': round(time.time() - started, 3)
+    }
+    print(f"[{datetime.datetime.now()}] Orphan sweep: removed {removed_files} files "
+          f"({reclaimed_bytes} bytes) and {len(missing_ids)} stale metadata entries")
+    return report
+
+def run_orphan_sweeper():
+    """Sweep once at startup and then every SWEEP_INTERVAL"""
+    while True:
+        try:
+            sweep_orphans()
+        except Exception as e:
+            print(f"[{datetime.datetime.now()}] Error during orphan sweep: {e}")
+        time.sleep(SWEEP_INTERVAL)
+
+sweeper_thread = threading.Thread(target=run_orphan_sweeper, daemon=True)
+sweeper_thread.start()
+
+def request_display_service(message):
+    """Send one request to the display service and return its reply"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(DISPLAY_SOCKET_TIMEOUT)
+        sock.connect(DISPLAY_SOCKET)
+        sock.sendall(json.dumps(message).encode('utf-8') + b'\n')
+        with sock.makefile('rb') as reply:
+            return json.loads(reply.readline())
+
+# Display scheduler run inside the app when the display service is not running
+local_display = {'service': None}
+local_display_lock = threading.Lock()
+
+def get_local_display_service():
+    with local_display_lock:
+        if local_display['service'] is None:
+            try:
+                panel = create_panel(command=DISPLAY_COMMAND)
+            except Exception as e:
+                # e.g. the driver cannot open SPI/GPIO without root
+                print(f"[{datetime.datetime.now()}] Could not open the display panel ({e!r}), using the epd binary")
+                panel = CommandPanel(DISPLAY_COMMAND)
+            local_display['service'] = DisplayService(panel)
+        return local_display['service']
+
+# The newest frame sent to the display
+display_state = {'frame': None}
+
+def show_on_display(frame=None):
+    """Queue a frame ("<image id>_qr") for the e-ink display without waiting for it.
+
+    Returns the job's ID and status from the display service. Without the
+    service, the frame is queued on a scheduler inside the app instead, using
+    the same DISPLAY_BACKEND. frame=None redraws the current frame. Display
+    errors are logged and reported as a failed job, never raised. Render has
+    no display, so there it returns None.
+    """
+    if IS_RENDER:
+        return None
+    job_id = uuid.uuid4().hex
+    if frame:
+        display_state['frame'] = frame
+    try:
+        return request_display_service({'op': 'show', 'job': job_id, 'frame': frame})
+    except (OSError, ValueError) as e:
+        if local_display['service'] is None:
+            print(f"[{datetime.datetime.now()}] Display service unavailable ({e}), showing frames from the app")
+    try:
+        return {'job': job_id, 'status': get_local_display_service().submit(job_id, frame)}
+    except Exception as e:
+        print(f"[{datetime.datetime.now()}] Could not queue {frame} for the display: {e!r}")
+        return {'job': job_id, 'status': 'failed'}
+
+def apply_cache_policy(response, route):
+    """Set a response's Cache-Control from CACHE_POLICIES[route]"""
+    max_age, immutable = CACHE_POLICIES[route]
+    if max_age > 0:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+        response.cache_control.immutable = immutable
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+def get_file_version(path):
+    """Short content hash of a file, for cache-busting URLs"""
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:12]
+
+# The /view template is compiled once; pages are cached per image ID as
+# (expiry time, minutes remaining, HTML, ETag) and rebuilt when the minutes change
+view_template = app.jinja_env.get_template('view.html')
+view_css_version = get_file_version(VIEW_CSS_FILE)
+view_pages = {}
+
+def render_view_page(image_id, image_data, minutes_remaining):
+    """Render an image's view page from the compiled template"""
+    # Absolute URLs with the Render domain for the image and download
+    render_url = "https://qrcodegeneration2.onrender.com"
+    image_url, image_sources = get_image_sources(image_id, image_data, base_url=render_url)
+    return view_template.render(image=image_data,
+                                image_url=image_url,
+                                image_sources=image_sources,
+                                download_url=f"{render_url}/download/{image_id}",
+                                minutes_remaining=minutes_remaining,
+                                expires_at=int(get_expiry_time(image_data)),
+                                lifetime=format_lifetime(get_expiry_time(image_data) - image_data['upload_time']),
+                                css_version=view_css_version)
+
+def get_view_page(image_id):
+    """Return (HTML, ETag) of an image's view page, or None if the image is unknown"""
+    now = time.time()
+    page = view_pages.get(image_id)
+    if page is not None:
+        expires_at, minutes_remaining, html, etag = page
+        if now < expires_at and minutes_remaining == int((expires_at - now) / 60) + 1:
+            return html, etag
+    
+    image_data = metadata_store.get(image_id)
+    if image_data is None:
+        view_pages.pop(image_id, None)
+        return None
+    expires_at = get_expiry_time(image_data)
+    minutes_remaining = int(max(0, expires_at - now) / 60) + 1
+    html = render_view_page(image_id, image_data, minutes_remaining)
+    etag = hashlib.sha256(html.encode('utf-8')).hexdigest()[:32]
+    view_pages[image_id] = (expires_at, minutes_remaining, html, etag)
+    return html, etag
+
+def write_view_page(image_id):
+    """Write an image's view page to VIEW_PAGE_FOLDER when pages are served as files.
+
+    The page counts down to the expiry time itself, so it is written once.
+    """
+    if VIEW_PAGE_MODE == 'dynamic':
+        return
+    image_data = metadata_store.get(image_id)
+    if image_data is None:
+        return
+    minutes_remaining = int(max(0, get_expiry_time(image_data) - time.time()) / 60) + 1
+    path = os.path.join(VIEW_PAGE_FOLDER, f"{image_id}.html")
+    temp_path = f"{path}.tmp"
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(render_view_page(image_id, image_data, minutes_remaining))
+        os.replace(temp_path, path)
+    except OSError as e:
+        print(f"[{datetime.datetime.now()}] Error writing view page for {image_id}: {e}")
+
+def forget_view_pages(image_ids):
+    """Drop the cached view pages of deleted images"""
+    for image_id in image_ids:
+        view_pages.pop(image_id, None)
+
 @app.route('/')
 def index():
     """Serve the main HTML page"""
-    return send_from_directory('.', 'index.html')
+    return apply_cache_policy(send_from_directory('.', 'index.html'), 'static')
 
 @app.route('/einkdisplay')
 def einkdisplay():
-    subprocess.run(DISPLAY_COMMAND)
+    show_on_display()
     return redirect(url_for("index"))
 
 @app.route('/api/url', methods=['POST'])
@@ -181,26 +1582,24 @@ def receive_qr_url():
         
         # Check if this is a local image URL
         if ("192.168" in url or "localhost" in url or "127.0.0.1" in url) and ("/uploads/" in url):
-            # This is a local image URL that needs to be uploaded to Render
+            # This is a local image URL that needs to be replicated to Render
             try:
                 # Extract image path from URL
-                image_path = url.split("/uploads/", 1)[1]
+                image_path = secure_filename(url.split("/uploads/", 1)[1])
                 local_path = os.path.join(UPLOAD_FOLDER, image_path)
                 
-                if os.path.exists(local_path):
-                    # Upload the image to your Render site
-                    upload_cmd = f'curl -X POST -F "image=@{local_path}" https://qrcodegeneration2.onrender.com/api/upload'
-                    print(f"[{datetime.datetime.now()}] Uploading image to Render: {upload_cmd}")
-                    
-                    # Execute the upload command
-                    result = os.system(upload_cmd)
-                    
-                    if result == 0:
-                        # If upload succeeds, replace the URL with the Render URL
-                        url = f"https://qrcodegeneration2.onrender.com/view/{image_path.split('.')[0]}"
-                        print(f"[{datetime.datetime.now()}] Transformed URL for Render: {url}")
-                    else:
-                        print(f"[{datetime.datetime.now()}] Failed to upload image to Render")
+                # Uploads are stored by content hash, so look up the image they belong to
+                match = metadata_store.find_by_filename(image_path)
+                
+                if match and os.path.exists(local_path):
+                    # Queue the image for upload to Render; the QR can point at its
+                    # Render page right away since the image ID is preserved
+                    local_id, image_data = match
+                    if replication_outbox and not replication_outbox.is_pending(local_id):
+                        replication_outbox.enqueue(local_id, local_path, image_data['original_filename'],
+                                                   content_hash=image_data.get('sha256'))
+                    url = f"https://qrcodegeneration2.onrender.com/view/{local_id}"
+                    print(f"[{datetime.datetime.now()}] Transformed URL for Render: {url}")
                 else:
                     print(f"[{datetime.datetime.now()}] Local image not found: {local_path}")
             except Exception as e:
@@ -218,19 +1617,15 @@ def receive_qr_url():
         if not qr_url:
             return jsonify({'error': 'Failed to generate QR code'}), 500
 
-        # Save image ID for your epd display to read
-        with open("current_qrcode.txt", "w") as f:
-            f.write(f"{image_id}_qr\n")
-
-        # Display on e-ink
-        time.sleep(1)  # Optional buffer before display
-        subprocess.run(DISPLAY_COMMAND)
+        # Display on e-ink in the background
+        display_job = show_on_display(f"{image_id}_qr")
 
         return jsonify({
             'success': True,
-            'status': 'QR code displayed',
+            'status': 'QR code sent to display',
             'url': url,
-            'qrUrl': qr_url
+            'qrUrl': qr_url,
+            'displayJob': display_job
         }), 200
         
     except Exception as e:
@@ -241,29 +1636,87 @@ def receive_qr_url():
 def static_files(path):
     """Serve static files"""
     if os.path.exists(path):
-        return send_from_directory('.', path)
+        return apply_cache_policy(send_from_directory('.', path), 'static')
     else:
         abort(404)
 
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
     """Serve the uploaded images"""
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return apply_cache_policy(send_from_directory(app.config['UPLOAD_FOLDER'], filename), 'uploads')
+
+@app.route('/renditions/<filename>')
+def rendition_file(filename):
+    """Serve a resized copy of an image as /renditions/<id>_<width>.<format>.
+
+    Renditions not built yet are built first. Images they cannot be built
+    for are redirected to the original upload.
+    """
+    stem, _, image_format = filename.rpartition('.')
+    image_id, _, width = stem.rpartition('_')
+    if image_format not in RENDITION_FORMATS or not width.isdigit() or int(width) not in RENDITION_WIDTHS:
+        abort(404)
+    image_data = metadata_store.get(image_id)
+    if image_data is None:
+        abort(404)
+    
+    if rendition_workers.get(image_id, int(width), image_format) is None:
+        return redirect(f"/uploads/{image_data['filename']}")
+    return apply_cache_policy(send_from_directory(RENDITION_FOLDER, filename), 'renditions')
 
 @app.route('/qrcodes/<filename>')
 def qrcode_file(filename):
-    """Serve the QR code images"""
-    return send_from_directory(app.config['QR_FOLDER'], filename)
+    """Render an image's QR code on demand as /qrcodes/<id>.<format>?size=&ec=
+
+    The format is png, svg, bmp or bits (packed 1-bit rows), size is the
+    largest edge in pixels the client wants and ec one of L, M, Q or H.
+    Older <id>_qr.png links keep working.
+    """
+    image_format = filename.rsplit('.', 1)[-1]
+    image_id = get_artifact_image_id(filename)
+    url = get_qr_payload(image_id)
+    if image_format not in QR_MIMETYPES or url is None:
+        abort(404)
+    
+    ec = request.args.get('ec', '').upper()
+    if ec and ec not in QR_EC_LEVELS:
+        return jsonify({'error': 'ec must be one of L, M, Q or H'}), 400
+    error_correction = QR_EC_LEVELS[ec] if ec else QR_ERROR_CORRECTION
+    
+    # Whole pixels per module keep the code sharp, so round size down
+    box_size = QR_BOX_SIZE
+    size = request.args.get('size', type=int)
+    if size and size > 0:
+        modules = len(get_qr_matrix(url, error_correction)) + 2 * QR_BORDER
+        box_size = max(1, min(size, QR_MAX_RENDER_SIZE) // modules)
+    
+    # Renders are deterministic, so the parameters identify the bytes
+    key = (url, error_correction, box_size, QR_BORDER, image_format)
+    etag = hashlib.sha256(repr(key).encode('utf-8')).hexdigest()[:32]
+    if etag in request.if_none_match:
+        response = app.response_class(status=304)
+    else:
+        try:
+            data = render_qr_code(url, image_format, box_size, error_correction)
+        except concurrent.futures.TimeoutError:
+            return jsonify({'error': 'Server busy, try again'}), 503
+        response = app.response_class(data, mimetype=QR_MIMETYPES[image_format])
+        if image_format == 'bits':
+            pixels = (len(get_qr_matrix(url, error_correction)) + 2 * QR_BORDER) * box_size
+            response.headers['X-Image-Width'] = str(pixels)
+            response.headers['X-Image-Height'] = str(pixels)
+    response.set_etag(etag)
+    # Reused IDs like the remote URL's QR code change, so they are revalidated
+    return apply_cache_policy(response, 'static' if image_id in PERSISTENT_ARTIFACT_IDS else 'qrcodes')
 
 @app.route('/download/<image_id>')
 def download_image(image_id):
     """Download an image with proper headers to force download"""
-    metadata = load_metadata()
+    image_data = metadata_store.get(image_id)
     
-    if image_id not in metadata:
+    if image_data is None:
         return "Image not found or has expired", 404
         
-    image_data = metadata[image_id]
     file_path = os.path.join(UPLOAD_FOLDER, image_data['filename'])
     
     if not os.path.exists(file_path):
@@ -278,71 +1731,85 @@ def download_image(image_id):
     )
 
 @app.route('/view/<image_id>')
+@app.route('/VIEW/<image_id>')  # Uppercase view URLs from QR_UPPERCASE_URLS
 def view_image(image_id):
     """View a single image page, accessible by scanning QR code"""
-    print(f"[{datetime.datetime.now()}] View image request for ID: {image_id}")
-    metadata = load_metadata()
+    if VIEW_PAGE_MODE != 'dynamic':
+        page_filename = f"{secure_filename(image_id)}.html"
+        if os.path.exists(os.path.join(VIEW_PAGE_FOLDER, page_filename)):
+            if VIEW_PAGE_MODE == 'x-accel':
+                response = app.response_class(mimetype='text/html')
+                response.headers['X-Accel-Redirect'] = f"{VIEW_PAGE_ACCEL_PREFIX}/{page_filename}"
+            elif VIEW_PAGE_MODE == 'x-sendfile':
+                response = app.response_class(mimetype='text/html')
+                response.headers['X-Sendfile'] = os.path.abspath(os.path.join(VIEW_PAGE_FOLDER, page_filename))
+            else:
+                response = send_from_directory(VIEW_PAGE_FOLDER, page_filename)
+            response.cache_control.no_cache = True
+            return response
+        # Images uploaded before pages were written are rendered as usual
     
-    if image_id not in metadata:
+    page = get_view_page(image_id)
+    if page is None:
         print(f"[{datetime.datetime.now()}] Image ID not found: {image_id}")
         return "Image not found or has expired", 404
-        
-    image_data = metadata[image_id]
-    # Use absolute URL with Render domain for the image
-    render_url = "https://qrcodegeneration2.onrender.com"
-    image_url = f"{render_url}/uploads/{image_data['filename']}"
     
-    print(f"[{datetime.datetime.now()}] Serving view for image: {image_data['original_filename']}")
-    
-    # Calculate time left
-    now = time.time()
-    age_in_seconds = now - image_data['upload_time']
-    seconds_remaining = max(0, EXPIRATION_TIME - age_in_seconds)
-    minutes_remaining = int(seconds_remaining / 60) + 1
-    
-    # Generate HTML with absolute URLs for all resources
-    html = f"""
-    <!DOCTYPE html>
-    <html lang="en">
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>Image - {image_data['original_filename']}</title>
-        <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/5.15.4/css/all.min.css">
-        <style>
-            /* CSS styles remain the same */
-        </style>
-    </head>
-    <body>
-        <header>
-            <h1>Image Viewer</h1>
-        </header>
-
-        <div class="image-card">
-            <div class="image-container">
-                <img src="{image_url}" alt="{image_data['original_filename']}">
-            </div>
-            <div class="image-info">
-                <div class="image-name">{image_data['original_filename']}</div>
-                <div class="image-expiry">
-                    <i class="fas fa-clock"></i> Expires in {minutes_remaining} minutes
-                </div>
-                <div class="action-buttons">
-                    <a href="{render_url}/download/{image_id}" class="button download">
-                        <i class="fas fa-download"></i> Download
-                    </a>
-                </div>
-            </div>
-        </div>
-
-        <footer>
-            This image will be automatically deleted after 30 minutes from upload.
-        </footer>
-    </body>
-    </html>
-    """
-    
-    return html
+    html, etag = page
+    response = app.response_class(html, mimetype='text/html')
+    response.set_etag(etag)
+    response.cache_control.no_cache = True  # Revalidate, the expiry text changes every minute
+    return response.make_conditional(request)
+
+@app.route('/view.css')
+def view_stylesheet():
+    """Serve the view page's stylesheet; pages link it with a content hash"""
+    return apply_cache_policy(send_from_directory('.', VIEW_CSS_FILE), 'view_css')
+
+@app.route('/api/sweep', methods=['POST'])
+def run_sweep():
+    """Run the orphan sweeper now and report what it reclaimed"""
+    print(f"[{datetime.datetime.now()}] Orphan sweep requested")
+    return jsonify(sweep_orphans())
+
+@app.route('/api/replication/status', methods=['GET'])
+def replication_status():
+    """Report the state of the Render replication outbox"""
+    if not replication_outbox:
+        return jsonify({'enabled': False})
+    return jsonify(dict(replication_outbox.status(), enabled=True))
+
+@app.route('/api/image-workers/status', methods=['GET'])
+def image_workers_status():
+    """Report the image worker pool's queue depth and task counts"""
+    return jsonify(image_workers.status())
+
+@app.route('/api/renditions/status', methods=['GET'])
+def renditions_status():
+    """Report how many renditions were built and the bytes they save"""
+    return jsonify(rendition_workers.status())
+
+@app.route('/api/display/status', methods=['GET'])
+def display_status():
+    """Report the display service's queue, or one job with ?job=<id>"""
+    message = {'op': 'status'}
+    if request.args.get('job'):
+        message['job'] = request.args['job']
+    try:
+        return jsonify(dict(request_display_service(message), running=True))
+    except (OSError, ValueError):
+        if local_display['service'] is None:
+            return jsonify({'running': False})
+        return jsonify(dict(local_display['service'].status(message.get('job')), running=False, local=True))
+
+@app.route('/api/qr-cache/stats', methods=['GET'])
+def qr_cache_stats():
+    """Report QR render cache hits, misses and size"""
+    return jsonify(qr_cache.status())
+
+@app.route('/api/qr-pool/status', methods=['GET'])
+def qr_pool_status():
+    """Report how many pre-rendered image IDs are ready"""
+    return jsonify(qr_pool.status())
 
 @app.route('/api/images', methods=['GET'])
 def get_images():
@@ -350,29 +1817,28 @@ def get_images():
     print(f"[{datetime.datetime.now()}] API endpoint /api/images was called")
     
     try:
-        metadata = load_metadata()
         images = []
         now = time.time()
         server_url = get_server_url()
         
-        for image_id, image_data in metadata.items():
+        for image_id, image_data in metadata_store.items():
             # Calculate time left before expiration
-            age_in_seconds = now - image_data['upload_time']
-            seconds_remaining = max(0, EXPIRATION_TIME - age_in_seconds)
+            seconds_remaining = max(0, get_expiry_time(image_data) - now)
             minutes_remaining = int(seconds_remaining / 60) + 1
             
             # Check if file still exists
             if os.path.exists(os.path.join(UPLOAD_FOLDER, image_data['filename'])):
-                # Get QR code URL or generate if not exists
-                qr_path = f"/qrcodes/{image_id}_qr.png"
-                if not os.path.exists(os.path.join(QR_FOLDER, f"{image_id}_qr.png")):
-                    view_url = f"{server_url}/view/{image_id}"
-                    qr_path = generate_qr_code(view_url, image_id)
+                # QR codes are rendered on demand
+                qr_path = f"/qrcodes/{image_id}.png"
+                
+                thumbnail_url, thumbnail_sources = get_image_sources(image_id, image_data, GALLERY_RENDITION_WIDTHS)
                 
                 images.append({
                     'id': image_id,
                     'name': image_data['original_filename'],
                     'url': f"/uploads/{image_data['filename']}",
+                    'thumbnailUrl': thumbnail_url,
+                    'thumbnailSources': [{'type': mimetype, 'srcset': srcset} for mimetype, srcset in thumbnail_sources],
                     'qrUrl': qr_path,
                     'viewUrl': f"/view/{image_id}",
                     'downloadUrl': f"/download/{image_id}",  # Added downloadUrl
@@ -389,14 +1855,54 @@ def get_images():
         print(f"[{datetime.datetime.now()}] Error in /api/images: {e}")
         return jsonify({'error': str(e)}), 500
 
-import requests
+def link_stored_upload():
+    """Record a new image ID for an upload whose content is already stored"""
+    content_hash = request.form.get('sha256', '')
+    unique_filename = secure_filename(request.form.get('filename', ''))
+    file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
+    
+    # The full hash proves the booth has the content; a prefix would match anyone's upload
+    if not is_valid_content_hash(content_hash) or os.path.splitext(unique_filename)[0] != content_hash:
+        return jsonify({'error': 'Unknown content'}), 404
+    with content_lock:
+        if not os.path.exists(file_path):
+            return jsonify({'error': 'Unknown content'}), 404
+        image_id = get_requested_image_id() or generate_image_id()
+        ttl = get_requested_ttl()
+        upload_time = time.time()
+        metadata_store.set(image_id, {
+            'filename': unique_filename,
+            'original_filename': secure_filename(request.form.get('original_filename', unique_filename)),
+            'upload_time': upload_time,
+            'expires_at': upload_time + ttl,
+            'size': os.path.getsize(file_path),
+            'sha256': content_hash
+        })
+    expiry_scheduler.schedule(image_id, upload_time + ttl)
+    write_view_page(image_id)
+    rendition_workers.submit(image_id)
+    
+    print(f"[{datetime.datetime.now()}] Linked image {image_id} to stored content {unique_filename}")
+    return jsonify({
+        'success': True,
+        'id': image_id,
+        'url': f"/uploads/{unique_filename}",
+        'viewUrl': f"/view/{image_id}"
+    }), 200
 
 @app.route('/api/upload', methods=['POST'])
 def api_upload_file():
     """Handle API file uploads with JSON response"""
     print(f"[{datetime.datetime.now()}] API Upload endpoint was called")
     
+    replicated = get_replicated_image()
+    if replicated:
+        return replicated
+    
     if 'image' not in request.files:
+        # A replicating booth can reference content this server already stores
+        if request.form.get('sha256'):
+            return link_stored_upload()
         print(f"[{datetime.datetime.now()}] No file part in the request")
         return jsonify({'error': 'No file part'}), 400
     
@@ -408,51 +1914,38 @@ def api_upload_file():
     
     if file and allowed_file(file.filename):
         try:
-            image_id = str(uuid.uuid4())
-            original_filename = secure_filename(file.filename)
-            extension = original_filename.rsplit('.', 1)[1].lower() if '.' in original_filename else ''
-            unique_filename = f"{image_id}.{extension}" if extension else image_id
+            # Prefer the booth's ID, then an ID whose QR code is already rendered
+            image_id = get_requested_image_id()
+            pooled_id = None if image_id else qr_pool.claim()
+            image_id = image_id or pooled_id or generate_image_id()
+            ttl = get_requested_ttl()
+            # A replicating booth sends the guest's file name as a field
+            original_filename = secure_filename(request.form.get('original_filename', '')) or secure_filename(file.filename)
+            image_data = save_upload(image_id, file, original_filename, ttl)
+            unique_filename = image_data['filename']
             file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-            file.save(file_path)
             
-            # Skip uploading to Render if already on Render
-            if not IS_RENDER:
-                render_url = "https://qrcodegeneration2.onrender.com/api/upload"
-                print(f"[{datetime.datetime.now()}] Uploading to Render: {render_url}")
-                
-                # Use requests to upload the file to Render
-                with open(file_path, 'rb') as f:
-                    files = {'image': (unique_filename, f)}
-                    response = requests.post(render_url, files=files)
-                
-                if response.status_code != 200:
-                    print(f"[{datetime.datetime.now()}] Warning: Failed to upload to Render. Status: {response.status_code}, Response: {response.text}")
-                    # Optionally, you can handle the failure (e.g., return an error)
+            # Copy the upload to Render in the background unless this is Render
+            if replication_outbox:
+                replication_outbox.enqueue(image_id, file_path, original_filename, {'ttl': ttl}, image_data['sha256'])
             
-            upload_time = time.time()
-            view_url = f"https://qrcodegeneration2.onrender.com/view/{image_id}"
-            qr_url = generate_qr_code(view_url, image_id)
+            view_url = get_view_url(image_id)
+            if pooled_id:
+                # Show the pre-rendered frame now; the pool adds the expiry time after
+                qr_url = f"/qrcodes/{image_id}.png"
+            else:
+                qr_url = generate_qr_code(view_url, image_id, image_data['expires_at'])
             
             if not qr_url:
                 print(f"[{datetime.datetime.now()}] Failed to generate QR code for image ID: {image_id}")
                 return jsonify({'error': 'Failed to generate QR code'}), 500
             
-            with open("current_qrcode.txt", "w") as f:
-                f.write(f"{image_id}_qr\n")
-            
-            metadata = load_metadata()
-            metadata[image_id] = {
-                'filename': unique_filename,
-                'original_filename': original_filename,
-                'upload_time': upload_time,
-                'size': os.path.getsize(file_path)
-            }
-            save_metadata(metadata)
-            
             print(f"[{datetime.datetime.now()}] Successfully saved file: {unique_filename} (ID: {image_id})")
             
-            time.sleep(1)
-            subprocess.run(DISPLAY_COMMAND)
+            # Display QR code on e-ink display in the background
+            display_job = show_on_display(f"{image_id}_qr")
+            if pooled_id:
+                qr_pool.annotate(image_id, image_data['expires_at'])
             
             return jsonify({
                 'success': True,
@@ -462,7 +1955,8 @@ def api_upload_file():
                 'qrUrl': qr_url,
                 'viewUrl': view_url,
                 'downloadUrl': f"https://qrcodegeneration2.onrender.com/download/{image_id}",
-                'timeLeft': 30
+                'displayJob': display_job,
+                'timeLeft': math.ceil(ttl / 60)
             }), 200
             
         except Exception as e:
@@ -498,6 +1992,8 @@ def upload_file():
         return f"Error: {error_message}", status_code
 
 if __name__ == '__main__':
+    # Name this module so image workers do not run this script again when they start
+    __spec__ = importlib.machinery.ModuleSpec('__main__', None)
     print(f"[{datetime.datetime.now()}] Server running at {get_server_url()}")
     print(f"[{datetime.datetime.now()}] Access this server from any device on your network using the URL above")
     app.run(host='0.0.0.0', port=PORT, debug=True)
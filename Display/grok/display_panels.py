@@ -0,0 +1,183 @@
+"""Backends for the booth's 7.5" e-ink panel (Waveshare EPD_7in5_V2).
+
+Every backend shows native frames: rows of 1-bit pixels packed 8 to a byte,
+1 = white, as written to qrcodes_bmp/<frame>.epd by app.py.
+
+- hardware: Waveshare's Python driver when it is installed, which keeps the
+  panel initialized and supports partial refreshes, else the prebuilt epd
+  binary, which does one full refresh per run.
+- simulator: writes what the panel would show to PNG files and sleeps for
+  the panel's modeled refresh time, so the display path can be exercised
+  and load-tested on any machine.
+
+DISPLAY_BACKEND selects the backend ('hardware' or 'simulator').
+"""
+import os
+import time
+import subprocess
+import collections
+import numpy as np
+from PIL import Image
+
+try:
+    from waveshare_epd import epd7in5_V2  # Waveshare's Python driver, only on the Pi
+except (ImportError, RuntimeError):
+    epd7in5_V2 = None
+
+DISPLAY_BACKEND = os.environ.get('DISPLAY_BACKEND', 'hardware')  # 'hardware' or 'simulator'
+PANEL_COMMAND = ["./epd"]
+CURRENT_FRAME_FILE = 'current_qrcode.txt'  # Frame name read by the epd binary
+FRAME_FOLDER = 'qrcodes_bmp'  # <frame>.epd native frames written by app.py
+FRAME_MAGIC = b'EPD1'
+FRAME_WIDTH, FRAME_HEIGHT = 800, 480
+SIMULATOR_FOLDER = os.environ.get('DISPLAY_SIMULATOR_FOLDER', 'display_simulator')
+SIMULATOR_HISTORY = 50  # Frame PNGs kept by the simulator
+SIMULATOR_SPEED = float(os.environ.get('DISPLAY_SIMULATOR_SPEED', 1))  # 0 skips the modeled delays
+SIMULATED_FULL_REFRESH = 5.0  # seconds, approximate EPD_7in5_V2 full refresh
+SIMULATED_PARTIAL_REFRESH = 0.5  # seconds, approximate partial refresh
+
+def load_frame(frame):
+    """Read a native frame as rows of packed pixels (uint8, 1 = white), or None"""
+    try:
+        with open(os.path.join(FRAME_FOLDER, f"{frame}.epd"), 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    if data[:8] != FRAME_MAGIC + FRAME_WIDTH.to_bytes(2, 'little') + FRAME_HEIGHT.to_bytes(2, 'little'):
+        return None
+    return np.frombuffer(data, dtype=np.uint8, offset=8).reshape(FRAME_HEIGHT, FRAME_WIDTH // 8)
+
+def changed_window(previous, current):
+    """Return the (x_start, y_start, x_end, y_end) pixel box that differs, or None.
+
+    x is byte aligned, as the panel's partial window requires.
+    """
+    changed = previous != current
+    rows = np.flatnonzero(changed.any(axis=1))
+    if not rows.size:
+        return None
+    columns = np.flatnonzero(changed.any(axis=0))
+    return int(columns[0]) * 8, int(rows[0]), (int(columns[-1]) + 1) * 8, int(rows[-1]) + 1
+
+class DisplayPanel:
+    """Interface of the display backends.
+
+    show_full(frame, buffer) redraws the whole panel with a native frame (its
+    name and its pixels, which may be None if only the BMP exists).
+    show_partial(buffer, window) refreshes only window, for backends with
+    supports_partial.
+    recover() brings the panel back to a known state after a failed refresh.
+    """
+    name = None
+    supports_partial = False
+
+    def show_full(self, frame, buffer):
+        raise NotImplementedError
+
+    def show_partial(self, buffer, window):
+        raise NotImplementedError
+
+    def recover(self):
+        pass
+
+    def status(self):
+        return {'backend': self.name}
+
+class CommandPanel(DisplayPanel):
+    """The prebuilt epd binary, which initializes the panel and does a full refresh per run"""
+    name = 'epd-binary'
+
+    def __init__(self, command=PANEL_COMMAND):
+        self.command = command
+
+    def show_full(self, frame, buffer):
+        if frame:
+            with open(CURRENT_FRAME_FILE, 'w') as f:
+                f.write(f"{frame}\n")
+        subprocess.run(self.command, check=True)
+
+class WavesharePanel(DisplayPanel):
+    """The EPD_7in5_V2 through Waveshare's Python driver, kept initialized between frames"""
+    name = 'waveshare'
+    supports_partial = True
+
+    def __init__(self):
+        self.epd = epd7in5_V2.EPD()
+        self.epd.init()
+        self.partial_mode = False
+
+    def show_full(self, frame, buffer):
+        if buffer is None:
+            raise FileNotFoundError(f"No native frame for {frame}")
+        if self.partial_mode:
+            self.epd.init()
+            self.partial_mode = False
+        # The driver's buffers are inverted (1 = black), like epd.getbuffer()
+        self.epd.display(bytearray((~buffer).tobytes()))
+
+    def show_partial(self, buffer, window):
+        if not self.partial_mode:
+            self.epd.init_part()
+            self.partial_mode = True
+        x_start, y_start, x_end, y_end = window
+        region = ~buffer[y_start:y_end, x_start // 8:x_end // 8]
+        self.epd.display_Partial(bytearray(region.tobytes()), x_start, y_start, x_end, y_end)
+
+    def recover(self):
+        self.partial_mode = False
+        self.epd.init()
+
+class SimulatedPanel(DisplayPanel):
+    """A panel that saves what it shows as PNG files and models refresh timings"""
+    name = 'simulator'
+    supports_partial = True
+
+    def __init__(self, folder=SIMULATOR_FOLDER, speed=SIMULATOR_SPEED):
+        self.folder = folder
+        self.speed = speed
+        self.screen = np.full((FRAME_HEIGHT, FRAME_WIDTH // 8), 0xFF, dtype=np.uint8)
+        self.frame_count = 0
+        self.modeled_seconds = 0.0
+        self.refreshes = collections.deque(maxlen=SIMULATOR_HISTORY)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+    def show_full(self, frame, buffer):
+        if buffer is None:
+            raise FileNotFoundError(f"No native frame for {frame}")
+        self.screen = buffer.copy()
+        self.refresh('full', None, SIMULATED_FULL_REFRESH)
+
+    def show_partial(self, buffer, window):
+        x_start, y_start, x_end, y_end = window
+        self.screen[y_start:y_end, x_start // 8:x_end // 8] = buffer[y_start:y_end, x_start // 8:x_end // 8]
+        self.refresh('partial', window, SIMULATED_PARTIAL_REFRESH)
+
+    def refresh(self, kind, window, seconds):
+        if self.speed:
+            time.sleep(seconds / self.speed)
+        self.frame_count += 1
+        self.modeled_seconds += seconds
+        self.refreshes.append({'frame': self.frame_count, 'kind': kind, 'window': window, 'seconds': seconds})
+
+        image = Image.frombytes('1', (FRAME_WIDTH, FRAME_HEIGHT), self.screen.tobytes())
+        image.save(os.path.join(self.folder, f"frame_{self.frame_count:06d}.png"))
+        image.save(os.path.join(self.folder, 'latest.png'))
+        try:
+            os.remove(os.path.join(self.folder, f"frame_{self.frame_count - SIMULATOR_HISTORY:06d}.png"))
+        except FileNotFoundError:
+            pass
+
+    def status(self):
+        return dict(super().status(),
+                    frames=self.frame_count,
+                    modeledSeconds=round(self.modeled_seconds, 3),
+                    recentRefreshes=list(self.refreshes)[-10:])
+
+def create_panel(backend=DISPLAY_BACKEND, command=PANEL_COMMAND):
+    """Return the panel for backend; command runs the epd binary if it is used"""
+    if backend == 'simulator':
+        return SimulatedPanel()
+    if epd7in5_V2 is not None:
+        return WavesharePanel()
+    return CommandPanel(command)
@@ -2,16 +2,30 @@ from flask import Flask, request, jsonify, send_from_directory, render_template,
 from flask_cors import CORS
 import os
 import time
-import uuid
+import math
+import secrets
 import datetime
 import socket
 import threading
+import queue
 import json
-import qrcode
-from io import BytesIO
+import atexit
+import heapq
+import hashlib
+import sqlite3
+import concurrent.futures
+import multiprocessing
+import importlib.machinery
 from werkzeug.utils import secure_filename
+from PIL import features
 import requests
 import json
+from image_tasks import build_renditions, save_qr_code
+
+try:
+    import qrcode_terminal  # Optional, draws QR codes in the console
+except ImportError:
+    qrcode_terminal = None
 
 app = Flask(__name__, static_folder='.')
 CORS(app)  # Enable CORS for all routes
@@ -21,58 +35,245 @@ UPLOAD_FOLDER = 'uploads'
 QR_FOLDER = 'qrcodes'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp', 'bmp', 'svg'}
 EXPIRATION_TIME = 30 * 60  # 30 minutes in seconds
-CLEANUP_INTERVAL = 5 * 60  # 5 minutes in seconds
+MAX_EXPIRATION_TIME = 24 * 60 * 60  # Upper bound for a per-upload ttl
+IMAGE_ID_ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'  # Crockford base32
+IMAGE_ID_LENGTH = 8
+QR_UPPERCASE_URLS = os.environ.get('QR_UPPERCASE_URLS', '').lower() in ('1', 'true', 'yes')  # Smaller QR codes
+CLEANUP_INTERVAL = 5 * 60  # 5 minutes in seconds, backstop for the expiry scheduler
+SWEEP_INTERVAL = 60 * 60  # 1 hour in seconds
+SWEEP_GRACE_PERIOD = 60  # Leave files this recent alone during a sweep
 PORT = 3000
+VIEW_CSS_FILE = 'view.css'  # Stylesheet of the /view page
+VIEW_CSS_MAX_AGE = 365 * 24 * 60 * 60  # Its URL changes with its content
+# Cache-Control per route as (max-age in seconds, immutable). Files that never
+# change under their name are cached outright; a max-age of 0 makes browsers
+# revalidate every time with the route's ETag (and Last-Modified for files).
+CACHE_POLICIES = {
+    'uploads': (MAX_EXPIRATION_TIME, True),  # Named by image ID; uploads live at most this long
+    'renditions': (MAX_EXPIRATION_TIME, True),
+    'qrcodes': (MAX_EXPIRATION_TIME, True),  # An image ID's QR code never changes
+    'view_css': (VIEW_CSS_MAX_AGE, True),
+    'static': (0, False),
+}
+# How /view pages are served: 'dynamic' renders them on request, 'static' writes
+# them at upload time and sends the file, and 'x-accel' / 'x-sendfile' leave
+# sending the file to a fronting nginx / Apache
+VIEW_PAGE_MODE = os.environ.get('VIEW_PAGE_MODE', 'dynamic')
+VIEW_PAGE_FOLDER = 'view_pages'
+VIEW_PAGE_ACCEL_PREFIX = os.environ.get('VIEW_PAGE_ACCEL_PREFIX', '/internal/view_pages')  # nginx internal location for VIEW_PAGE_FOLDER
+RENDITION_FOLDER = 'renditions'  # Resized copies of uploads shown by the pages
+RENDITION_WIDTHS = (320, 640, 1280)  # pixels
+GALLERY_RENDITION_WIDTHS = (320, 640)  # The gallery's thumbnails
+RENDITION_FORMATS = ('webp', 'jpeg') if features.check('webp') else ('jpeg',)  # Preferred first
+RENDITION_MIMETYPES = {'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+RENDITION_SOURCE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'webp', 'bmp'}  # GIFs and SVGs are shown as uploaded
+RENDITION_WAIT = 30  # seconds a request waits for a rendition that is being built
+# Processes for CPU-heavy image work, leaving a core for the request threads
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', max(1, (os.cpu_count() or 2) - 1)))
+IMAGE_WORKER_QUEUE_SIZE = 32  # Tasks queued or running at once
+IMAGE_TASK_TIMEOUT = 30  # seconds a caller waits for a task by default
+IMAGE_WORKER_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
 IMAGE_METADATA_FILE = 'image_metadata.json'
+METADATA_FLUSH_DELAY = 0.5  # seconds to batch metadata writes before saving
+METADATA_BACKEND = os.environ.get('METADATA_BACKEND', 'json')  # 'json' or 'sqlite'
+METADATA_DB_FILE = 'image_metadata.db'
 
 # Create necessary directories if they don't exist
-for folder in [UPLOAD_FOLDER, QR_FOLDER]:
+for folder in [UPLOAD_FOLDER, QR_FOLDER, VIEW_PAGE_FOLDER, RENDITION_FOLDER]:
     if not os.path.exists(folder):
         os.makedirs(folder)
 
+# Folders holding per-image files, reconciled against the metadata by the sweeper
+ARTIFACT_FOLDERS = [UPLOAD_FOLDER, QR_FOLDER, VIEW_PAGE_FOLDER, RENDITION_FOLDER]
+# Artifacts that are reused rather than tied to an uploaded image
+PERSISTENT_ARTIFACT_IDS = set()
+
 QR_DISPLAY_PI = "http://192.168.50.48:3000/api/url"  # Replace with actual address
+DISPLAY_NOTIFY_WORKERS = 2  # Concurrent deliveries to the display Pi
+DISPLAY_NOTIFY_QUEUE_SIZE = 100
+DISPLAY_NOTIFY_ATTEMPTS = 5
+DISPLAY_NOTIFY_BACKOFF = 1  # seconds, doubled after every failed attempt
+DISPLAY_NOTIFY_TIMEOUT = 5  # seconds per request
 
-def send_image_url_to_display_pi(image_url):
-    try:
-        # Method 1: Using curl (more reliable in some network configurations)
-        cmd = f'curl -X POST -H "Content-Type: application/json" -d \'{{"url":"{image_url}"}}\' http://192.168.50.48:3000/api/url'
-        print(f"[{datetime.datetime.now()}] Executing curl command: {cmd}")
-        result = os.system(cmd)
+class DisplayNotifier:
+    """Delivers image URLs to the display Pi from background threads.
+
+    Each worker keeps its own keep-alive HTTP session and retries failed
+    deliveries with exponential backoff, so uploads never wait on the Pi.
+    """
+
+    def __init__(self, endpoint, workers=DISPLAY_NOTIFY_WORKERS):
+        self.endpoint = endpoint
+        self.queue = queue.Queue(maxsize=DISPLAY_NOTIFY_QUEUE_SIZE)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.stats = {'queued': 0, 'delivered': 0, 'retried': 0, 'failed': 0, 'dropped': 0}
+        self.last_error = None
+        self.last_delivered_url = None
         
-        if result == 0:
-            print(f"[{datetime.datetime.now()}] Successfully sent image URL to display Pi: {image_url}")
-        else:
-            print(f"[{datetime.datetime.now()}] Failed to send URL. Command returned: {result}")
-            
-            # Fallback method: try with form data instead
-            print(f"[{datetime.datetime.now()}] Trying fallback method with form data")
-            fallback_cmd = f'curl -X POST -F "url={image_url}" http://192.168.50.48:3000/api/url'
-            fallback_result = os.system(fallback_cmd)
+        for _ in range(workers):
+            threading.Thread(target=self.worker, daemon=True).start()
+
+    def notify(self, image_url):
+        """Queue an image URL for delivery without blocking"""
+        try:
+            self.queue.put_nowait(image_url)
+            self.count('queued')
+        except queue.Full:
+            self.count('dropped')
+            print(f"[{datetime.datetime.now()}] Display notification queue full, dropping: {image_url}")
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def session(self):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            self.local.session = session
+        return session
+
+    def worker(self):
+        while True:
+            image_url = self.queue.get()
+            try:
+                self.deliver(image_url)
+            finally:
+                self.queue.task_done()
+
+    def deliver(self, image_url):
+        delay = DISPLAY_NOTIFY_BACKOFF
+        for attempt in range(1, DISPLAY_NOTIFY_ATTEMPTS + 1):
+            try:
+                response = self.session().post(self.endpoint, json={'url': image_url}, timeout=DISPLAY_NOTIFY_TIMEOUT)
+                if response.status_code == 200:
+                    with self.lock:
+                        self.stats['delivered'] += 1
+                        self.last_delivered_url = image_url
+                    print(f"[{datetime.datetime.now()}] Successfully sent image URL to display Pi: {image_url}")
+                    return
+                error = f"HTTP {response.status_code}"
+            except requests.RequestException as e:
+                error = str(e)
             
-            if fallback_result == 0:
-                print(f"[{datetime.datetime.now()}] Fallback method successful")
-            else:
-                print(f"[{datetime.datetime.now()}] Fallback method also failed with code: {fallback_result}")
-                
-    except Exception as e:
-        print(f"[{datetime.datetime.now()}] Error sending image URL: {e}")
+            with self.lock:
+                self.last_error = error
+            print(f"[{datetime.datetime.now()}] Failed to send URL (attempt {attempt}/{DISPLAY_NOTIFY_ATTEMPTS}): {error}")
+            if attempt < DISPLAY_NOTIFY_ATTEMPTS:
+                self.count('retried')
+                time.sleep(delay)
+                delay *= 2
+        
+        self.count('failed')
+
+    def status(self):
+        with self.lock:
+            return dict(self.stats,
+                        pending=self.queue.qsize(),
+                        endpoint=self.endpoint,
+                        lastError=self.last_error,
+                        lastDeliveredUrl=self.last_delivered_url)
+
+display_notifier = DisplayNotifier(QR_DISPLAY_PI)
+
+def send_image_url_to_display_pi(image_url):
+    """Queue an image URL to be shown on the display Pi"""
+    display_notifier.notify(image_url)
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['QR_FOLDER'] = QR_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB max upload size
 
+def generate_image_id():
+    """Create a short image ID that is not in use yet.
+
+    IDs use Crockford's base32 alphabet (digits and uppercase letters without
+    I, L, O and U), which keeps view URLs short and lets an uppercase URL be
+    encoded in the QR code's compact alphanumeric mode.
+    """
+    while True:
+        image_id = ''.join(secrets.choice(IMAGE_ID_ALPHABET) for _ in range(IMAGE_ID_LENGTH))
+        if metadata_store.get(image_id) is None:
+            return image_id
+
+def get_view_url(image_id):
+    """Return the public page an image's QR code points to"""
+    view_url = f"{get_server_url()}/view/{image_id}"
+    return view_url.upper() if QR_UPPERCASE_URLS else view_url
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def get_server_url():
-    """Get the server's IP address for network access"""
+def get_requested_ttl():
+    """Read the optional per-upload lifetime in seconds from the request"""
+    ttl = request.form.get('ttl', type=int)
+    if not ttl or ttl <= 0:
+        return EXPIRATION_TIME
+    return min(ttl, MAX_EXPIRATION_TIME)
+
+# Server URL detection forks ifconfig/ip, so the result is cached and only
+# re-detected when the network interfaces change.
+SERVER_URL_CHECK_INTERVAL = 30  # seconds between cheap interface checks
+server_url_lock = threading.Lock()
+server_url_cache = {'url': None, 'fingerprint': None, 'checked_at': 0}
+
+def get_network_fingerprint():
+    """Cheaply summarize the current network state without forking a process"""
+    fingerprint = []
+    
+    # Interface names and indexes change when adapters come and go
+    try:
+        fingerprint.append(tuple(socket.if_nameindex()))
+    except (AttributeError, OSError):
+        pass
+    
+    # The routing table changes when an interface gets or loses an address
+    try:
+        with open('/proc/net/route', 'r') as f:
+            fingerprint.append(f.read())
+    except OSError:
+        pass
+    
+    # The outbound address picked by the kernel (no packet is actually sent)
+    try:
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            s.connect(('8.8.8.8', 80))
+            fingerprint.append(s.getsockname()[0])
+        finally:
+            s.close()
+    except OSError:
+        fingerprint.append(None)
+    
+    return tuple(fingerprint)
+
+def get_server_url(force_refresh=False):
+    """Get the server's URL, re-detecting it only when the network changed"""
     # First, check if a custom server URL is provided via environment variable
-    import os
     custom_url = os.environ.get('SERVER_URL')
     if custom_url:
-        print(f"[{datetime.datetime.now()}] Using custom server URL from environment: {custom_url}")
         return custom_url
     
+    with server_url_lock:
+        now = time.time()
+        cached_url = server_url_cache['url']
+        if not force_refresh and cached_url and now - server_url_cache['checked_at'] < SERVER_URL_CHECK_INTERVAL:
+            return cached_url
+        
+        fingerprint = get_network_fingerprint()
+        server_url_cache['checked_at'] = now
+        if not force_refresh and cached_url and fingerprint == server_url_cache['fingerprint']:
+            return cached_url
+        
+        if cached_url and not force_refresh:
+            print(f"[{datetime.datetime.now()}] Network change detected, re-detecting server URL")
+        server_url_cache['url'] = detect_server_url()
+        server_url_cache['fingerprint'] = fingerprint
+        return server_url_cache['url']
+
+def detect_server_url():
+    """Get the server's IP address for network access"""
     # Try to get all network interfaces that could be used
     possible_ips = []
     
@@ -150,133 +351,757 @@ def get_server_url():
     # Return the server URL
     return server_url
 
-def load_metadata():
-    """Load the image metadata from the JSON file"""
-    if os.path.exists(IMAGE_METADATA_FILE):
+def get_expiry_time(image_data):
+    """Return the timestamp at which an image expires"""
+    return image_data.get('expires_at', image_data['upload_time'] + EXPIRATION_TIME)
+
+def format_lifetime(seconds):
+    """Describe how long an image is kept, e.g. "30 minutes" or "45 seconds" """
+    seconds = max(0, round(seconds))
+    if seconds < 60:
+        count, unit = seconds, 'second'
+    elif seconds < 60 * 60 or seconds % (60 * 60):
+        count, unit = math.ceil(seconds / 60), 'minute'
+    else:
+        count, unit = seconds // (60 * 60), 'hour'
+    return f"{count} {unit}" if count == 1 else f"{count} {unit}s"
+
+class MetadataStore:
+    """In-memory index of the image metadata, persisted to a JSON file.
+
+    The file is read once at startup and lookups are served from a dict.
+    Changes are written back by a background thread that coalesces bursts
+    of updates into a single atomic rewrite (temp file + rename).
+    """
+
+    def __init__(self, path, flush_delay=METADATA_FLUSH_DELAY):
+        self.path = path
+        self.flush_delay = flush_delay
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.images = {}
+        self.mtime = None
+        self.dirty = False
+        self.flush_requested = threading.Event()
+        self.load()
+        
+        self.writer_thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer_thread.start()
+        atexit.register(self.flush)
+
+    def load(self):
+        """(Re)load the metadata from disk, replacing the in-memory index"""
         try:
-            with open(IMAGE_METADATA_FILE, 'r') as f:
-                return json.load(f)
+            mtime = os.stat(self.path).st_mtime
+            with open(self.path, 'r') as f:
+                images = json.load(f)
+        except FileNotFoundError:
+            return
         except Exception as e:
-            print(f"Error loading metadata: {e}")
-    return {}
+            print(f"[{datetime.datetime.now()}] Error loading metadata: {e}")
+            return
+        self.images = images
+        self.mtime = mtime
 
-def save_metadata(metadata):
-    """Save the image metadata to the JSON file"""
-    try:
-        with open(IMAGE_METADATA_FILE, 'w') as f:
-            json.dump(metadata, f, indent=2)
-    except Exception as e:
-        print(f"Error saving metadata: {e}")
+    def refresh_if_changed(self):
+        """Pick up changes written by another process (e.g. a second gunicorn worker)"""
+        if self.dirty:
+            return
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return
+        if mtime != self.mtime:
+            self.load()
+
+    def get(self, image_id):
+        with self.lock:
+            self.refresh_if_changed()
+            return self.images.get(image_id)
+
+    def items(self):
+        """Return a snapshot of (image_id, image_data) pairs"""
+        with self.lock:
+            self.refresh_if_changed()
+            return list(self.images.items())
+
+    def expired_items(self, now):
+        """Return (image_id, image_data) pairs whose expiry time has passed"""
+        return [(image_id, image_data) for image_id, image_data in self.items()
+                if get_expiry_time(image_data) <= now]
+
+    def set(self, image_id, image_data):
+        with self.lock:
+            self.refresh_if_changed()
+            self.images[image_id] = image_data
+            self.mark_dirty()
+
+    def delete(self, image_ids):
+        with self.lock:
+            self.refresh_if_changed()
+            for image_id in image_ids:
+                self.images.pop(image_id, None)
+            self.mark_dirty()
+
+    def mark_dirty(self):
+        self.dirty = True
+        self.flush_requested.set()
+
+    def write_loop(self):
+        """Write pending changes to disk, batching updates that arrive close together"""
+        while True:
+            self.flush_requested.wait()
+            time.sleep(self.flush_delay)
+            self.flush()
+
+    def flush(self):
+        """Atomically write the index to disk if it has unsaved changes"""
+        with self.write_lock:
+            with self.lock:
+                self.flush_requested.clear()
+                if not self.dirty:
+                    return
+                payload = json.dumps(self.images, separators=(',', ':'))
+                self.dirty = False
+            
+            temp_path = f"{self.path}.tmp"
+            try:
+                with open(temp_path, 'w') as f:
+                    f.write(payload)
+                os.replace(temp_path, self.path)
+                with self.lock:
+                    if not self.dirty:
+                        self.mtime = os.stat(self.path).st_mtime
+            except Exception as e:
+                print(f"[{datetime.datetime.now()}] Error saving metadata: {e}")
+                with self.lock:
+                    self.dirty = True
+
+class SQLiteMetadataStore:
+    """Image metadata kept in a SQLite database in WAL mode.
+
+    Unlike the JSON file, several processes (e.g. gunicorn workers) can read
+    concurrently and each upload is a single-row insert instead of a
+    read-modify-write of the whole index.
+    """
+
+    def __init__(self, path, json_path=IMAGE_METADATA_FILE):
+        self.path = path
+        self.local = threading.local()
+        conn = self.connection()
+        with conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS images (
+                    image_id TEXT PRIMARY KEY,
+                    filename TEXT NOT NULL,
+                    upload_time REAL NOT NULL,
+                    expires_at REAL NOT NULL,
+                    data TEXT NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS images_upload_time ON images (upload_time)")
+            conn.execute("CREATE INDEX IF NOT EXISTS images_filename ON images (filename)")
+            conn.execute("CREATE INDEX IF NOT EXISTS images_expires_at ON images (expires_at)")
+        self.import_json(json_path)
+
+    def connection(self):
+        """Return this thread's connection, opening it on first use"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def import_json(self, json_path):
+        """Carry over entries from an existing JSON metadata file into an empty database"""
+        conn = self.connection()
+        if not os.path.exists(json_path) or conn.execute("SELECT 1 FROM images LIMIT 1").fetchone():
+            return
+        try:
+            with open(json_path, 'r') as f:
+                images = json.load(f)
+        except Exception as e:
+            print(f"[{datetime.datetime.now()}] Error importing metadata from {json_path}: {e}")
+            return
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO images VALUES (?, ?, ?, ?, ?)",
+                [self.row(image_id, image_data) for image_id, image_data in images.items()]
+            )
+        print(f"[{datetime.datetime.now()}] Imported {len(images)} metadata entries from {json_path}")
+
+    def row(self, image_id, image_data):
+        return (image_id, image_data['filename'], image_data['upload_time'],
+                get_expiry_time(image_data), json.dumps(image_data))
+
+    def get(self, image_id):
+        row = self.connection().execute(
+            "SELECT data FROM images WHERE image_id = ?", (image_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def items(self):
+        """Return (image_id, image_data) pairs, oldest upload first"""
+        rows = self.connection().execute(
+            "SELECT image_id, data FROM images ORDER BY upload_time"
+        ).fetchall()
+        return [(image_id, json.loads(data)) for image_id, data in rows]
+
+    def expired_items(self, now):
+        """Return (image_id, image_data) pairs whose expiry time has passed"""
+        rows = self.connection().execute(
+            "SELECT image_id, data FROM images WHERE expires_at <= ? ORDER BY expires_at", (now,)
+        ).fetchall()
+        return [(image_id, json.loads(data)) for image_id, data in rows]
+
+    def set(self, image_id, image_data):
+        conn = self.connection()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?)", self.row(image_id, image_data))
+
+    def delete(self, image_ids):
+        conn = self.connection()
+        with conn:
+            conn.executemany("DELETE FROM images WHERE image_id = ?", [(image_id,) for image_id in image_ids])
+
+    def flush(self):
+        """Writes are committed immediately; nothing to flush"""
+
+def create_metadata_store():
+    """Create the metadata store selected by METADATA_BACKEND"""
+    if METADATA_BACKEND == 'sqlite':
+        print(f"[{datetime.datetime.now()}] Using SQLite metadata store: {METADATA_DB_FILE}")
+        return SQLiteMetadataStore(METADATA_DB_FILE)
+    return MetadataStore(IMAGE_METADATA_FILE)
+
+metadata_store = create_metadata_store()
 
 def generate_qr_code(url, image_id):
     """Generate a QR code for a given URL and save it"""
     try:
-        import qrcode_terminal  # Add this if not already at the top
-
         print(f"[{datetime.datetime.now()}] Generating QR code for URL: {url}")
         
         # Make sure the URL is properly formatted
-        if not url.startswith('http://') and not url.startswith('https://'):
+        if not url.lower().startswith(('http://', 'https://')):
             url = 'http://' + url
         
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_H,  # Higher error correction
-            box_size=10,
-            border=4,
-        )
-        qr.add_data(url)
-        qr.make(fit=True)
-
-        img = qr.make_image(fill_color="black", back_color="white")
         qr_file_path = os.path.join(app.config['QR_FOLDER'], f"{image_id}_qr.png")
-        img.save(qr_file_path)
+        image_workers.run_with_fallback(save_qr_code, url, qr_file_path)
 
         print(f"[{datetime.datetime.now()}] QR code saved to: {qr_file_path}")
         print(f"[{datetime.datetime.now()}] QR code link: {url}")
         send_image_url_to_display_pi(url)
-        qrcode_terminal.draw(url)
+        if qrcode_terminal:
+            qrcode_terminal.draw(url)
 
         return f"/qrcodes/{image_id}_qr.png"
     except Exception as e:
         print(f"[{datetime.datetime.now()}] Error generating QR code: {e}")
         return None
 
-def cleanup_old_files():
-    """Remove files older than EXPIRATION_TIME"""
-    while True:
-        print(f"[{datetime.datetime.now()}] Running cleanup check...")
-        now = time.time()
-        metadata = load_metadata()
-        deleted_ids = []
+class ImageWorkers:
+    """Runs CPU-heavy image work in a bounded pool of worker processes.
+
+    Pillow and numpy hold the GIL for much of their work, so in a request
+    thread a burst of uploads stalls every other guest's request. Worker
+    processes run it on the Pi's other cores instead.
+
+    Forking this multi-threaded process could copy locks held by other
+    threads, so workers come from a fork server (or are spawned) and only
+    import image_tasks.py. Tasks must be functions from that module, which
+    can also run in this process when the workers cannot take them.
+    """
+
+    def __init__(self, workers=IMAGE_WORKERS, queue_size=IMAGE_WORKER_QUEUE_SIZE):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.lock = threading.Lock()
+        self.executor = self.create_executor()
+        self.pending = 0
+        self.peak_pending = 0
+        self.stats = {'submitted': 0, 'completed': 0, 'failed': 0, 'timedOut': 0, 'rejected': 0, 'restarts': 0,
+                      'fallbacks': 0}
+        atexit.register(self.shutdown)
+
+    def create_executor(self):
+        return concurrent.futures.ProcessPoolExecutor(max_workers=self.workers,
+                                                      mp_context=multiprocessing.get_context(IMAGE_WORKER_START_METHOD))
+
+    def submit(self, function, *args, wait=0):
+        """Queue function(*args) and return its Future.
+
+        Waits up to wait seconds for a free slot when queue_size tasks are
+        already queued or running, and returns None if none frees up.
+        """
+        acquired = self.slots.acquire(timeout=wait) if wait > 0 else self.slots.acquire(blocking=False)
+        if not acquired:
+            with self.lock:
+                self.stats['rejected'] += 1
+            return None
+        try:
+            try:
+                future = self.executor.submit(function, *args)
+            except concurrent.futures.process.BrokenProcessPool:
+                # A worker died (e.g. killed for memory), which breaks the whole pool
+                print(f"[{datetime.datetime.now()}] Image worker pool broken, starting a new one")
+                with self.lock:
+                    self.stats['restarts'] += 1
+                self.executor = self.create_executor()
+                future = self.executor.submit(function, *args)
+        except Exception:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.stats['submitted'] += 1
+            self.pending += 1
+            self.peak_pending = max(self.peak_pending, self.pending)
+        future.add_done_callback(self.finish)
+        return future
+
+    def finish(self, future):
+        with self.lock:
+            self.pending -= 1
+            self.stats['failed' if future.cancelled() or future.exception() else 'completed'] += 1
+        self.slots.release()
+
+    def run(self, function, *args, timeout=IMAGE_TASK_TIMEOUT):
+        """Run function(*args) in a worker and return its result.
+
+        Raises concurrent.futures.TimeoutError if the task cannot be queued
+        or does not finish within timeout. A running task cannot be stopped;
+        it finishes in the background and its slot is freed then.
+        """
+        deadline = time.monotonic() + timeout
+        future = self.submit(function, *args, wait=timeout)
+        if future is None:
+            raise concurrent.futures.TimeoutError('Image workers are busy')
+        try:
+            return future.result(timeout=max(0, deadline - time.monotonic()))
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            with self.lock:
+                self.stats['timedOut'] += 1
+            raise
+
+    def run_with_fallback(self, function, *args, timeout=IMAGE_TASK_TIMEOUT):
+        """Run function(*args) in a worker, or in this thread if the workers cannot run it"""
+        try:
+            return self.run(function, *args, timeout=timeout)
+        except Exception as e:
+            # Busy, timed out or broken workers; the task itself raises again here if it is at fault
+            print(f"[{datetime.datetime.now()}] Running {function.__name__} in the app instead of a worker: {e!r}")
+            with self.lock:
+                self.stats['fallbacks'] += 1
+            return function(*args)
+
+    def shutdown(self):
+        """Cancel queued tasks and wait for the running ones to finish"""
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def status(self):
+        with self.lock:
+            return dict(self.stats,
+                        workers=self.workers,
+                        queueDepth=self.pending,
+                        peakQueueDepth=self.peak_pending,
+                        queueSize=self.queue_size)
+
+image_workers = ImageWorkers()
+
+def has_renditions(image_data):
+    """Whether renditions are built for an upload"""
+    return image_data['filename'].rsplit('.', 1)[-1].lower() in RENDITION_SOURCE_EXTENSIONS
+
+def get_rendition_paths(image_id):
+    """Return the files of every rendition of an image"""
+    return [os.path.join(RENDITION_FOLDER, f"{image_id}_{width}.{image_format}")
+            for width in RENDITION_WIDTHS for image_format in RENDITION_FORMATS]
+
+class RenditionWorkers:
+    """Builds the renditions of uploads on the image workers.
+
+    Uploads are queued as soon as they are stored, so pages usually find
+    their renditions ready. A request for one that is still being built
+    waits for that build instead of starting another.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.building = {}  # image ID -> Future
+        self.stats = {'built': 0, 'failed': 0, 'sourceBytes': 0, 'renditionBytes': 0}
+
+    def submit(self, image_id, wait=0):
+        """Queue an image's renditions unless they are being built; returns the Future or None.
+
+        Waits up to wait seconds for the image workers to accept the build.
+        """
+        image_data = metadata_store.get(image_id)
+        if image_data is None or not has_renditions(image_data):
+            return None
+        with self.lock:
+            future = self.building.get(image_id)
+        if future is not None:
+            return future
         
+        started = time.monotonic()
+        upload_path = os.path.join(UPLOAD_FOLDER, image_data['filename'])
+        future = image_workers.submit(build_renditions, image_id, upload_path, RENDITION_FOLDER,
+                                      RENDITION_WIDTHS, RENDITION_FORMATS, wait=wait)
+        if future is None:
+            return None
+        with self.lock:
+            self.building.setdefault(image_id, future)
+        future.add_done_callback(lambda future: self.finish(image_id, image_data, started, future))
+        return future
+
+    def finish(self, image_id, image_data, started, future):
         try:
-            for image_id, image_data in list(metadata.items()):
-                file_path = os.path.join(UPLOAD_FOLDER, image_data['filename'])
-                qr_path = os.path.join(QR_FOLDER, f"{image_id}_qr.png")
-                
-                if os.path.isfile(file_path):
-                    # Check if file has expired
-                    if now - image_data['upload_time'] > EXPIRATION_TIME:
-                        # Delete both the image and its QR code
-                        os.remove(file_path)
-                        if os.path.exists(qr_path):
-                            os.remove(qr_path)
-                        deleted_ids.append(image_id)
-                        print(f"[{datetime.datetime.now()}] Deleted old file: {image_data['filename']}")
-                else:
-                    # File doesn't exist, remove from metadata
-                    if os.path.exists(qr_path):
-                        os.remove(qr_path)
-                    deleted_ids.append(image_id)
-            
-            # Remove deleted files from metadata
-            for image_id in deleted_ids:
-                metadata.pop(image_id, None)
-            
-            save_metadata(metadata)
+            written = future.result()
+            error = None
         except Exception as e:
-            print(f"[{datetime.datetime.now()}] Error during cleanup: {e}")
+            error = e
+        with self.lock:
+            if self.building.get(image_id) is future:
+                del self.building[image_id]
+            if error is None:
+                self.stats['built'] += 1
+                self.stats['sourceBytes'] += image_data['size']
+                self.stats['renditionBytes'] += written
+            else:
+                self.stats['failed'] += 1
+        if error is None:
+            print(f"[{datetime.datetime.now()}] Built renditions of {image_id} in {time.monotonic() - started:.2f}s")
+        else:
+            print(f"[{datetime.datetime.now()}] Error building renditions of {image_id}: {error}")
+
+    def get(self, image_id, width, image_format):
+        """Return the path of a rendition, building it first if needed, or None if it cannot be built"""
+        path = os.path.join(RENDITION_FOLDER, f"{image_id}_{width}.{image_format}")
+        if os.path.exists(path):
+            return path
+        future = self.submit(image_id, wait=RENDITION_WAIT)
+        if future is None:
+            return None
+        concurrent.futures.wait([future], timeout=RENDITION_WAIT)
+        return path if os.path.exists(path) else None
+
+    def status(self):
+        with self.lock:
+            return dict(self.stats, building=len(self.building))
+
+rendition_workers = RenditionWorkers()
+
+def get_image_sources(image_id, image_data, widths=RENDITION_WIDTHS, base_url=''):
+    """Return how a page shows an image, as (src, [(mimetype, srcset)]).
+
+    Images with renditions get a srcset per format and a mid-sized JPEG as
+    src; others are shown from the original upload.
+    """
+    if not has_renditions(image_data):
+        return f"{base_url}/uploads/{image_data['filename']}", []
+    sources = [(RENDITION_MIMETYPES[image_format],
+                ', '.join(f"{base_url}/renditions/{image_id}_{width}.{image_format} {width}w" for width in widths))
+               for image_format in RENDITION_FORMATS]
+    return f"{base_url}/renditions/{image_id}_{widths[len(widths) // 2]}.jpeg", sources
+
+class ExpiryScheduler:
+    """Deletes images when they expire.
+
+    Expiry deadlines are kept in a min-heap fed by uploads, and the worker
+    sleeps until the earliest one instead of rescanning every image on a
+    fixed interval.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.condition = threading.Condition()
+
+    def schedule(self, image_id, expires_at):
+        """Queue an image for deletion at expires_at"""
+        with self.condition:
+            heapq.heappush(self.heap, (expires_at, image_id))
+            # Wake the worker if this is now the earliest deadline
+            if self.heap[0][1] == image_id:
+                self.condition.notify()
+
+    def run(self):
+        """Worker loop: sleep until the next deadline, then delete what is due"""
+        for image_id, image_data in metadata_store.items():
+            self.schedule(image_id, get_expiry_time(image_data))
+        
+        while True:
+            due = []
+            reconcile = False
+            with self.condition:
+                now = time.time()
+                if self.heap and self.heap[0][0] <= now:
+                    while self.heap and self.heap[0][0] <= now:
+                        due.append(heapq.heappop(self.heap)[1])
+                else:
+                    timeout = CLEANUP_INTERVAL
+                    if self.heap:
+                        timeout = min(timeout, self.heap[0][0] - now)
+                    if self.condition.wait(timeout):
+                        continue  # An earlier deadline was scheduled
+                    # Nothing due after a full interval: check the store for images
+                    # scheduled by another process (e.g. a second gunicorn worker)
+                    reconcile = not self.heap or self.heap[0][0] > time.time()
             
-        # Wait for the next cleanup interval
-        time.sleep(CLEANUP_INTERVAL)
+            try:
+                if reconcile:
+                    due = [image_id for image_id, _ in metadata_store.expired_items(time.time())]
+                if due:
+                    expire_images(due)
+            except Exception as e:
+                print(f"[{datetime.datetime.now()}] Error during cleanup: {e}")
+
+def get_artifact_paths(image_id, image_data):
+    """Return every file written for an image"""
+    return [
+        os.path.join(UPLOAD_FOLDER, image_data['filename']),
+        os.path.join(QR_FOLDER, f"{image_id}_qr.png"),
+        os.path.join(VIEW_PAGE_FOLDER, f"{image_id}.html")
+    ] + get_rendition_paths(image_id)
+
+def expire_images(image_ids):
+    """Delete the files of expired images and drop them from the metadata"""
+    now = time.time()
+    deleted_ids = []
+    for image_id in image_ids:
+        image_data = metadata_store.get(image_id)
+        # Skip images that are already gone or were given a later expiry
+        if image_data is None or get_expiry_time(image_data) > now:
+            continue
+        
+        for path in get_artifact_paths(image_id, image_data):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        deleted_ids.append(image_id)
+        print(f"[{datetime.datetime.now()}] Deleted expired file: {image_data['filename']}")
+    
+    if deleted_ids:
+        metadata_store.delete(deleted_ids)
+        forget_view_pages(deleted_ids)
 
-# Start the cleanup thread
-cleanup_thread = threading.Thread(target=cleanup_old_files, daemon=True)
+# Start the expiry scheduler
+expiry_scheduler = ExpiryScheduler()
+cleanup_thread = threading.Thread(target=expiry_scheduler.run, daemon=True)
 cleanup_thread.start()
 
+def get_artifact_image_id(filename):
+    """Map an artifact file name back to the image ID it belongs to"""
+    # Uploads are "<id>.<ext>", QR codes "<id>_qr.png" and "<id>_qr.bmp",
+    # renditions "<id>_<width>.<format>"
+    return filename.split('.', 1)[0].split('_', 1)[0]
+
+def sweep_orphans():
+    """Reconcile the artifact folders against the metadata in one pass.
+
+    Deletes files that belong to no known image and drops metadata entries
+    whose upload has disappeared. Files younger than SWEEP_GRACE_PERIOD are
+    left alone so uploads that are still being written are not removed.
+    """
+    started = time.time()
+    images = dict(metadata_store.items())
+    upload_filenames = {image_data['filename'] for image_data in images.values()}
+    seen_uploads = set()
+    removed_files = 0
+    reclaimed_bytes = 0
+    
+    for folder in ARTIFACT_FOLDERS:
+        try:
+            entries = os.scandir(folder)
+        except FileNotFoundError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.name.startswith('.') or not entry.is_file(follow_symlinks=False):
+                    continue
+                if folder == UPLOAD_FOLDER:
+                    if entry.name in upload_filenames:
+                        seen_uploads.add(entry.name)
+                        continue
+                else:
+                    image_id = get_artifact_image_id(entry.name)
+                    if image_id in images or image_id in PERSISTENT_ARTIFACT_IDS:
+                        continue
+                
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                    if started - stat.st_mtime < SWEEP_GRACE_PERIOD:
+                        continue
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    continue
+                removed_files += 1
+                reclaimed_bytes += stat.st_size
+    
+    # Metadata entries whose upload file is gone can no longer be served
+    missing_ids = [image_id for image_id, image_data in images.items()
+                   if image_data['filename'] not in seen_uploads
+                   and started - image_data['upload_time'] > SWEEP_GRACE_PERIOD]
+    if missing_ids:
+        metadata_store.delete(missing_ids)
+        forget_view_pages(missing_ids)
+    
+    report = {
+        'removedFiles': removed_files,
+        'reclaimedBytes': reclaimed_bytes,
+        'removedEntries': len(missing_ids),
+        'duration': round(time.time() - started, 3)
+    }
+    print(f"[{datetime.datetime.now()}] Orphan sweep: removed {removed_files} files "
+          f"({reclaimed_bytes} bytes) and {len(missing_ids)} stale metadata entries")
+    return report
+
+def run_orphan_sweeper():
+    """Sweep once at startup and then every SWEEP_INTERVAL"""
+    while True:
+        try:
+            sweep_orphans()
+        except Exception as e:
+            print(f"[{datetime.datetime.now()}] Error during orphan sweep: {e}")
+        time.sleep(SWEEP_INTERVAL)
+
+sweeper_thread = threading.Thread(target=run_orphan_sweeper, daemon=True)
+sweeper_thread.start()
+
+def apply_cache_policy(response, route):
+    """Set a response's Cache-Control from CACHE_POLICIES[route]"""
+    max_age, immutable = CACHE_POLICIES[route]
+    if max_age > 0:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+        response.cache_control.immutable = immutable
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+def get_file_version(path):
+    """Short content hash of a file, for cache-busting URLs"""
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:12]
+
+# The /view template is compiled once; pages are cached per image ID as
+# (expiry time, minutes remaining, HTML, ETag) and rebuilt when the minutes change
+view_template = app.jinja_env.get_template('view.html')
+view_css_version = get_file_version(VIEW_CSS_FILE)
+view_pages = {}
+
+def render_view_page(image_id, image_data, minutes_remaining):
+    """Render an image's view page from the compiled template"""
+    # Relative URLs avoid cross-origin issues
+    image_url, image_sources = get_image_sources(image_id, image_data)
+    return view_template.render(image=image_data,
+                                image_url=image_url,
+                                image_sources=image_sources,
+                                download_url=f"/download/{image_id}",
+                                minutes_remaining=minutes_remaining,
+                                expires_at=int(get_expiry_time(image_data)),
+                                lifetime=format_lifetime(get_expiry_time(image_data) - image_data['upload_time']),
+                                css_version=view_css_version)
+
+def get_view_page(image_id):
+    """Return (HTML, ETag) of an image's view page, or None if the image is unknown"""
+    now = time.time()
+    page = view_pages.get(image_id)
+    if page is not None:
+        expires_at, minutes_remaining, html, etag = page
+        if now < expires_at and minutes_remaining == int((expires_at - now) / 60) + 1:
+            return html, etag
+    
+    image_data = metadata_store.get(image_id)
+    if image_data is None:
+        view_pages.pop(image_id, None)
+        return None
+    expires_at = get_expiry_time(image_data)
+    minutes_remaining = int(max(0, expires_at - now) / 60) + 1
+    html = render_view_page(image_id, image_data, minutes_remaining)
+    etag = hashlib.sha256(html.encode('utf-8')).hexdigest()[:32]
+    view_pages[image_id] = (expires_at, minutes_remaining, html, etag)
+    return html, etag
+
+def write_view_page(image_id):
+    """Write an image's view page to VIEW_PAGE_FOLDER when pages are served as files.
+
+    The page counts down to the expiry time itself, so it is written once.
+    """
+    if VIEW_PAGE_MODE == 'dynamic':
+        return
+    image_data = metadata_store.get(image_id)
+    if image_data is None:
+        return
+    minutes_remaining = int(max(0, get_expiry_time(image_data) - time.time()) / 60) + 1
+    path = os.path.join(VIEW_PAGE_FOLDER, f"{image_id}.html")
+    temp_path = f"{path}.tmp"
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(render_view_page(image_id, image_data, minutes_remaining))
+        os.replace(temp_path, path)
+    except OSError as e:
+        print(f"[{datetime.datetime.now()}] Error writing view page for {image_id}: {e}")
+
+def forget_view_pages(image_ids):
+    """Drop the cached view pages of deleted images"""
+    for image_id in image_ids:
+        view_pages.pop(image_id, None)
+
 @app.route('/')
 def index():
     """Serve the main HTML page"""
-    return send_from_directory('.', 'index.html')
+    return apply_cache_policy(send_from_directory('.', 'index.html'), 'static')
 
 @app.route('/<path:path>')
 def static_files(path):
     """Serve static files"""
     if os.path.exists(path):
-        return send_from_directory('.', path)
+        return apply_cache_policy(send_from_directory('.', path), 'static')
     else:
         abort(404)
 
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
     """Serve the uploaded images"""
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return apply_cache_policy(send_from_directory(app.config['UPLOAD_FOLDER'], filename), 'uploads')
+
+@app.route('/renditions/<filename>')
+def rendition_file(filename):
+    """Serve a resized copy of an image as /renditions/<id>_<width>.<format>.
+
+    Renditions not built yet are built first. Images they cannot be built
+    for are redirected to the original upload.
+    """
+    stem, _, image_format = filename.rpartition('.')
+    image_id, _, width = stem.rpartition('_')
+    if image_format not in RENDITION_FORMATS or not width.isdigit() or int(width) not in RENDITION_WIDTHS:
+        abort(404)
+    image_data = metadata_store.get(image_id)
+    if image_data is None:
+        abort(404)
+    
+    if rendition_workers.get(image_id, int(width), image_format) is None:
+        return redirect(f"/uploads/{image_data['filename']}")
+    return apply_cache_policy(send_from_directory(RENDITION_FOLDER, filename), 'renditions')
 
 @app.route('/qrcodes/<filename>')
 def qrcode_file(filename):
     """Serve the QR code images"""
-    return send_from_directory(app.config['QR_FOLDER'], filename)
+    return apply_cache_policy(send_from_directory(app.config['QR_FOLDER'], filename), 'qrcodes')
 
 @app.route('/download/<image_id>')
 def download_image(image_id):
     """Download an image with proper headers to force download"""
-    metadata = load_metadata()
+    image_data = metadata_store.get(image_id)
     
-    if image_id not in metadata:
+    if image_data is None:
         return "Image not found or has expired", 404
         
-    image_data = metadata[image_id]
     file_path = os.path.join(UPLOAD_FOLDER, image_data['filename'])
     
     if not os.path.exists(file_path):
@@ -291,204 +1116,66 @@ def download_image(image_id):
     )
 
 @app.route('/view/<image_id>')
+@app.route('/VIEW/<image_id>')  # Uppercase view URLs from QR_UPPERCASE_URLS
 def view_image(image_id):
     """View a single image page, accessible by scanning QR code"""
-    print(f"[{datetime.datetime.now()}] View image request for ID: {image_id}")
-    metadata = load_metadata()
+    if VIEW_PAGE_MODE != 'dynamic':
+        page_filename = f"{secure_filename(image_id)}.html"
+        if os.path.exists(os.path.join(VIEW_PAGE_FOLDER, page_filename)):
+            if VIEW_PAGE_MODE == 'x-accel':
+                response = app.response_class(mimetype='text/html')
+                response.headers['X-Accel-Redirect'] = f"{VIEW_PAGE_ACCEL_PREFIX}/{page_filename}"
+            elif VIEW_PAGE_MODE == 'x-sendfile':
+                response = app.response_class(mimetype='text/html')
+                response.headers['X-Sendfile'] = os.path.abspath(os.path.join(VIEW_PAGE_FOLDER, page_filename))
+            else:
+                response = send_from_directory(VIEW_PAGE_FOLDER, page_filename)
+            response.cache_control.no_cache = True
+            return response
+        # Images uploaded before pages were written are rendered as usual
     
-    if image_id not in metadata:
+    page = get_view_page(image_id)
+    if page is None:
         print(f"[{datetime.datetime.now()}] Image ID not found: {image_id}")
         return "Image not found or has expired", 404
-        
-    image_data = metadata[image_id]
-    image_url = f"/uploads/{image_data['filename']}"
     
-    # Use relative URL for the image to avoid cross-origin issues
-    server_url = get_server_url()
-    print(f"[{datetime.datetime.now()}] Serving view for image: {image_data['original_filename']}")
-    
-    # Calculate time left
-    now = time.time()
-    age_in_seconds = now - image_data['upload_time']
-    seconds_remaining = max(0, EXPIRATION_TIME - age_in_seconds)
-    minutes_remaining = int(seconds_remaining / 60) + 1
-    
-    # Generate HTML for single image view - without back button
-    html = f"""
-    <!DOCTYPE html>
-    <html lang="en">
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>Image - {image_data['original_filename']}</title>
-        <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/5.15.4/css/all.min.css">
-        <style>
-            :root {{
-                --primary-color: #3498db;
-                --primary-dark: #2980b9;
-                --secondary-color: #2ecc71;
-                --secondary-dark: #27ae60;
-                --background-color: #f5f7fa;
-                --card-color: #ffffff;
-                --text-color: #333333;
-                --text-light: #888888;
-                --shadow: 0 4px 6px rgba(0, 0, 0, 0.1);
-                --border-radius: 8px;
-                --transition: all 0.3s ease;
-            }}
-
-            * {{
-                margin: 0;
-                padding: 0;
-                box-sizing: border-box;
-            }}
-
-            body {{
-                font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-                background-color: var(--background-color);
-                color: var(--text-color);
-                line-height: 1.6;
-                padding: 20px;
-                max-width: 100%;
-                margin: 0 auto;
-                display: flex;
-                flex-direction: column;
-                min-height: 100vh;
-            }}
-
-            header {{
-                text-align: center;
-                margin-bottom: 20px;
-                padding-bottom: 10px;
-                border-bottom: 1px solid #e1e1e1;
-            }}
-
-            header h1 {{
-                color: var(--primary-color);
-                font-size: 1.8rem;
-                margin-bottom: 10px;
-            }}
-
-            .image-card {{
-                background-color: var(--card-color);
-                border-radius: var(--border-radius);
-                box-shadow: var(--shadow);
-                padding: 20px;
-                margin-bottom: 20px;
-                flex: 1;
-                display: flex;
-                flex-direction: column;
-            }}
-
-            .image-container {{
-                flex: 1;
-                display: flex;
-                align-items: center;
-                justify-content: center;
-                margin-bottom: 20px;
-                overflow: hidden;
-            }}
-
-            .image-container img {{
-                max-width: 100%;
-                max-height: 70vh;
-                object-fit: contain;
-            }}
-
-            .image-info {{
-                display: flex;
-                flex-direction: column;
-                gap: 10px;
-            }}
-
-            .image-name {{
-                font-weight: 600;
-                font-size: 1.2rem;
-                color: var(--text-color);
-            }}
-
-            .image-expiry {{
-                font-size: 0.9rem;
-                color: var(--text-light);
-                display: flex;
-                align-items: center;
-                gap: 5px;
-            }}
-
-            .image-expiry i {{
-                color: var(--primary-color);
-            }}
-
-            .action-buttons {{
-                display: flex;
-                justify-content: center;
-                margin-top: 15px;
-            }}
-
-            .button {{
-                display: flex;
-                align-items: center;
-                justify-content: center;
-                background-color: var(--secondary-color);
-                color: white;
-                text-decoration: none;
-                padding: 10px 20px;
-                border-radius: var(--border-radius);
-                transition: var(--transition);
-                font-weight: 500;
-                gap: 5px;
-                cursor: pointer;
-                width: 100%;
-                max-width: 250px;
-            }}
-
-            .button.download {{
-                background-color: var(--secondary-color);
-            }}
-
-            .button.download:hover {{
-                background-color: var(--secondary-dark);
-            }}
-
-            footer {{
-                text-align: center;
-                margin-top: auto;
-                padding-top: 20px;
-                font-size: 0.8rem;
-                color: var(--text-light);
-            }}
-        </style>
-    </head>
-    <body>
-        <header>
-            <h1>Image Viewer</h1>
-        </header>
-
-        <div class="image-card">
-            <div class="image-container">
-                <img src="{image_url}" alt="{image_data['original_filename']}">
-            </div>
-            <div class="image-info">
-                <div class="image-name">{image_data['original_filename']}</div>
-                <div class="image-expiry">
-                    <i class="fas fa-clock"></i> Expires in {minutes_remaining} minutes
-                </div>
-                <div class="action-buttons">
-                    <a href="/download/{image_id}" class="button download">
-                        <i class="fas fa-download"></i> Download
-                    </a>
-                </div>
-            </div>
-        </div>
-
-        <footer>
-            This image will be automatically deleted after 30 minutes from upload.
-        </footer>
-    </body>
-    </html>
-    """
-    
-    return html
+    html, etag = page
+    response = app.response_class(html, mimetype='text/html')
+    response.set_etag(etag)
+    response.cache_control.no_cache = True  # Revalidate, the expiry text changes every minute
+    return response.make_conditional(request)
+
+@app.route('/view.css')
+def view_stylesheet():
+    """Serve the view page's stylesheet; pages link it with a content hash"""
+    return apply_cache_policy(send_from_directory('.', VIEW_CSS_FILE), 'view_css')
+
+@app.route('/api/server-url/refresh', methods=['POST'])
+def refresh_server_url():
+    """Force the cached server URL to be detected again"""
+    print(f"[{datetime.datetime.now()}] Server URL refresh requested")
+    return jsonify({'serverUrl': get_server_url(force_refresh=True)})
+
+@app.route('/api/sweep', methods=['POST'])
+def run_sweep():
+    """Run the orphan sweeper now and report what it reclaimed"""
+    print(f"[{datetime.datetime.now()}] Orphan sweep requested")
+    return jsonify(sweep_orphans())
+
+@app.route('/api/image-workers/status', methods=['GET'])
+def image_workers_status():
+    """Report the image worker pool's queue depth and task counts"""
+    return jsonify(image_workers.status())
+
+@app.route('/api/renditions/status', methods=['GET'])
+def renditions_status():
+    """Report how many renditions were built and the bytes they save"""
+    return jsonify(rendition_workers.status())
+
+@app.route('/api/display/status', methods=['GET'])
+def display_status():
+    """Report the state of the display Pi delivery queue"""
+    return jsonify(display_notifier.status())
 
 @app.route('/api/images', methods=['GET'])
 def get_images():
@@ -496,15 +1183,13 @@ def get_images():
     print(f"[{datetime.datetime.now()}] API endpoint /api/images was called")
     
     try:
-        metadata = load_metadata()
         images = []
         now = time.time()
         server_url = get_server_url()
         
-        for image_id, image_data in metadata.items():
+        for image_id, image_data in metadata_store.items():
             # Calculate time left before expiration
-            age_in_seconds = now - image_data['upload_time']
-            seconds_remaining = max(0, EXPIRATION_TIME - age_in_seconds)
+            seconds_remaining = max(0, get_expiry_time(image_data) - now)
             minutes_remaining = int(seconds_remaining / 60) + 1
             
             # Check if file still exists
@@ -512,14 +1197,18 @@ def get_images():
                 # Get QR code URL or generate if not exists
                 qr_path = f"/qrcodes/{image_id}_qr.png"
                 if not os.path.exists(os.path.join(QR_FOLDER, f"{image_id}_qr.png")):
-                    view_url = f"{server_url}/view/{image_id}"
+                    view_url = get_view_url(image_id)
                     send_image_url_to_display_pi(view_url)
                     qr_path = generate_qr_code(view_url, image_id)
                 
+                thumbnail_url, thumbnail_sources = get_image_sources(image_id, image_data, GALLERY_RENDITION_WIDTHS)
+                
                 images.append({
                     'id': image_id,
                     'name': image_data['original_filename'],
                     'url': f"/uploads/{image_data['filename']}",
+                    'thumbnailUrl': thumbnail_url,
+                    'thumbnailSources': [{'type': mimetype, 'srcset': srcset} for mimetype, srcset in thumbnail_sources],
                     'qrUrl': qr_path,
                     'viewUrl': f"/view/{image_id}",
                     'downloadUrl': f"/download/{image_id}",  # Added downloadUrl
@@ -556,7 +1245,8 @@ def api_upload_file():
     if file and allowed_file(file.filename):
         try:
             # Generate a unique ID for the image
-            image_id = str(uuid.uuid4())
+            image_id = generate_image_id()
+            ttl = get_requested_ttl()
             
             # Secure the filename and add a unique prefix
             original_filename = secure_filename(file.filename)
@@ -571,19 +1261,20 @@ def api_upload_file():
             upload_time = time.time()
             
             # Generate QR code for direct access
-            server_url = get_server_url()
-            view_url = f"{server_url}/view/{image_id}"
+            view_url = get_view_url(image_id)
             qr_url = generate_qr_code(view_url, image_id)
             
             # Record metadata
-            metadata = load_metadata()
-            metadata[image_id] = {
+            metadata_store.set(image_id, {
                 'filename': unique_filename,
                 'original_filename': original_filename,
                 'upload_time': upload_time,
+                'expires_at': upload_time + ttl,
                 'size': os.path.getsize(file_path)
-            }
-            save_metadata(metadata)
+            })
+            expiry_scheduler.schedule(image_id, upload_time + ttl)
+            write_view_page(image_id)
+            rendition_workers.submit(image_id)
             
             print(f"[{datetime.datetime.now()}] Successfully saved file: {unique_filename} (ID: {image_id})")
             
@@ -596,7 +1287,7 @@ def api_upload_file():
                 'qrUrl': qr_url,
                 'viewUrl': f"/view/{image_id}",
                 'downloadUrl': f"/download/{image_id}",  # Added downloadUrl
-                'timeLeft': 30  # Initial expiration time in minutes
+                'timeLeft': math.ceil(ttl / 60)  # Initial expiration time in minutes, rounded up
             }), 200
             
         except Exception as e:
@@ -624,6 +1315,8 @@ def upload_file():
         return f"Error: {error_message}", status_code
 
 if __name__ == '__main__':
+    # Name this module so image workers do not run this script again when they start
+    __spec__ = importlib.machinery.ModuleSpec('__main__', None)
     print(f"[{datetime.datetime.now()}] Server running at {get_server_url()}")
     print(f"[{datetime.datetime.now()}] Access this server from any device on your network using the URL above")
     app.run(host='0.0.0.0', port=PORT, debug=True)
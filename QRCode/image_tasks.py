@@ -0,0 +1,66 @@
+"""Image work run by the app's image worker processes.
+
+Workers are started by a fork server (or spawned), not forked from the
+app, so they only import this module. It must not import app.py or start
+anything when imported. Tasks take and return plain data, and the app
+runs them itself when the workers cannot.
+
+- save_qr_code: a URL's QR code as a PNG file.
+- build_renditions: the resized copies of an upload shown by the pages.
+"""
+import os
+from io import BytesIO
+import qrcode
+from PIL import Image, ImageOps
+
+RENDITION_SAVE_OPTIONS = {
+    'webp': {'quality': 75, 'method': 4},
+    'jpeg': {'quality': 80, 'optimize': True, 'progressive': True}
+}
+
+def save_qr_code(url, path):
+    """Render url's QR code to a PNG file"""
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_H,  # Higher error correction
+        box_size=10,
+        border=4,
+    )
+    qr.add_data(url)
+    qr.make(fit=True)
+    qr.make_image(fill_color="black", back_color="white").save(path)
+
+def build_renditions(image_id, upload_path, folder, widths, formats):
+    """Decode an upload once and write all its renditions; returns their total size.
+
+    Renditions are written to folder as <image id>_<width>.<format>, for
+    each of widths (ascending) and formats. EXIF orientation is applied and
+    no metadata is copied. Images are never enlarged: widths above the
+    original's are written at its size.
+    """
+    with Image.open(upload_path) as image:
+        # JPEGs can be decoded straight at a fraction of their size
+        image.draft('RGB', (widths[-1], widths[-1]))
+        image = ImageOps.exif_transpose(image)
+    has_alpha = image.mode in ('RGBA', 'LA') or 'transparency' in image.info
+    image = image.convert('RGBA' if has_alpha else 'RGB')
+    
+    written = 0
+    # Each width is resized from the previous, larger one
+    for width in sorted(widths, reverse=True):
+        if image.width > width:
+            height = max(1, round(image.height * width / image.width))
+            image = image.resize((width, height), Image.Resampling.LANCZOS, reducing_gap=3.0)
+        for image_format in formats:
+            output = image
+            if image_format == 'jpeg' and has_alpha:
+                output = Image.new('RGB', image.size, 'white')
+                output.paste(image, mask=image.getchannel('A'))
+            buffer = BytesIO()
+            output.save(buffer, image_format.upper(), **RENDITION_SAVE_OPTIONS[image_format])
+            path = os.path.join(folder, f"{image_id}_{width}.{image_format}")
+            with open(f"{path}.tmp", 'wb') as f:
+                f.write(buffer.getvalue())
+            os.replace(f"{path}.tmp", path)
+            written += buffer.tell()
+    return written
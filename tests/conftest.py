@@ -0,0 +1,94 @@
+"""Fixtures loading the Flask apps from throwaway copies of their folders.
+
+Each app writes its data folders relative to the working directory when it
+is imported, so tests run them from a temporary copy and never touch the
+checked-in uploads, frames or metadata.
+"""
+import os
+import sys
+import shutil
+import importlib.util
+from pathlib import Path
+import pytest
+
+REPO = Path(__file__).resolve().parent.parent
+APP_FOLDERS = {
+    'qrcode': 'QRCode',
+    'booth': 'Display/booth-local-server',
+    'grok': 'Display/grok',
+}
+APP_FILES = ['app.py', 'display_panels.py', 'display_service.py', 'image_tasks.py',
+             'index.html', 'style.css', 'view.css', 'templates']
+# Modules the apps import from their own folder; each copy needs its own
+APP_MODULES = ['display_panels', 'display_service', 'image_tasks']
+
+loaded_apps = {}
+
+def load_app(name, tmp_path_factory):
+    """Import an app from a fresh copy of its folder, once per test session"""
+    if name in loaded_apps:
+        return loaded_apps[name]
+    folder = tmp_path_factory.mktemp(name)
+    for entry in APP_FILES:
+        source = REPO / APP_FOLDERS[name] / entry
+        if source.is_dir():
+            shutil.copytree(source, folder / entry)
+        elif source.exists():
+            shutil.copy(source, folder / entry)
+    
+    previous = os.getcwd()
+    os.chdir(folder)
+    sys.path.insert(0, str(folder))
+    for module_name in APP_MODULES:
+        sys.modules.pop(module_name, None)
+    try:
+        spec = importlib.util.spec_from_file_location(f"{name}_app", folder / 'app.py')
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[spec.name] = module
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(str(folder))
+        os.chdir(previous)
+    app_modules = {module_name: sys.modules[module_name] for module_name in APP_MODULES if module_name in sys.modules}
+    loaded_apps[name] = (module, folder, app_modules)
+    return loaded_apps[name]
+
+@pytest.fixture
+def app_copy(tmp_path_factory, monkeypatch):
+    """Call with an app's name to run the test from that app's copy"""
+    used = []
+    def use(name):
+        module, folder, app_modules = load_app(name, tmp_path_factory)
+        monkeypatch.chdir(folder)
+        # Image workers pickle tasks by module name and import them from sys.path
+        monkeypatch.syspath_prepend(str(folder))
+        for module_name, app_module in app_modules.items():
+            monkeypatch.setitem(sys.modules, module_name, app_module)
+        used.append(module)
+        return module
+    yield use
+    # Metadata is written in the background to a relative path; save it before leaving the copy
+    for module in used:
+        module.metadata_store.flush()
+
+@pytest.fixture(params=['booth', 'grok'])
+def display_app(request, app_copy):
+    """Each Display app, run from its own copy"""
+    return app_copy(request.param)
+
+@pytest.fixture
+def qrcode_app(app_copy):
+    """The standalone QRCode app, run from its own copy"""
+    return app_copy('qrcode')
+
+@pytest.fixture(params=['qrcode', 'booth', 'grok'])
+def any_app(request, app_copy, monkeypatch):
+    """Each app, with replication and the displays stubbed out for uploads"""
+    module = app_copy(request.param)
+    if getattr(module, 'replication_outbox', None):
+        monkeypatch.setattr(module.replication_outbox, 'enqueue', lambda *args, **kwargs: None)
+    if hasattr(module, 'show_on_display'):
+        monkeypatch.setattr(module, 'show_on_display', lambda frame=None: {'job': 'test', 'status': 'queued'})
+    if hasattr(module, 'display_notifier'):
+        monkeypatch.setattr(module.display_notifier, 'notify', lambda image_url: None)
+    return module
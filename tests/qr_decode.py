@@ -0,0 +1,139 @@
+"""A minimal QR decoder for checking what the apps actually encode.
+
+It reads a module matrix back into its payload, independently of the
+encoders under test: function patterns come from the reference qrcode
+library and the data bits are unmasked and parsed per ISO/IEC 18004.
+"""
+import numpy as np
+import qrcode
+from qrcode import base, util
+
+ALPHANUMERIC = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ $%*+-./:'
+MODE_NAMES = {util.MODE_NUMBER: 'numeric', util.MODE_ALPHA_NUM: 'alphanumeric', util.MODE_8BIT_BYTE: 'byte'}
+
+def function_modules(version):
+    """Return a boolean matrix of the modules not used for data in version"""
+    qr = qrcode.QRCode(version=version)
+    n = qr.modules_count = version * 4 + 17
+    qr.modules = [[None] * n for _ in range(n)]
+    qr.setup_position_probe_pattern(0, 0)
+    qr.setup_position_probe_pattern(n - 7, 0)
+    qr.setup_position_probe_pattern(0, n - 7)
+    qr.setup_position_adjust_pattern()
+    qr.setup_timing_pattern()
+    qr.setup_type_info(True, 0)
+    if version >= 7:
+        qr.setup_type_number(True)
+    return np.array([[module is not None for module in row] for row in qr.modules])
+
+def read_format(matrix):
+    """Return (error correction, mask pattern) from the format bits beside the top-left finder"""
+    n = len(matrix)
+    positions = [(i, 8) if i < 6 else (i + 1, 8) if i < 8 else (n - 15 + i, 8) for i in range(15)]
+    bits = sum(int(matrix[row][col]) << i for i, (row, col) in enumerate(positions))
+    for error_correction in (qrcode.constants.ERROR_CORRECT_L, qrcode.constants.ERROR_CORRECT_M,
+                             qrcode.constants.ERROR_CORRECT_Q, qrcode.constants.ERROR_CORRECT_H):
+        for mask_pattern in range(8):
+            if util.BCH_type_info((error_correction << 3) | mask_pattern) == bits:
+                return error_correction, mask_pattern
+    raise ValueError('unreadable format information')
+
+def read_codewords(matrix, version, mask_pattern):
+    """Unmask the data modules and read them in placement order"""
+    n = len(matrix)
+    reserved = function_modules(version)
+    mask = util.mask_func(mask_pattern)
+    bits = []
+    row, step = n - 1, -1
+    col = n - 1
+    while col > 0:
+        if col == 6:
+            col -= 1
+        while 0 <= row < n:
+            for c in (col, col - 1):
+                if not reserved[row][c]:
+                    bits.append(bool(matrix[row][c]) ^ mask(row, c))
+            row += step
+        row -= step
+        step = -step
+        col -= 2
+    usable = len(bits) // 8 * 8
+    return np.packbits(np.array(bits[:usable], dtype=np.uint8)).tolist()
+
+def deinterleave(codewords, version, error_correction):
+    """Return the data codewords of all blocks in order"""
+    blocks = base.rs_blocks(version, error_correction)
+    data = [[] for _ in blocks]
+    position = 0
+    for index in range(max(block.data_count for block in blocks)):
+        for block, block_data in zip(blocks, data):
+            if index < block.data_count:
+                block_data.append(codewords[position])
+                position += 1
+    return [codeword for block_data in data for codeword in block_data]
+
+class BitReader:
+    def __init__(self, data):
+        self.bits = np.unpackbits(np.array(data, dtype=np.uint8)).tolist()
+        self.position = 0
+
+    def remaining(self):
+        return len(self.bits) - self.position
+
+    def read(self, count):
+        value = 0
+        for bit in self.bits[self.position:self.position + count]:
+            value = value << 1 | bit
+        self.position += count
+        return value
+
+def decode_matrix(matrix):
+    """Return (payload, [segment modes]) of a QR module matrix (True = dark, no border)"""
+    matrix = np.asarray(matrix, dtype=bool)
+    version = (len(matrix) - 17) // 4
+    error_correction, mask_pattern = read_format(matrix)
+    data = deinterleave(read_codewords(matrix, version, mask_pattern), version, error_correction)
+    
+    reader = BitReader(data)
+    payload = b''
+    modes = []
+    while reader.remaining() >= 4:
+        mode = reader.read(4)
+        if mode == 0:
+            break
+        modes.append(MODE_NAMES[mode])
+        length = reader.read(util.length_in_bits(mode, version))
+        if mode == util.MODE_NUMBER:
+            digits = ''
+            while len(digits) < length:
+                count = min(3, length - len(digits))
+                digits += str(reader.read({3: 10, 2: 7, 1: 4}[count])).zfill(count)
+            payload += digits.encode('ascii')
+        elif mode == util.MODE_ALPHA_NUM:
+            chars = ''
+            while len(chars) < length:
+                if length - len(chars) >= 2:
+                    value = reader.read(11)
+                    chars += ALPHANUMERIC[value // 45] + ALPHANUMERIC[value % 45]
+                else:
+                    chars += ALPHANUMERIC[reader.read(6)]
+            payload += chars.encode('ascii')
+        else:
+            payload += bytes(reader.read(8) for _ in range(length))
+    return payload.decode('utf-8'), modes
+
+def modules_from_pixels(dark):
+    """Sample the module matrix from a rendered QR code (True = dark pixel) on a light background"""
+    dark = np.asarray(dark, dtype=bool)
+    rows = np.flatnonzero(dark.any(axis=1))
+    columns = np.flatnonzero(dark.any(axis=0))
+    size = columns[-1] + 1 - columns[0]
+    # The finder patterns fill the corners, so the dark bounding box is the symbol
+    for version in range(1, 41):
+        count = version * 4 + 17
+        if size % count == 0:
+            box = size // count
+            centers = np.arange(count) * box + box // 2
+            symbol = dark[rows[0]:rows[0] + size, columns[0]:columns[0] + size]
+            return symbol[np.ix_(centers, centers)]
+    raise ValueError(f'{size} pixels is not a whole number of modules')
@@ -0,0 +1,58 @@
+"""Cache-Control policies and conditional requests on the public routes"""
+import os
+import pytest
+from test_qr_pool import make_png
+
+@pytest.fixture
+def uploaded(any_app):
+    """A test client and the upload response for one image"""
+    client = any_app.app.test_client()
+    response = client.post('/api/upload', data={'image': (make_png(), 'photo.png')})
+    assert response.status_code == 200
+    return client, response.get_json()
+
+def assert_long_lived(response, max_age):
+    assert response.status_code == 200
+    assert response.cache_control.public
+    assert response.cache_control.max_age == max_age
+    assert response.cache_control.immutable
+
+def test_uploads_and_qr_codes_are_cached_for_their_lifetime(any_app, uploaded):
+    client, upload = uploaded
+    assert_long_lived(client.get(upload['url']), any_app.CACHE_POLICIES['uploads'][0])
+    assert_long_lived(client.get(upload['qrUrl']), any_app.CACHE_POLICIES['qrcodes'][0])
+
+def test_pages_are_revalidated(any_app, uploaded):
+    client, upload = uploaded
+    paths = [f"/view/{upload['id']}"]
+    if os.path.exists('index.html'):  # grok ships without the upload page
+        paths.append('/')
+    for path in paths:
+        response = client.get(path)
+        assert response.status_code == 200
+        assert response.cache_control.no_cache
+        assert response.cache_control.max_age is None
+
+def test_unchanged_view_pages_answer_304(any_app, uploaded):
+    client, upload = uploaded
+    response = client.get(f"/view/{upload['id']}")
+    etag = response.get_etag()[0]
+    assert etag
+
+    revalidated = client.get(f"/view/{upload['id']}", headers={'If-None-Match': f'"{etag}"'})
+    assert revalidated.status_code == 304
+    assert revalidated.get_data() == b''
+    assert revalidated.get_etag()[0] == etag
+    assert client.get(f"/view/{upload['id']}", headers={'If-None-Match': '"stale"'}).status_code == 200
+
+def test_unchanged_qr_codes_answer_304(any_app, uploaded):
+    client, upload = uploaded
+    response = client.get(upload['qrUrl'])
+    etag = response.get_etag()[0]
+    assert etag
+
+    revalidated = client.get(upload['qrUrl'], headers={'If-None-Match': f'"{etag}"'})
+    assert revalidated.status_code == 304
+    assert revalidated.get_data() == b''
+    assert revalidated.get_etag()[0] == etag
+    assert revalidated.cache_control.max_age == any_app.CACHE_POLICIES['qrcodes'][0]
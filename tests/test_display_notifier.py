@@ -0,0 +1,62 @@
+"""The QRCode app's background deliveries to the display Pi"""
+import requests
+from test_replication import wait_for
+
+class FakeAdapter(requests.adapters.BaseAdapter):
+    """Transport that answers with the given status codes or raises the given errors, in order"""
+
+    def __init__(self, outcomes):
+        super().__init__()
+        self.outcomes = list(outcomes)
+        self.sent = []
+
+    def send(self, request, **kwargs):
+        self.sent.append(request)
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        response = requests.Response()
+        response.status_code = outcome
+        response.request = request
+        response.url = request.url
+        response._content = b''
+        return response
+
+    def close(self):
+        pass
+
+def make_notifier(qrcode_app, monkeypatch, outcomes):
+    monkeypatch.setattr(qrcode_app, 'DISPLAY_NOTIFY_BACKOFF', 0.01)
+    adapter = FakeAdapter(outcomes)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    notifier = qrcode_app.DisplayNotifier('http://display.test/api/url', workers=1)
+    monkeypatch.setattr(notifier, 'session', lambda: session)
+    return notifier, adapter
+
+def test_failed_deliveries_are_retried(qrcode_app, monkeypatch):
+    notifier, adapter = make_notifier(qrcode_app, monkeypatch, [
+        requests.ConnectionError('Connection refused'), 503, 200])
+    notifier.notify('http://example.com/view/ABCDEFGH')
+    wait_for(lambda: notifier.status()['delivered'] == 1)
+
+    status = notifier.status()
+    assert (status['queued'], status['retried'], status['failed']) == (1, 2, 0)
+    assert status['lastError'] == 'HTTP 503'
+    assert status['lastDeliveredUrl'] == 'http://example.com/view/ABCDEFGH'
+    assert [request.body for request in adapter.sent] == [b'{"url": "http://example.com/view/ABCDEFGH"}'] * 3
+
+def test_deliveries_give_up_after_the_last_attempt(qrcode_app, monkeypatch):
+    monkeypatch.setattr(qrcode_app, 'DISPLAY_NOTIFY_ATTEMPTS', 3)
+    notifier, adapter = make_notifier(qrcode_app, monkeypatch, [
+        requests.ConnectionError('Connection refused'), requests.Timeout('Read timed out'), 500, 200])
+    notifier.notify('http://example.com/view/ABCDEFGH')
+    wait_for(lambda: notifier.status()['failed'] == 1)
+    notifier.queue.join()
+
+    status = notifier.status()
+    assert (status['retried'], status['delivered']) == (2, 0)
+    assert status['lastError'] == 'HTTP 500'
+    assert status['lastDeliveredUrl'] is None
+    assert len(adapter.sent) == 3
+    assert adapter.outcomes == [200]  # Never tried a fourth time
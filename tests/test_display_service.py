@@ -0,0 +1,175 @@
+"""The display service's scheduler and refreshes, and how the apps reach it"""
+import sys
+import time
+import pytest
+import numpy as np
+from conftest import REPO
+from test_qr_pool import make_png
+
+sys.path.insert(0, str(REPO / 'Display/booth-local-server'))
+import display_service
+from display_panels import DisplayPanel, FRAME_WIDTH, FRAME_HEIGHT
+
+class FlakyPanel(DisplayPanel):
+    """Raises a driver error on the first refresh, then works"""
+    name = 'flaky'
+
+    def __init__(self):
+        self.shown = []
+        self.recoveries = 0
+
+    def show_full(self, frame, buffer):
+        if not self.shown and not self.recoveries:
+            raise RuntimeError('SPI transfer failed')
+        self.shown.append(frame)
+
+    def recover(self):
+        self.recoveries += 1
+
+def wait_for_job(service, job_id, timeout=5):
+    deadline = time.monotonic() + timeout
+    while service.status(job_id)['status'] in ('queued', 'showing'):
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.02)
+    return service.status(job_id)['status']
+
+def test_worker_survives_driver_errors(monkeypatch):
+    monkeypatch.setattr(display_service, 'DISPLAY_ERROR_DELAY', 0)
+    panel = FlakyPanel()
+    service = display_service.DisplayService(panel, coalesce_window=0)
+    
+    service.submit('1', 'AAAAAAAA_qr')
+    assert wait_for_job(service, '1') == 'failed'
+    service.submit('2', 'BBBBBBBB_qr')
+    assert wait_for_job(service, '2') == 'shown'
+    
+    assert service.worker_thread.is_alive()
+    assert panel.recoveries == 1
+    assert panel.shown == ['BBBBBBBB_qr']
+    assert service.status()['failed'] == 1
+
+@pytest.fixture
+def offline_app(display_app, monkeypatch):
+    """A Display app on a machine where the display service is not running"""
+    monkeypatch.setattr(display_app, 'local_display', {'service': None})
+    monkeypatch.setattr(display_app, 'request_display_service', no_display_service)
+    if display_app.replication_outbox:
+        monkeypatch.setattr(display_app.replication_outbox, 'enqueue', lambda *args, **kwargs: None)
+    return display_app
+
+def no_display_service(message):
+    raise FileNotFoundError('No display service socket')
+
+def panel_error(command=None):
+    raise RuntimeError('Failed to open /dev/spidev0.0')
+
+def test_panel_errors_fall_back_to_the_epd_binary(offline_app, monkeypatch):
+    monkeypatch.setattr(offline_app, 'create_panel', panel_error)
+    monkeypatch.setattr(sys.modules['display_service'], 'DISPLAY_ERROR_DELAY', 0)  # The app's copy
+    job = offline_app.show_on_display('AAAAAAAA_qr')
+    assert job['status'] == 'queued'
+    service = offline_app.local_display['service']
+    assert isinstance(service.panel, offline_app.CommandPanel)
+    # The epd binary is not here; let the job finish inside the app's copy
+    assert wait_for_job(service, job['job']) == 'failed'
+
+def test_uploads_do_not_depend_on_the_display(offline_app, monkeypatch):
+    def service_error(panel):
+        raise RuntimeError("can't start new thread")
+
+    monkeypatch.setattr(offline_app, 'DisplayService', service_error)
+    response = offline_app.app.test_client().post('/api/upload', data={'image': (make_png(), 'photo.png')})
+    assert response.status_code == 200
+    assert response.get_json()['displayJob']['status'] == 'failed'
+
+def test_frames_share_one_local_scheduler(offline_app, monkeypatch):
+    panel = FlakyPanel()
+    panel.recoveries = 1  # Works from the first frame
+    monkeypatch.setattr(offline_app, 'create_panel', lambda command=None: panel)
+    jobs = [offline_app.show_on_display(f"{image_id}_qr") for image_id in ['AAAAAAAA', 'BBBBBBBB', 'CCCCCCCC']]
+    service = offline_app.local_display['service']
+    # The newest frame wins; the ones queued behind it are dropped, not run one by one
+    assert wait_for_job(service, jobs[-1]['job']) == 'shown'
+    assert panel.shown == ['CCCCCCCC_qr']
+    assert [service.status(job['job'])['status'] for job in jobs[:2]] == ['dropped', 'dropped']
+
+def test_render_has_no_display(app_copy, monkeypatch):
+    grok_app = app_copy('grok')
+    monkeypatch.setattr(grok_app, 'IS_RENDER', True)
+    monkeypatch.setattr(grok_app, 'local_display', {'service': None})
+    monkeypatch.setattr(grok_app.replication_outbox, 'enqueue', lambda *args, **kwargs: None)
+    response = grok_app.app.test_client().post('/api/upload', data={'image': (make_png(), 'photo.png')})
+    assert response.status_code == 200
+    assert response.get_json()['displayJob'] is None
+    assert grok_app.local_display['service'] is None
+
+class RecordingPanel(DisplayPanel):
+    """A partial-refresh panel that records each refresh"""
+    name = 'recording'
+    supports_partial = True
+
+    def __init__(self):
+        self.refreshes = []
+
+    def show_full(self, frame, buffer):
+        self.refreshes.append(('full', frame))
+
+    def show_partial(self, buffer, window):
+        self.refreshes.append(('partial', window))
+
+def blank_frame():
+    return np.full((FRAME_HEIGHT, FRAME_WIDTH // 8), 0xFF, dtype=np.uint8)
+
+@pytest.fixture
+def frames(monkeypatch):
+    """Native frames by name, served to the service instead of .epd files"""
+    frames = {}
+    monkeypatch.setattr(display_service, 'load_frame', frames.get)
+    return frames
+
+def test_bursts_show_only_the_newest_frame(frames):
+    panel = RecordingPanel()
+    service = display_service.DisplayService(panel, coalesce_window=0.2)
+    for job_id in '123':
+        service.submit(job_id, f"{job_id * 8}_qr")
+    
+    assert wait_for_job(service, '3') == 'shown'
+    assert [service.status(job_id)['status'] for job_id in '12'] == ['dropped', 'dropped']
+    assert panel.refreshes == [('full', '33333333_qr')]
+
+def test_partial_refresh_covers_only_the_changed_window(frames, monkeypatch):
+    monkeypatch.setattr(display_service, 'DISPLAY_MODE', 'partial')
+    frames['before'] = blank_frame()
+    frames['after'] = blank_frame()
+    frames['after'][100, 3] = 0x7F
+    frames['after'][120:130, 10] = 0x00
+    panel = RecordingPanel()
+    service = display_service.DisplayService(panel, coalesce_window=0)
+    
+    for job_id, frame in [('1', 'before'), ('2', 'after'), ('3', 'after')]:
+        service.submit(job_id, frame)
+        assert wait_for_job(service, job_id) == 'shown'
+    
+    # Byte columns 3-10 and rows 100-129, in pixels
+    assert panel.refreshes == [('full', 'before'), ('partial', (24, 100, 88, 130))]
+    assert display_changes(service) == (1, 1, 1)
+
+def test_partial_refreshes_are_followed_by_a_full_refresh(frames, monkeypatch):
+    monkeypatch.setattr(display_service, 'DISPLAY_MODE', 'partial')
+    monkeypatch.setattr(display_service, 'FULL_REFRESH_INTERVAL', 3)
+    frames['light'] = blank_frame()
+    frames['dark'] = blank_frame()
+    frames['dark'][0, 0] = 0x00
+    panel = RecordingPanel()
+    service = display_service.DisplayService(panel, coalesce_window=0)
+    
+    for job_id in range(6):
+        service.submit(str(job_id), 'dark' if job_id % 2 else 'light')
+        assert wait_for_job(service, str(job_id)) == 'shown'
+    
+    assert [kind for kind, _ in panel.refreshes] == ['full', 'partial', 'partial', 'partial', 'full', 'partial']
+    assert display_changes(service) == (2, 4, 0)
+
+def display_changes(service):
+    status = service.status()
+    return status['fullRefreshes'], status['partialRefreshes'], status['unchanged']
@@ -0,0 +1,99 @@
+"""The expiry scheduler and the orphan sweeper"""
+import os
+import time
+import threading
+import pytest
+from test_replication import wait_for
+
+class StopScheduler(BaseException):
+    """Raised into the worker to end its loop; the loop only catches Exception"""
+
+@pytest.fixture
+def scheduler(any_app, tmp_path, monkeypatch):
+    """A second ExpiryScheduler over an empty store, recording what it expires"""
+    store = any_app.MetadataStore(str(tmp_path / 'image_metadata.json'), flush_delay=0.05)
+    monkeypatch.setattr(any_app, 'metadata_store', store)
+    monkeypatch.setattr(any_app, 'CLEANUP_INTERVAL', 0.2)
+    expire_images = any_app.expire_images
+    expired = []
+    stopping = threading.Event()
+
+    def record_expire(image_ids):
+        if stopping.is_set():
+            raise StopScheduler
+        expired.append(list(image_ids))
+        expire_images(image_ids)
+    monkeypatch.setattr(any_app, 'expire_images', record_expire)
+
+    expiry_scheduler = any_app.ExpiryScheduler()
+    expiry_scheduler.expired = expired
+    def run():
+        try:
+            expiry_scheduler.run()
+        except StopScheduler:
+            pass
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    yield expiry_scheduler
+    stopping.set()
+    expiry_scheduler.schedule('stop', 0)
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+
+def add_image(app, image_id, expires_at):
+    app.metadata_store.set(image_id, {'filename': f"{image_id}.png", 'upload_time': time.time(), 'expires_at': expires_at})
+
+def test_images_expire_in_deadline_order(any_app, scheduler):
+    now = time.time()
+    for image_id, delay in [('third', 0.6), ('first', 0.2), ('second', 0.4)]:
+        add_image(any_app, image_id, now + delay)
+        scheduler.schedule(image_id, now + delay)
+
+    wait_for(lambda: len(scheduler.expired) == 3)
+    assert scheduler.expired == [['first'], ['second'], ['third']]
+    assert any_app.metadata_store.items() == []
+
+def test_extended_images_wait_for_the_new_deadline(any_app, scheduler):
+    now = time.time()
+    add_image(any_app, 'extended', now + 0.2)
+    scheduler.schedule('extended', now + 0.2)
+    add_image(any_app, 'extended', now + 0.8)
+    scheduler.schedule('extended', now + 0.8)
+
+    # The stale deadline fires but leaves the image alone
+    wait_for(lambda: scheduler.expired)
+    assert any_app.metadata_store.get('extended') is not None
+    wait_for(lambda: any_app.metadata_store.get('extended') is None)
+    assert time.time() >= now + 0.8
+    assert scheduler.expired == [['extended'], ['extended']]
+
+def test_backstop_expires_images_scheduled_elsewhere(any_app, scheduler):
+    # Wait until the worker has loaded the store and is idle
+    scheduler.schedule('ready', time.time())
+    wait_for(lambda: scheduler.expired == [['ready']])
+
+    # Written by another process: never scheduled here
+    add_image(any_app, 'elsewhere', time.time() - 1)
+    wait_for(lambda: ['elsewhere'] in scheduler.expired, timeout=2)
+    assert any_app.metadata_store.get('elsewhere') is None
+
+def test_sweep_leaves_recent_files_alone(any_app):
+    orphan = os.path.join(any_app.UPLOAD_FOLDER, 'sweeporphan.png')
+    with open(orphan, 'wb') as f:
+        f.write(b'orphan')
+    upload_time = time.time()
+    any_app.metadata_store.set('sweepfresh', {'filename': 'sweepfresh-gone.png', 'upload_time': upload_time})
+    any_app.metadata_store.set('sweepstale', {'filename': 'sweepstale-gone.png', 'upload_time': upload_time - 120})
+
+    any_app.sweep_orphans()
+    assert os.path.exists(orphan)
+    assert any_app.metadata_store.get('sweepfresh') is not None
+    assert any_app.metadata_store.get('sweepstale') is None
+
+    # Once past the grace period the orphan is reclaimed
+    old = time.time() - any_app.SWEEP_GRACE_PERIOD - 1
+    os.utime(orphan, (old, old))
+    report = any_app.sweep_orphans()
+    assert not os.path.exists(orphan)
+    assert report['removedFiles'] >= 1
+    any_app.metadata_store.delete(['sweepfresh'])
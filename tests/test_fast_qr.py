@@ -0,0 +1,105 @@
+"""FastQRCode must produce exactly what the reference qrcode encoder does"""
+import sys
+import random
+import numpy as np
+import pytest
+import qrcode
+
+EC_LEVELS = {
+    'L': qrcode.constants.ERROR_CORRECT_L,
+    'M': qrcode.constants.ERROR_CORRECT_M,
+    'Q': qrcode.constants.ERROR_CORRECT_Q,
+    'H': qrcode.constants.ERROR_CORRECT_H,
+}
+ALPHABETS = {
+    'numeric': '0123456789',
+    'alphanumeric': '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ $%*+-./:',
+    'byte': 'abcdefghijklmnopqrstuvwxyz0123456789-_.~?=&/',
+}
+MAX_VERSION = 10
+
+class AlwaysVerified:
+    """Stands in for FastQRCode's verified set so the fast path never defers to the reference"""
+
+    def __contains__(self, key):
+        return True
+
+    def add(self, key):
+        pass
+
+@pytest.fixture
+def image_tasks(display_app):
+    """The encoder the app's copy runs on its image workers"""
+    return sys.modules['image_tasks']
+
+def reference_version(payload, error_correction):
+    qr = qrcode.QRCode(error_correction=error_correction)
+    qr.add_data(payload)
+    return qr.best_fit()
+
+def payloads(mode, error_correction):
+    """The longest payload of each version from 1 to MAX_VERSION, plus a short one"""
+    rng = random.Random(f"{mode}-{error_correction}")
+    longest = {}
+    length = 1
+    while True:
+        payload = ''.join(rng.choice(ALPHABETS[mode]) for _ in range(length))
+        version = reference_version(payload, error_correction)
+        if version > MAX_VERSION:
+            break
+        longest[version] = payload
+        length += 1 if length < 20 else 5
+    return [payload[:3] for payload in longest.values()][:1] + list(longest.values())
+
+CASES = [(mode, ec, payload) for mode in ALPHABETS for ec in EC_LEVELS
+         for payload in payloads(mode, EC_LEVELS[ec])]
+
+def test_cases_cover_every_version():
+    for mode in ALPHABETS:
+        for ec, error_correction in EC_LEVELS.items():
+            versions = {reference_version(payload, error_correction)
+                        for case_mode, case_ec, payload in CASES if (case_mode, case_ec) == (mode, ec)}
+            assert versions == set(range(1, MAX_VERSION + 1)), (mode, ec)
+
+@pytest.mark.parametrize('mode,ec,payload', CASES, ids=[f"{mode}-{ec}-{len(payload)}" for mode, ec, payload in CASES])
+def test_fast_qr_matches_reference(image_tasks, monkeypatch, mode, ec, payload):
+    monkeypatch.setitem(image_tasks.fast_qr_state, 'enabled', True)
+    monkeypatch.setitem(image_tasks.fast_qr_state, 'verified', AlwaysVerified())
+    
+    reference = qrcode.QRCode(error_correction=EC_LEVELS[ec], border=0)
+    reference.add_data(payload)
+    reference.make(fit=True)
+    fast = image_tasks.FastQRCode(error_correction=EC_LEVELS[ec], border=0)
+    fast.add_data(payload)
+    fast.make(fit=True)
+    
+    assert fast.version == reference.version
+    assert np.array_equal(np.array(fast.modules, dtype=bool), np.array(reference.modules, dtype=bool))
+    # best_mask_pattern() rebuilds modules, so it is compared last
+    assert fast.best_mask_pattern() == reference.best_mask_pattern()
+    assert image_tasks.fast_qr_state['enabled']
+
+def test_layout_leaves_the_callers_modules_alone(image_tasks, monkeypatch):
+    monkeypatch.setattr(image_tasks, 'qr_layouts', {})
+    qr = qrcode.QRCode(version=7, error_correction=EC_LEVELS['M'], border=0)
+    qr.add_data('HTTPS://EXAMPLE.COM/VIEW/ABCDEFGH')
+    qr.makeImpl(False, 5)
+    modules = [row[:] for row in qr.modules]
+    
+    image_tasks.get_qr_layout(qr)
+    assert qr.modules == modules
+
+@pytest.mark.parametrize('version', [2, 7])
+def test_explicit_mask_patterns_match_reference(image_tasks, monkeypatch, version):
+    # An uncached version lays itself out in the middle of map_data
+    monkeypatch.setattr(image_tasks, 'qr_layouts', {})
+    monkeypatch.setitem(image_tasks.fast_qr_state, 'enabled', True)
+    for mask_pattern in range(8):
+        reference = qrcode.QRCode(version=version, error_correction=EC_LEVELS['L'], border=0, mask_pattern=mask_pattern)
+        reference.add_data('HTTPS://EXAMPLE.COM/VIEW/ABCDEFGH')
+        reference.make(fit=False)
+        fast = image_tasks.FastQRCode(version=version, error_correction=EC_LEVELS['L'], border=0, mask_pattern=mask_pattern)
+        fast.add_data('HTTPS://EXAMPLE.COM/VIEW/ABCDEFGH')
+        fast.make(fit=False)
+        assert fast.modules == reference.modules, mask_pattern
+        image_tasks.qr_layouts.clear()
@@ -0,0 +1,43 @@
+"""CPU-heavy image work in worker processes that only import image_tasks"""
+import os
+from test_qr_pool import make_png
+
+def test_renditions_are_built_in_the_workers(any_app):
+    assert any_app.IMAGE_WORKER_START_METHOD != 'fork'
+    client = any_app.app.test_client()
+    response = client.post('/api/upload', data={'image': (make_png(), 'photo.png')})
+    image_id = response.get_json()['id']
+    
+    future = any_app.rendition_workers.submit(image_id) or any_app.rendition_workers.building.get(image_id)
+    if future is not None:
+        future.result(timeout=60)
+    assert all(os.path.exists(path) for path in any_app.get_rendition_paths(image_id))
+
+def test_qr_codes_are_rendered_in_the_workers(qrcode_app):
+    submitted = qrcode_app.image_workers.status()['submitted']
+    assert qrcode_app.generate_qr_code('http://example.com/view/AAAAAAAA', 'AAAAAAAA')
+    assert qrcode_app.image_workers.status()['submitted'] == submitted + 1
+    assert os.path.getsize(os.path.join(qrcode_app.QR_FOLDER, 'AAAAAAAA_qr.png')) > 0
+
+def test_qr_encoding_and_frames_are_rendered_in_the_workers(display_app):
+    submitted = display_app.image_workers.status()['submitted']
+    url = 'http://example.com/view/WORKERQ1'
+    matrix = display_app.get_qr_matrix(url)
+    modules = display_app.np.pad(matrix, display_app.QR_BORDER)
+    for image_format in ['png', 'svg', 'bits']:
+        assert display_app.render_qr_code(url, image_format) == display_app.QR_RENDERERS[image_format](modules, display_app.QR_BOX_SIZE)
+    epd_data, _ = display_app.render_eink_frame('WORKERQ1', url, 1800000000)
+    assert epd_data.startswith(b'EPD1')
+    # The matrix, three images and the frame
+    assert display_app.image_workers.status()['submitted'] == submitted + 5
+
+def test_busy_workers_fall_back_to_the_app(display_app, monkeypatch):
+    def busy(function, *args, timeout=None):
+        raise display_app.concurrent.futures.TimeoutError('Image workers are busy')
+
+    url = 'http://example.com/view/FALLBAK1'
+    expected = display_app.image_workers.run(display_app.encode_qr_matrix, url, display_app.QR_ERROR_CORRECTION)
+    fallbacks = display_app.image_workers.status()['fallbacks']
+    monkeypatch.setattr(display_app.image_workers, 'run', busy)
+    assert display_app.get_qr_matrix(url).tobytes() == expected
+    assert display_app.image_workers.status()['fallbacks'] == fallbacks + 1
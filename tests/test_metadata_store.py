@@ -0,0 +1,117 @@
+"""The JSON and SQLite image metadata stores"""
+import os
+import json
+import time
+import threading
+from test_replication import wait_for
+
+def make_entry(filename, upload_time, **extra):
+    return dict(filename=filename, upload_time=upload_time, **extra)
+
+def test_sqlite_store_round_trip(display_app, tmp_path):
+    store = display_app.SQLiteMetadataStore(str(tmp_path / 'images.db'), json_path=str(tmp_path / 'missing.json'))
+    store.set('old', make_entry('same.png', 100.0))
+    store.set('new', make_entry('same.png', 200.0, expires_at=300.0, caption='hi'))
+    store.set('other', make_entry('other.png', 150.0))
+
+    assert store.get('new') == make_entry('same.png', 200.0, expires_at=300.0, caption='hi')
+    assert store.get('absent') is None
+    assert [image_id for image_id, _ in store.items()] == ['old', 'other', 'new']
+    assert store.count_references('same.png') == 2
+    assert store.find_by_filename('same.png')[0] == 'new'
+
+    store.delete(['old', 'other'])
+    assert [image_id for image_id, _ in store.items()] == ['new']
+    assert store.count_references('same.png') == 1
+    assert store.find_by_filename('other.png') is None
+
+    # A second store on the same file sees the committed rows
+    reopened = display_app.SQLiteMetadataStore(str(tmp_path / 'images.db'), json_path=str(tmp_path / 'missing.json'))
+    assert reopened.items() == store.items()
+
+def test_sqlite_store_imports_the_json_file_once(display_app, tmp_path):
+    json_path = tmp_path / 'image_metadata.json'
+    images = {
+        'a': make_entry('a.png', 100.0),
+        'b': make_entry('b.png', 200.0, expires_at=250.0),
+    }
+    json_path.write_text(json.dumps(images))
+
+    store = display_app.SQLiteMetadataStore(str(tmp_path / 'images.db'), json_path=str(json_path))
+    assert dict(store.items()) == images
+
+    # Later starts leave a populated database alone
+    store.delete(['a'])
+    json_path.write_text(json.dumps(dict(images, c=make_entry('c.png', 300.0))))
+    reopened = display_app.SQLiteMetadataStore(str(tmp_path / 'images.db'), json_path=str(json_path))
+    assert [image_id for image_id, _ in reopened.items()] == ['b']
+
+def test_sqlite_store_finds_expired_images_by_index(display_app, tmp_path):
+    store = display_app.SQLiteMetadataStore(str(tmp_path / 'images.db'), json_path=str(tmp_path / 'missing.json'))
+    lifetime = display_app.EXPIRATION_TIME
+    store.set('default', make_entry('a.png', 1000.0))
+    store.set('short', make_entry('b.png', 1000.0, expires_at=1000.0 + lifetime / 2))
+    store.set('long', make_entry('c.png', 1000.0, expires_at=1000.0 + lifetime * 2))
+
+    assert store.expired_items(999.0) == []
+    assert [image_id for image_id, _ in store.expired_items(1000.0 + lifetime)] == ['short', 'default']
+    assert [image_id for image_id, _ in store.expired_items(1000.0 + lifetime * 2)] == ['short', 'default', 'long']
+
+    plan = store.connection().execute(
+        "EXPLAIN QUERY PLAN SELECT image_id, data FROM images WHERE expires_at <= ? ORDER BY expires_at", (0,)
+    ).fetchall()
+    assert any('images_expires_at' in row[-1] for row in plan)
+
+def test_sqlite_store_opens_a_connection_per_thread(display_app, tmp_path):
+    store = display_app.SQLiteMetadataStore(str(tmp_path / 'images.db'), json_path=str(tmp_path / 'missing.json'))
+    main_connection = store.connection()
+    assert store.connection() is main_connection
+
+    seen = {}
+    def use_store():
+        seen['connection'] = store.connection()
+        store.set('threaded', make_entry('t.png', 100.0))
+        seen['mode'] = store.connection().execute("PRAGMA journal_mode").fetchone()[0]
+    thread = threading.Thread(target=use_store)
+    thread.start()
+    thread.join()
+
+    assert seen['connection'] is not main_connection
+    assert seen['mode'] == 'wal'
+    assert store.get('threaded') == make_entry('t.png', 100.0)
+
+def test_json_store_batches_writes_into_one_replace(display_app, tmp_path, monkeypatch):
+    path = str(tmp_path / 'image_metadata.json')
+    replaced = []
+    replace = display_app.os.replace
+    def record_replace(source, destination):
+        if destination == path:
+            replaced.append(source)
+        return replace(source, destination)
+    monkeypatch.setattr(display_app.os, 'replace', record_replace)
+
+    store = display_app.MetadataStore(path, flush_delay=0.2)
+    for index in range(5):
+        store.set(f"image{index}", make_entry(f"{index}.png", 100.0 + index))
+    store.delete(['image0'])
+    wait_for(lambda: replaced)
+    time.sleep(0.4)
+
+    assert replaced == [f"{path}.tmp"]
+    assert not (tmp_path / 'image_metadata.json.tmp').exists()
+    with open(path) as f:
+        assert sorted(json.load(f)) == ['image1', 'image2', 'image3', 'image4']
+
+def test_json_store_reloads_a_file_changed_by_another_process(display_app, tmp_path):
+    json_path = tmp_path / 'image_metadata.json'
+    json_path.write_text(json.dumps({'a': make_entry('a.png', 100.0)}))
+    store = display_app.MetadataStore(str(json_path), flush_delay=0.05)
+    assert [image_id for image_id, _ in store.items()] == ['a']
+
+    # Another worker rewrites the file; the new mtime triggers a reload
+    json_path.write_text(json.dumps({'b': make_entry('shared.png', 200.0)}))
+    mtime = json_path.stat().st_mtime + 10
+    os.utime(json_path, (mtime, mtime))
+    assert store.get('a') is None
+    assert store.get('b') == make_entry('shared.png', 200.0)
+    assert store.count_references('shared.png') == 1
@@ -0,0 +1,71 @@
+"""The QR render cache's memory and disk tiers"""
+import os
+from test_qr_pool import make_png
+
+def key(name):
+    return (f"https://example.com/view/{name}", 1, 10, 4, 'png')
+
+def test_memory_tier_evicts_the_least_recently_used(display_app):
+    cache = display_app.QRRenderCache(max_bytes=30)
+    for name in 'abc':
+        cache.put(key(name), name.encode() * 10)
+    assert cache.get(key('a')) == b'a' * 10
+    cache.put(key('d'), b'd' * 10)
+
+    assert list(cache.entries) == [key('c'), key('a'), key('d')]
+    assert cache.get(key('b')) is None
+    assert cache.status()['bytes'] == 30
+    assert (cache.stats['hits'], cache.stats['misses'], cache.stats['evictions']) == (1, 1, 1)
+
+def test_disk_tier_serves_evicted_renders_and_survives_restarts(display_app, tmp_path):
+    folder = str(tmp_path / 'qr_cache')
+    cache = display_app.QRRenderCache(max_bytes=10, disk_folder=folder, disk_max_bytes=1000)
+    cache.put(key('a'), b'a' * 10)
+    cache.put(key('b'), b'b' * 10)
+    assert list(cache.entries) == [key('b')]
+
+    assert cache.get(key('a')) == b'a' * 10
+    assert cache.stats['diskHits'] == 1
+    assert list(cache.entries) == [key('a')]  # Promoted back into memory
+
+    restarted = display_app.QRRenderCache(max_bytes=10, disk_folder=folder, disk_max_bytes=1000)
+    assert restarted.get(key('b')) == b'b' * 10
+    assert restarted.get(key('b')) == b'b' * 10
+    assert (restarted.stats['diskHits'], restarted.stats['hits']) == (1, 1)
+
+def test_disk_tier_removes_the_oldest_files(display_app, tmp_path):
+    folder = str(tmp_path / 'qr_cache')
+    cache = display_app.QRRenderCache(max_bytes=100, disk_folder=folder, disk_max_bytes=25)
+    for age, name in [(300, 'a'), (200, 'b')]:
+        cache.put(key(name), name.encode() * 10)
+        old = os.path.getmtime(cache.disk_path(key(name))) - age
+        os.utime(cache.disk_path(key(name)), (old, old))
+    cache.put(key('c'), b'c' * 10)
+
+    assert not os.path.exists(cache.disk_path(key('a')))
+    assert os.path.exists(cache.disk_path(key('b')))
+    assert os.path.exists(cache.disk_path(key('c')))
+    assert sorted(os.listdir(folder)) == sorted(os.path.basename(cache.disk_path(key(name))) for name in 'bc')
+
+def test_repeated_qr_requests_are_served_from_the_cache(display_app, monkeypatch):
+    monkeypatch.setattr(display_app, 'show_on_display', lambda frame=None: {'job': 'test', 'status': 'queued'})
+    if display_app.replication_outbox:
+        monkeypatch.setattr(display_app.replication_outbox, 'enqueue', lambda *args, **kwargs: None)
+    rendered = []
+    run_with_fallback = display_app.image_workers.run_with_fallback
+    def record_run(function, *args, **kwargs):
+        if function is display_app.QR_RENDERERS['svg']:
+            rendered.append(args[1:])
+        return run_with_fallback(function, *args, **kwargs)
+    monkeypatch.setattr(display_app.image_workers, 'run_with_fallback', record_run)
+
+    client = display_app.app.test_client()
+    image_id = client.post('/api/upload', data={'image': (make_png(), 'photo.png')}).get_json()['id']
+    first = client.get(f"/qrcodes/{image_id}.svg?size=300")
+    second = client.get(f"/qrcodes/{image_id}.svg?size=300")
+    other_size = client.get(f"/qrcodes/{image_id}.svg?size=600")
+
+    assert first.status_code == second.status_code == other_size.status_code == 200
+    assert second.get_data() == first.get_data()
+    assert other_size.get_data() != first.get_data()
+    assert rendered == [(8,), (16,)]  # Box sizes; the repeat was not rendered again
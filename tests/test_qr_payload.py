@@ -0,0 +1,49 @@
+"""QR codes written for uploads must decode to the image's view URL"""
+import io
+import sys
+import numpy as np
+import pytest
+from PIL import Image
+from qr_decode import decode_matrix, modules_from_pixels
+
+def read_eink_qr(app, image_id):
+    """Sample the QR code from the left square of an image's native e-ink frame"""
+    with open(f"{app.BMP_FOLDER}/{image_id}_qr.epd", 'rb') as f:
+        data = f.read()
+    tasks = sys.modules['image_tasks']  # The app's copy, which composes the frames
+    white = np.unpackbits(np.frombuffer(data[8:], dtype=np.uint8)).reshape(tasks.EINK_HEIGHT, tasks.EINK_WIDTH)
+    return modules_from_pixels(~white[:tasks.EINK_QR_AREA, :tasks.EINK_QR_AREA].astype(bool))
+
+@pytest.mark.parametrize('uppercase', [False, True])
+def test_display_qr_round_trips(display_app, monkeypatch, uppercase):
+    monkeypatch.setattr(display_app, 'QR_UPPERCASE_URLS', uppercase)
+    image_id = display_app.generate_image_id()
+    view_url = display_app.get_view_url(image_id)
+    
+    assert display_app.generate_qr_code(view_url, image_id)
+    payload, modes = decode_matrix(read_eink_qr(display_app, image_id))
+    assert payload == view_url
+    assert image_id not in display_app.qr_payloads
+    if uppercase:
+        assert modes == ['alphanumeric']
+    
+    # The on-demand PNG encodes the same URL
+    png = display_app.render_qr_code(view_url, 'png')
+    with Image.open(io.BytesIO(png)) as image:
+        pixels = ~np.array(image.convert('1'), dtype=bool)
+    assert decode_matrix(modules_from_pixels(pixels))[0] == view_url
+
+@pytest.mark.parametrize('uppercase', [False, True])
+def test_qrcode_app_qr_round_trips(qrcode_app, monkeypatch, uppercase):
+    monkeypatch.setattr(qrcode_app, 'QR_UPPERCASE_URLS', uppercase)
+    monkeypatch.setattr(qrcode_app, 'send_image_url_to_display_pi', lambda url: None)
+    image_id = qrcode_app.generate_image_id()
+    view_url = qrcode_app.get_view_url(image_id)
+    
+    assert qrcode_app.generate_qr_code(view_url, image_id)
+    with Image.open(f"{qrcode_app.QR_FOLDER}/{image_id}_qr.png") as image:
+        pixels = ~np.array(image.convert('1'), dtype=bool)
+    payload, modes = decode_matrix(modules_from_pixels(pixels))
+    assert payload == view_url
+    if uppercase:
+        assert modes == ['alphanumeric']
@@ -0,0 +1,45 @@
+"""Uploads that claim a pre-rendered QR code"""
+import io
+import threading
+from PIL import Image
+from test_replication import wait_for
+
+def make_png():
+    buffer = io.BytesIO()
+    Image.new('RGB', (8, 8), 'red').save(buffer, 'PNG')
+    buffer.seek(0)
+    return buffer
+
+def test_pooled_uploads_add_the_expiry_off_the_request(display_app, monkeypatch):
+    rendered = []
+    shown = []
+    generate_qr_code = display_app.generate_qr_code
+
+    def record_render(url, image_id, expires_at=None):
+        rendered.append((image_id, expires_at, threading.current_thread()))
+        return generate_qr_code(url, image_id, expires_at)
+
+    def record_show(frame=None):
+        display_app.display_state['frame'] = frame
+        shown.append(frame)
+        return {'job': 'test', 'status': 'queued'}
+
+    monkeypatch.setattr(display_app, 'generate_qr_code', record_render)
+    monkeypatch.setattr(display_app, 'show_on_display', record_show)
+    if display_app.replication_outbox:
+        monkeypatch.setattr(display_app.replication_outbox, 'enqueue', lambda *args, **kwargs: None)
+    wait_for(lambda: display_app.qr_pool.status()['ready'] > 0, timeout=30)
+
+    response = display_app.app.test_client().post('/api/upload', data={'image': (make_png(), 'photo.png')})
+    assert response.status_code == 200
+    image_id = response.get_json()['id']
+    assert response.get_json()['qrUrl'] == f"/qrcodes/{image_id}.png"
+    assert not [render for render in rendered if render[2] is threading.current_thread()]
+
+    # The pool thread redraws the frame with the expiry time and shows it again
+    expires_at = display_app.metadata_store.get(image_id)['expires_at']
+    wait_for(lambda: shown == [f"{image_id}_qr"] * 2)
+    assert (image_id, expires_at, display_app.qr_pool.worker_thread) in rendered
+    epd_path = display_app.get_eink_paths(image_id)[0]
+    with open(epd_path, 'rb') as f:
+        assert f.read() == display_app.render_eink_frame(image_id, display_app.get_view_url(image_id), expires_at)[0]
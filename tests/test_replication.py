@@ -0,0 +1,116 @@
+"""The replication outbox against a fake Render endpoint"""
+import io
+import os
+import time
+import hashlib
+import pytest
+from PIL import Image
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.text = f"status {status_code}"
+
+class FakeRender:
+    """Answers uploads with a status per image ID and records the file names sent"""
+
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.filenames = {}
+
+    def post(self, endpoint, data, headers=None, timeout=None):
+        fields = data.head.decode('utf-8') if hasattr(data, 'head') else ''
+        image_id = next(image_id for image_id in self.statuses if image_id in fields)
+        self.filenames[image_id] = fields.split('filename="', 1)[1].split('"', 1)[0]
+        return FakeResponse(self.statuses[image_id])
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.02)
+
+@pytest.fixture
+def outbox(display_app, tmp_path):
+    return display_app.ReplicationOutbox(str(tmp_path / 'outbox'), 'http://render.invalid/api/upload')
+
+def enqueue(outbox, tmp_path, image_id, original_filename):
+    path = tmp_path / f"{image_id.lower()}hash.jpg"
+    path.write_bytes(b'not really a jpeg')
+    outbox.enqueue(image_id, str(path), original_filename, {'ttl': 60})
+
+def test_rejected_jobs_do_not_block_the_queue(outbox, tmp_path):
+    outbox.session = FakeRender({'AAAAAAAA': 400, 'BBBBBBBB': 200})
+    enqueue(outbox, tmp_path, 'AAAAAAAA', 'jpg')  # secure_filename('фото.jpg')
+    enqueue(outbox, tmp_path, 'BBBBBBBB', 'photo.jpg')
+    
+    wait_for(lambda: outbox.status()['replicated'] == 1)
+    status = outbox.status()
+    assert status['rejected'] == 1
+    assert status['pending'] == 0
+    assert os.listdir(outbox.rejected_folder) == ['AAAAAAAA.json']
+    # The multipart name keeps the stored file's extension
+    assert outbox.session.filenames == {'AAAAAAAA': 'AAAAAAAA.jpg', 'BBBBBBBB': 'BBBBBBBB.jpg'}
+
+def test_server_errors_are_retried(outbox, tmp_path):
+    outbox.session = FakeRender({'CCCCCCCC': 503})
+    enqueue(outbox, tmp_path, 'CCCCCCCC', 'photo.jpg')
+    
+    wait_for(lambda: outbox.status()['failedAttempts'] >= 1)
+    status = outbox.status()
+    assert status['pending'] == 1
+    assert status['rejected'] == 0
+
+def test_queued_images_are_reported_pending(outbox, tmp_path):
+    outbox.session = FakeRender({'DDDDDDDD': 503})
+    assert not outbox.is_pending('DDDDDDDD')
+    enqueue(outbox, tmp_path, 'DDDDDDDD', 'photo.jpg')
+    assert outbox.is_pending('DDDDDDDD')
+
+@pytest.fixture
+def grok_app(app_copy):
+    return app_copy('grok')
+
+def test_resent_image_ids_are_acknowledged(grok_app):
+    content = b'the same photo'
+    content_hash = hashlib.sha256(content).hexdigest()
+    grok_app.metadata_store.set('EEEEEEEE', {
+        'filename': f"{content_hash}.jpg",
+        'original_filename': 'photo.jpg',
+        'upload_time': time.time(),
+        'expires_at': time.time() + 60,
+        'size': len(content),
+        'sha256': content_hash
+    })
+    before = dict(grok_app.metadata_store.get('EEEEEEEE'))
+    client = grok_app.app.test_client()
+    
+    # A retried link, then a retried upload without the hash field
+    response = client.post('/api/upload', data={'image_id': 'EEEEEEEE', 'sha256': content_hash,
+                                                'filename': f"{content_hash}.jpg"})
+    assert response.status_code == 200
+    assert response.get_json()['id'] == 'EEEEEEEE'
+    response = client.post('/api/upload', data={'image_id': 'EEEEEEEE',
+                                                'image': (io.BytesIO(content), 'EEEEEEEE.jpg')})
+    assert response.status_code == 200
+    assert grok_app.metadata_store.get('EEEEEEEE') == before
+    
+    response = client.post('/api/upload', data={'image_id': 'EEEEEEEE',
+                                                'image': (io.BytesIO(b'another photo'), 'EEEEEEEE.jpg')})
+    assert response.status_code == 409
+    assert grok_app.metadata_store.get('EEEEEEEE') == before
+
+def test_links_need_the_full_content_hash(grok_app):
+    content = io.BytesIO()
+    Image.new('RGB', (8, 8), 'blue').save(content, 'JPEG')
+    content_hash = hashlib.sha256(content.getvalue()).hexdigest()
+    filename = f"{content_hash}.jpg"
+    with open(os.path.join(grok_app.UPLOAD_FOLDER, filename), 'wb') as f:
+        f.write(content.getvalue())
+    client = grok_app.app.test_client()
+    
+    for guess in [content_hash[:1], content_hash[:63], content_hash.upper(), '']:
+        response = client.post('/api/upload', data={'sha256': guess or 'x', 'filename': filename})
+        assert response.status_code == 404, guess
+    response = client.post('/api/upload', data={'sha256': content_hash, 'filename': filename})
+    assert response.status_code == 200
@@ -0,0 +1,18 @@
+"""View pages and upload responses report the upload's own lifetime"""
+import pytest
+from test_qr_pool import make_png
+
+@pytest.mark.parametrize('ttl, time_left, lifetime', [
+    (45, 1, '45 seconds'),
+    (90, 2, '2 minutes'),
+    (30 * 60, 30, '30 minutes'),
+    (2 * 60 * 60, 120, '2 hours'),
+])
+def test_short_lifetimes_are_not_rounded_away(any_app, ttl, time_left, lifetime):
+    client = any_app.app.test_client()
+    response = client.post('/api/upload', data={'image': (make_png(), 'photo.png'), 'ttl': str(ttl)})
+    assert response.status_code == 200
+    assert response.get_json()['timeLeft'] == time_left
+    
+    page = client.get(f"/view/{response.get_json()['id']}").get_data(as_text=True)
+    assert f"deleted {lifetime} after upload" in page